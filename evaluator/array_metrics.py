@@ -0,0 +1,228 @@
+"""Array backend of the TrajNet++ evaluator.
+
+The ground-truth and predicted scenes (lists of TrackRow) are converted once
+to padded arrays. The metrics of trajnetplusplustools.metrics are then
+computed for all scenes together with the same semantics (first strict
+minimum for Top-k, skip rules of the NLL). Collisions are computed with
+evaluator.eval_utils.segment_collisions.
+"""
+import numpy as np
+from scipy.stats import gaussian_kde
+
+
+class IrregularScene(Exception):
+    """Scene that cannot be represented exactly by the padded arrays
+    (e.g. missing or duplicate frames). Such files are evaluated row by row."""
+
+
+def aligned_track(track, frame_index, num_frames):
+    """Positions of a track at the frames of frame_index [num_frames, 2] (NaN if absent)
+    and the mask of the frames present in the track [num_frames,]"""
+    xy = np.full((num_frames, 2), np.nan)
+    present = np.zeros(num_frames, dtype=bool)
+    rows = [(frame_index[row.frame], row.x, row.y) for row in track if row.frame in frame_index]
+    if rows:
+        rows = np.array(rows)
+        index = rows[:, 0].astype(int)
+        if np.any(np.diff(index) <= 0):
+            raise IrregularScene('duplicate or unordered frames')
+        xy[index] = rows[:, 1:]
+        present[index] = True
+    return xy, present
+
+
+def scene_to_arrays(ground_truth, primary_tracks_all, neighbours_tracks_all, obs_length, pred_length,
+                    topk_modes=0, n_samples=0, collision=True):
+    """Convert one scene to arrays. See scenes_to_arrays."""
+    if len(ground_truth[0]) < max(pred_length, obs_length + 1):
+        raise IrregularScene('ground truth too short')
+    gt_rows = ground_truth[0][-pred_length:]
+    frame_gt = [row.frame for row in gt_rows]
+    frame_index = {frame: t for t, frame in enumerate(frame_gt)}
+    if np.any(np.diff(frame_gt) <= 0) or ground_truth[0][obs_length].frame <= ground_truth[0][0].frame:
+        raise IrregularScene('unordered frames')
+
+    ## Primary predictions: (frame, prediction_number, x, y)
+    rows = np.array([(row.frame, -1 if row.prediction_number is None else row.prediction_number, row.x, row.y)
+                     for row in primary_tracks_all]).reshape(-1, 4)
+    modes = rows[:, 1]
+    if not np.array_equal(rows[modes == 0, 0], frame_gt):
+        raise IrregularScene('frame numbers are not consistent')
+
+    ## Last pred_length rows of every evaluated mode
+    pred = []
+    for mode in range(max(topk_modes, 1)):
+        mode_rows = rows[modes == mode]
+        if len(mode_rows) < pred_length:
+            raise IrregularScene('missing predictions')
+        pred.append(mode_rows[-pred_length:, 2:])
+
+    ## First n_samples predictions at every frame
+    samples = None
+    if n_samples:
+        slots = np.array([frame_index.get(frame, -1) for frame in rows[:, 0].tolist()], dtype=int)
+        valid = slots >= 0
+        counts = np.bincount(slots[valid], minlength=pred_length)
+        if counts.min() < n_samples or counts.min() != counts.max():
+            raise IrregularScene('not enough predictions')
+        order = np.argsort(slots[valid], kind='stable')
+        samples = rows[valid][order, 2:].reshape(pred_length, counts[0], 2)[:, :n_samples]
+
+    arrays = dict(gt=np.array([(row.x, row.y) for row in gt_rows]), pred=np.stack(pred))
+    if samples is not None:
+        arrays['samples'] = samples
+
+    if collision:
+        ## Neighbours in ground truth (that appear before the end of observation)
+        obs_end_frame = ground_truth[0][obs_length].frame
+        gt_neigh = [aligned_track(track, frame_index, pred_length)
+                    for track in ground_truth[1:] if track[0].frame < obs_end_frame]
+        ## Neighbours in predictions
+        pred_neigh = [aligned_track([row for row in track if row.prediction_number == 0], frame_index, pred_length)
+                      for track in neighbours_tracks_all]
+        arrays['gt_neigh'] = gt_neigh
+        arrays['pred_neigh'] = pred_neigh
+    return arrays
+
+
+def pad_tracks(tracks_list, num_frames):
+    """Stack lists of (xy, present) per scene to [num_scenes, max_tracks, num_frames, 2]
+    and [num_scenes, max_tracks, num_frames]"""
+    max_tracks = max([len(tracks) for tracks in tracks_list] + [1])
+    xy = np.full((len(tracks_list), max_tracks, num_frames, 2), np.nan)
+    present = np.zeros((len(tracks_list), max_tracks, num_frames), dtype=bool)
+    for i, tracks in enumerate(tracks_list):
+        for j, (track_xy, track_present) in enumerate(tracks):
+            xy[i, j] = track_xy
+            present[i, j] = track_present
+    return xy, present
+
+
+def scenes_to_arrays(scenes_gt, scenes_pred, obs_length, pred_length, topk_modes=0, n_samples=0, collision=True):
+    """Convert all scenes to padded arrays.
+
+    Parameters
+    ----------
+    scenes_gt : List of ground-truth scenes (paths of TrackRow)
+    scenes_pred : List of predicted scenes [primary rows, neighbour rows ...]
+        (rows restricted to the scene, see bucket_predictions)
+    topk_modes : Number of modes for Top-k (0: no Top-k)
+    n_samples : Number of samples for the NLL (0: no NLL)
+    collision : Whether to convert the neighbours for the collision metrics
+
+    Returns
+    -------
+    arrays : dict
+        gt : [num_scenes, pred_length, 2] Primary ground truth
+        pred : [num_scenes, modes, pred_length, 2] Primary predictions (last pred_length rows per mode)
+        samples : [num_scenes, pred_length, n_samples, 2] Primary predictions per frame (NLL)
+        gt_neigh, gt_neigh_mask : [num_scenes, max_neigh, pred_length, (2)] Ground-truth neighbours
+        pred_neigh, pred_neigh_mask : [num_scenes, max_neigh, pred_length, (2)] Mode-0 predicted neighbours
+        num_gt_neigh, num_pred_neigh : [num_scenes,] Number of neighbours
+
+    Raises
+    ------
+    IrregularScene
+        If a scene cannot be represented by the arrays.
+    """
+    scenes = [scene_to_arrays(ground_truth, scene_pred[0], scene_pred[1:], obs_length, pred_length,
+                              topk_modes, n_samples, collision)
+              for ground_truth, scene_pred in zip(scenes_gt, scenes_pred)]
+
+    arrays = dict(gt=np.stack([scene['gt'] for scene in scenes]).reshape(-1, pred_length, 2),
+                  pred=np.stack([scene['pred'] for scene in scenes]).reshape(len(scenes), -1, pred_length, 2))
+    if n_samples:
+        arrays['samples'] = np.stack([scene['samples'] for scene in scenes])
+    if collision:
+        for key in ['gt_neigh', 'pred_neigh']:
+            arrays[key], arrays[key + '_mask'] = pad_tracks([scene[key] for scene in scenes], pred_length)
+            arrays['num_' + key] = np.array([len(scene[key]) for scene in scenes], dtype=int)
+    return arrays
+
+
+def sequential_sum(values, axis=-1):
+    """Sum in the order of the values (as the accumulation of the row-based evaluator)"""
+    return np.add.accumulate(values, axis=axis).take(-1, axis=axis)
+
+
+def displacement_errors(gt, pred):
+    """ADE and FDE of every mode.
+    gt = Num_scenes x Num_timesteps x 2
+    pred = Num_scenes x Num_modes x Num_timesteps x 2
+    Returns ade, fde = Num_scenes x Num_modes
+    """
+    diff = pred - gt[:, None]
+    distance = np.sqrt(diff[..., 0] * diff[..., 0] + diff[..., 1] * diff[..., 1])
+    return sequential_sum(distance) / gt.shape[1], distance[..., -1]
+
+
+def topk_errors(ade, fde):
+    """Top-k ADE and FDE: the first mode with the strictly lowest ADE (below 1e10).
+    ade, fde = Num_scenes x Num_modes"""
+    masked = np.where(ade < 1e10, ade, np.inf)
+    best = np.argmin(masked, axis=1)
+    if np.isinf(masked[np.arange(len(best)), best]).any():
+        raise IrregularScene('no valid mode')
+    return ade[np.arange(len(best)), best], fde[np.arange(len(best)), best]
+
+
+def kde_logpdf(samples, points):
+    """Log-density of a 2D gaussian KDE (Scott's rule, as scipy.stats.gaussian_kde)
+    of the samples evaluated at the points.
+    samples = [..., Num_samples, 2], points = [..., 2]
+    Returns the log-densities [...] and the Cholesky factor (l11, l21, l22) of the data covariance
+    """
+    num_samples = samples.shape[-2]
+    centered = samples - samples.mean(axis=-2, keepdims=True)
+    c11 = (centered[..., 0] * centered[..., 0]).sum(-1) / (num_samples - 1)
+    c21 = (centered[..., 0] * centered[..., 1]).sum(-1) / (num_samples - 1)
+    c22 = (centered[..., 1] * centered[..., 1]).sum(-1) / (num_samples - 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        l11 = np.sqrt(c11)
+        l21 = c21 / l11
+        l22 = np.sqrt(c22 - l21 * l21)
+
+        factor = num_samples ** (-1. / 6)
+        diff = points[..., None, :] - samples
+        z1 = diff[..., 0] / (l11 * factor)[..., None]
+        z2 = (diff[..., 1] - (l21 * factor)[..., None] * z1) / (l22 * factor)[..., None]
+        exponent = -0.5 * (z1 * z1 + z2 * z2)
+        max_exponent = exponent.max(axis=-1)
+        log_pdf = max_exponent + np.log(np.exp(exponent - max_exponent[..., None]).sum(axis=-1)) \
+            - np.log(num_samples) - np.log(l11 * factor * l22 * factor * 2 * np.pi)
+    return log_pdf, (c11, c22 - l21 * l21, c22)
+
+
+def nll(samples, gt, log_pdf_lower_bound=-20, rtol=1e-8):
+    """NLL of the ground truth under the KDE of the predictions at every timestep.
+    Same skip rules as trajnetplusplustools.metrics.nll: timesteps with identical
+    predictions or where the KDE fails are skipped. Borderline timesteps
+    (near-singular covariance, log-density close to the upper bound of 100) are
+    recomputed with scipy.stats.gaussian_kde.
+    samples = Num_scenes x Num_timesteps x Num_samples x 2
+    gt = Num_scenes x Num_timesteps x 2
+    Returns Num_scenes
+    """
+    identical = np.all(samples[:, :, 1:] == samples[:, :, :-1], axis=(-2, -1))
+    log_pdf, (c11, schur, c22) = kde_logpdf(samples, gt)
+    with np.errstate(invalid='ignore'):
+        log_pdf = np.maximum(log_pdf, log_pdf_lower_bound)
+        valid = ~identical & np.isfinite(log_pdf) & (log_pdf <= 100) & (c11 > 0) & (schur > 0)
+        scale = np.maximum(np.abs(c11), np.abs(c22))
+        borderline = ~identical & np.isfinite(scale) & (
+            (np.abs(schur) <= rtol * scale) | (np.abs(c11) <= rtol * scale)
+            | (np.abs(log_pdf - 100) <= rtol * 100))
+
+    for i, t in zip(*np.nonzero(borderline)):
+        try:
+            scipy_kde = gaussian_kde(samples[i, t].T)
+            value = np.clip(scipy_kde.logpdf(gt[i, t].T), a_min=log_pdf_lower_bound, a_max=None)[0]
+            valid[i, t] = not (np.isnan(value) or np.isinf(value) or value > 100)
+            log_pdf[i, t] = value
+        except Exception: ## Difficulties in computing Gaussian_KDE
+            valid[i, t] = False
+
+    num_valid = valid.sum(axis=1)
+    if (num_valid == 0).any():
+        raise Exception('All Predictions are Identical')
+    return sequential_sum(np.where(valid, log_pdf, 0.0)) / num_valid
@@ -19,65 +19,126 @@ def fde(pred, gt):
     return np.linalg.norm(gt_last - pred_last)
 
 
+def interpolate_segments(start, end, parts=2):
+    """Points of np.linspace(start, end, parts + 1) for every segment.
+    start, end = [...] --> [..., parts + 1]
+    """
+    delta = end - start
+    step = delta / parts
+    fraction = np.arange(parts + 1)
+    with np.errstate(invalid='ignore'):
+        points = np.where((step == 0)[..., None], (fraction / parts) * delta[..., None], fraction * step[..., None])
+    points = points + start[..., None]
+    points[..., -1] = end
+    return points
+
+def segment_collisions(primary, neighbours, present=None, person_radius=0.1, inter_parts=2):
+    """Check Collision between the primary path and every neighbour path.
+    Only the timesteps present in the neighbour path are considered: consecutive
+    common timesteps form a segment, interpolated with inter_parts parts.
+    Paths containing NaN do not collide.
+    primary = [...] x Num_timesteps x 2
+    neighbours = [...] x Num_neigh x Num_timesteps x 2
+    present = [...] x Num_neigh x Num_timesteps (default: all timesteps)
+
+    Returns
+    -------
+    collide : [...] x Num_neigh
+        Collision with the neighbour
+    collide_steps : [...] x Num_neigh x Num_timesteps
+        Collision on the segment starting at the timestep
+    """
+    num_frames = neighbours.shape[-2]
+    if present is None:
+        present = np.ones(neighbours.shape[:-1], dtype=bool)
+    primary = np.broadcast_to(primary[..., None, :, :], neighbours.shape)
+
+    ## Index of the next common timestep (num_frames if none)
+    index = np.where(present, np.arange(num_frames), num_frames)
+    next_index = np.minimum.accumulate(index[..., ::-1], axis=-1)[..., ::-1]
+    next_index = np.concatenate([next_index[..., 1:], np.full_like(next_index[..., :1], num_frames)], axis=-1)
+    valid = present & (next_index < num_frames)
+    next_index = np.minimum(next_index, num_frames - 1)
+
+    distance_2 = 0.0
+    for coordinate in range(2):
+        p1 = primary[..., coordinate]
+        p2 = np.take_along_axis(p1, next_index, axis=-1)
+        p3 = neighbours[..., coordinate]
+        p4 = np.take_along_axis(p3, next_index, axis=-1)
+        diff = interpolate_segments(p1, p2, inter_parts) - interpolate_segments(p3, p4, inter_parts)
+        distance_2 = distance_2 + diff * diff
+
+    ## np.min propagates NaN (no collision)
+    with np.errstate(invalid='ignore'):
+        collide_steps = (np.min(np.sqrt(distance_2), axis=-1) <= 2 * person_radius) & valid
+    return collide_steps.any(axis=-1), collide_steps
+
 def collision(path1, path2, person_radius=0.1, inter_parts=2):
     """Check Collision between path1 and path2.
     path1 = Num_timesteps x 2
     path2 = Num_timesteps x 2
     """
-    def getinsidepoints(p1, p2, parts=2):
-        """return: equally distanced points between starting and ending "control" points"""
-
-        return np.array((np.linspace(p1[0], p2[0], parts + 1),
-                         np.linspace(p1[1], p2[1], parts + 1)))
-
-    for i in range(len(path1) - 1):
-        p1, p2 = [path1[i][0], path1[i][1]], [path1[i + 1][0], path1[i + 1][1]]
-        p3, p4 = [path2[i][0], path2[i][1]], [path2[i + 1][0], path2[i + 1][1]]
-        if np.min(np.linalg.norm(getinsidepoints(p1, p2, inter_parts) - getinsidepoints(p3, p4, inter_parts), axis=0)) \
-           <= 2 * person_radius:
-            return True
-    return False
+    collide, _ = segment_collisions(np.asarray(path1, dtype=float), np.asarray(path2, dtype=float)[None],
+                                    person_radius=person_radius, inter_parts=inter_parts)
+    return bool(collide[0])
 
 def pred_col(pred, gt):
     """Check Collision between primary prediction and neighbour predictions."""
-    primary_pred = pred[0]
-    for neigh in pred[1:]:
-        if collision(primary_pred, neigh):
-            return 1.0
-    return 0.0
+    collide, _ = segment_collisions(pred[0], pred[1:])
+    return float(collide.any())
 
 
 def gt_col(pred, gt):
     """Check Collision between primary prediction and groundtruth neighbours."""
-    primary_pred = pred[0]
-    for neigh in gt[1:]:
-        if collision(primary_pred, neigh):
-            return 1.0
-    return 0.0
+    collide, _ = segment_collisions(pred[0], gt[1:])
+    return float(collide.any())
+
+def topk_errors(preds, gt, seq_start_end=None):
+    """Top-k Average and Final displacement errors between the primary predictions
+    and groundtruth of every scene, minimised over the modes in one pass.
+    The first mode with the lowest error is selected (errors >= 1e10 or NaN are ignored).
+    preds = Num_modes x Num_ped x Num_timesteps x 2
+    gt = Num_ped x Num_timesteps x 2
+    seq_start_end (batch delimiter) = Num_batches x 2 (default: single scene)
+
+    Returns
+    -------
+    topk_ade, topk_fde : Num_batches
+        Top-k ADE and FDE of every scene
+    best_ade_mode, best_fde_mode : Num_batches
+        Mode index achieving the Top-k ADE and FDE
+    """
+    preds = np.asarray(preds)
+    starts = np.zeros(1, dtype=int) if seq_start_end is None else np.asarray(seq_start_end).reshape(-1, 2)[:, 0]
+
+    ## Num_modes x Num_batches
+    errors = np.linalg.norm(preds[:, starts] - gt[starts], axis=-1)
+    ade_m = np.mean(errors, axis=-1)
+    fde_m = errors[..., -1]
+
+    topk = []
+    for error in (ade_m, fde_m):
+        with np.errstate(invalid='ignore'):
+            error = np.where(error < 1e10, error, 1e10)
+        best_mode = np.argmin(error, axis=0)
+        topk.append((error[best_mode, np.arange(len(starts))], best_mode))
+    (topk_ade, best_ade_mode), (topk_fde, best_fde_mode) = topk
+    return topk_ade, topk_fde, best_ade_mode, best_fde_mode
 
 def topk_ade(preds, gt):
     """Top-k Average displacement error between primary predictions and groundtruth.
     pred = Num_modes x Num_ped x Num_timesteps x 2
     gt = Num_ped x Num_timesteps x 2
     """
-    topk_ade = 1e10
-    for pred in preds:
-        ade_m = ade(pred, gt)
-        if ade_m < topk_ade:
-            topk_ade = ade_m
-    return topk_ade
+    return topk_errors(preds, gt)[0][0]
 
 def topk_fde(preds, gt):
     """Top-k Final displacement error between primary predictions and groundtruth.
     pred = Num_modes x Num_ped x Num_timesteps x 2
     gt = Num_ped x Num_timesteps x 2
     """
-    topk_fde = 1e10
-    for pred in preds:
-        fde_m = fde(pred, gt)
-        if fde_m < topk_fde:
-            topk_fde = fde_m
-    return topk_fde
+    return topk_errors(preds, gt)[1][0]
 
 def trajnet_sample_eval(pred, gt):
     """Calculate ADE, FDE, Pred_Col, GT_Col for one sample.
@@ -91,17 +152,28 @@ def trajnet_batch_eval(pred, gt, seq_start_end):
     pred = Num_ped x Num_timesteps x 2
     gt = Num_ped x Num_timesteps x 2
     seq_start_end (batch delimiter) = Num_batches x 2
-    """ 
-    s_ade = 0
-    s_fde = 0
-    s_pred_col = 0
-    s_gt_col = 0
-
-    for (start, end) in seq_start_end:
-        s_ade += ade(pred[start:end], gt[start:end])
-        s_fde += fde(pred[start:end], gt[start:end])
-        s_pred_col += pred_col(pred[start:end], gt[start:end])
-        s_gt_col += gt_col(pred[start:end], gt[start:end])
+    """
+    seq_start_end = np.asarray(seq_start_end).reshape(-1, 2)
+    starts, lengths = seq_start_end[:, 0], seq_start_end[:, 1] - seq_start_end[:, 0]
+    num_scenes = len(seq_start_end)
+
+    ## Scene and index of every pedestrian of the batch
+    scene_index = np.repeat(np.arange(num_scenes), lengths)
+    ped_index = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths - starts, lengths)
+    is_neighbour = ped_index != starts[scene_index]
+
+    s_ade = np.mean(np.linalg.norm(pred[starts] - gt[starts], axis=-1), axis=-1).sum()
+    s_fde = np.linalg.norm(pred[starts, -1] - gt[starts, -1], axis=-1).sum()
+
+    ## Collisions of every pedestrian with the primary prediction of its scene
+    primary_pred = pred[starts][scene_index]
+    s_pred_col = 0.0
+    s_gt_col = 0.0
+    if len(ped_index):
+        pred_collide, _ = segment_collisions(primary_pred, pred[ped_index][:, None])
+        gt_collide, _ = segment_collisions(primary_pred, gt[ped_index][:, None])
+        s_pred_col = float(np.bincount(scene_index[pred_collide[:, 0] & is_neighbour], minlength=num_scenes).astype(bool).sum())
+        s_gt_col = float(np.bincount(scene_index[gt_collide[:, 0] & is_neighbour], minlength=num_scenes).astype(bool).sum())
 
     return s_ade, s_fde, s_pred_col, s_gt_col
 
@@ -110,20 +182,21 @@ def trajnet_sample_multi_eval(preds, gt):
     pred = Num_modes x Num_ped x Num_timesteps x 2
     gt = Num_ped x Num_timesteps x 2
     """
-    return topk_ade(preds, gt), topk_fde(preds, gt)
+    topk_ade, topk_fde, _, _ = topk_errors(preds, gt)
+    return topk_ade[0], topk_fde[0]
 
-def trajnet_batch_multi_eval(preds, gt, seq_start_end):
+def trajnet_batch_multi_eval(preds, gt, seq_start_end, return_scenes=False):
     """Calculate Top-k ADE, Top-k FDE for batch of samples.
     pred = Num_modes x Num_ped x Num_timesteps x 2
     gt = Num_ped x Num_timesteps x 2
     seq_start_end (batch delimiter) = Num_batches x 2
+    return_scenes : If True, additionally return the per-scene (topk_ade, topk_fde,
+        best_ade_mode, best_fde_mode) of topk_errors
     """
-    s_topk_ade = 0
-    s_topk_fde = 0
-
-    for (start, end) in seq_start_end:
-        s_preds = [pred[start:end] for pred in preds]
-        s_topk_ade += topk_ade(s_preds, gt[start:end])
-        s_topk_fde += topk_fde(s_preds, gt[start:end])
+    scenes = topk_errors(preds, gt, seq_start_end)
+    s_topk_ade = scenes[0].sum()
+    s_topk_fde = scenes[1].sum()
 
+    if return_scenes:
+        return s_topk_ade, s_topk_fde, scenes
     return s_topk_ade, s_topk_fde
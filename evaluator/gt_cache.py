@@ -0,0 +1,117 @@
+"""Persistent cache of parsed ground-truth files.
+
+The cache of a file is keyed by the sha1 of its content: a modified file
+gets a new key and is parsed again. Scenes are stored as the columns of the
+unique TrackRows and one array of row indices, which is much faster to
+load than the (overlapping) scenes themselves.
+"""
+import hashlib
+import os
+import pickle
+from collections import defaultdict
+
+import numpy as np
+from trajnetplusplustools import TrackRow
+
+CACHE_VERSION = 1
+
+
+def default_cache_dir(gt):
+    """Cache directory of the folder of the ground-truth file in the user cache
+    ($XDG_CACHE_HOME or ~/.cache): the dataset folder may be read-only"""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    folder = hashlib.sha1(os.path.abspath(os.path.dirname(gt)).encode()).hexdigest()[:16]
+    return os.path.join(cache_home, 'trajnetbaselines', 'gt_cache', folder)
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """sha1 of the content of the file"""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def cache_path(gt, cache_dir, digest):
+    return os.path.join(cache_dir, '{}.{}.v{}.pkl'.format(os.path.basename(gt), digest, CACHE_VERSION))
+
+
+def pack_scenes(scenes):
+    """Scenes (paths of TrackRow) --> (row columns, row index, path lengths, scene lengths)"""
+    row_index = {}
+    rows = []
+    index = []
+    for scene in scenes:
+        for path in scene:
+            for row in path:
+                if id(row) not in row_index:
+                    row_index[id(row)] = len(rows)
+                    rows.append(row)
+                index.append(row_index[id(row)])
+    columns = tuple(zip(*rows)) if rows else ((),) * len(TrackRow._fields)
+    path_lengths = np.array([len(path) for scene in scenes for path in scene], dtype=np.int32)
+    scene_lengths = np.array([len(scene) for scene in scenes], dtype=np.int32)
+    return columns, np.array(index, dtype=np.int32), path_lengths, scene_lengths
+
+
+def unpack_scenes(columns, index, path_lengths, scene_lengths):
+    """Inverse of pack_scenes. Rows shared by overlapping scenes are the same objects"""
+    rows = list(map(TrackRow, *columns))
+    flat = [rows[i] for i in index.tolist()]
+
+    ends = np.cumsum(path_lengths).tolist()
+    paths = [flat[start:end] for start, end in zip([0] + ends[:-1], ends)]
+    ends = np.cumsum(scene_lengths).tolist()
+    return [paths[start:end] for start, end in zip([0] + ends[:-1], ends)]
+
+
+def is_cached(gt, cache_dir):
+    """True if the current content of the file gt is cached"""
+    return os.path.isfile(cache_path(gt, cache_dir, file_hash(gt)))
+
+
+def load(gt, cache_dir):
+    """Cached (scenes_gt, scenes_id_gt, indexes, sub_indexes) of the file gt,
+    or None (with the content hash) if the file is not cached"""
+    digest = file_hash(gt)
+    try:
+        with open(cache_path(gt, cache_dir, digest), 'rb') as f:
+            cached = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None, digest
+
+    scenes_gt = unpack_scenes(*cached['scenes'])
+    indexes = defaultdict(list, cached['indexes'])
+    sub_indexes = defaultdict(list, cached['sub_indexes'])
+    return (scenes_gt, cached['scenes_id'], indexes, sub_indexes), digest
+
+
+def save(gt, cache_dir, digest, ground_truth):
+    """Store the parsed ground truth of gt and remove the caches of previous versions of the file.
+    Raises OSError if the cache cannot be written"""
+    scenes_gt, scenes_id_gt, indexes, sub_indexes = ground_truth
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_path(gt, cache_dir, digest)
+
+    ## Write to a temporary file first: several processes may store the same file
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(dict(scenes=pack_scenes(scenes_gt), scenes_id=scenes_id_gt,
+                             indexes=dict(indexes), sub_indexes=dict(sub_indexes)),
+                        f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError:
+        ## e.g. full disk: do not leave a partial file behind
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    prefix = os.path.basename(gt) + '.'
+    for f in os.listdir(cache_dir):
+        if f.startswith(prefix) and f.endswith('.pkl') and os.path.join(cache_dir, f) != path:
+            try:
+                os.remove(os.path.join(cache_dir, f))
+            except OSError:
+                pass
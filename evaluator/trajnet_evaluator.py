@@ -1,14 +1,60 @@
 import os
+import shutil
+import tempfile
 from collections import defaultdict, OrderedDict
 import argparse
 
 import pickle
 from joblib import Parallel, delayed
+import numpy as np
 import scipy
 
 import trajnetplusplustools
 from evaluator.design_table import Table
 from evaluator.evaluator_helpers import Categories, Sub_categories, Metrics
+from evaluator.array_metrics import IrregularScene, scenes_to_arrays, displacement_errors, \
+    topk_errors, nll, sequential_sum
+from evaluator.eval_utils import segment_collisions
+from evaluator import gt_cache
+
+
+def index_scene_types(indexes, sub_indexes):
+    """Hash index from scene id to (main type, [sub types]) for the types 1-4"""
+    scene_types = {}
+    for key in range(1, 5):
+        for scene_id in indexes[key]:
+            scene_types.setdefault(scene_id, (key, []))
+    for sub_key in range(1, 5):
+        for scene_id in sub_indexes[sub_key]:
+            scene_types.setdefault(scene_id, (None, []))[1].append(sub_key)
+    return scene_types
+
+
+def bucket_predictions(reader_pred, scenes_id_gt):
+    """Group the prediction rows by scene_id and pedestrian in a single pass over the file.
+
+    Returns
+    -------
+    scenes_pred : List of length num_scenes
+        For the i-th predicted scene, its tracks [primary, neighbours ...] restricted to
+        the rows predicted for the scene scenes_id_gt[i]. Empty neighbour tracks are dropped.
+    """
+    ## scene_id --> pedestrian --> rows (sorted by frame)
+    rows_by_scene = defaultdict(lambda: defaultdict(list))
+    for frame in sorted(reader_pred.tracks_by_frame):
+        for row in reader_pred.tracks_by_frame[frame]:
+            rows_by_scene[row.scene_id][row.pedestrian].append(row)
+
+    scenes_pred = []
+    for scene, scene_id in zip(reader_pred.scenes_by_id.values(), scenes_id_gt):
+        tracks_by_ped = rows_by_scene.get(scene_id, {})
+        primary_track = tracks_by_ped.get(scene.pedestrian, [])
+        neighbour_tracks = [track for ped, track in tracks_by_ped.items() if ped != scene.pedestrian]
+        tracks = [primary_track] + neighbour_tracks
+        ## Only rows within the frames of the predicted scene
+        tracks = [[row for row in track if scene.start <= row.frame <= scene.end] for track in tracks]
+        scenes_pred.append(tracks[:1] + [track for track in tracks[1:] if len(track)])
+    return scenes_pred
 
 
 class TrajnetEvaluator:
@@ -23,6 +69,7 @@ class TrajnetEvaluator:
         ## Dictionary of type of trajectories
         self.indexes = indexes
         self.sub_indexes = sub_indexes
+        self.scene_types = index_scene_types(indexes, sub_indexes)
 
         ## Overall metrics ADE, FDE, ColI, ColII, Topk_ade, Topk_fde, NLL
         self.metrics = Metrics(*([len(scenes_gt)] + [0.0]*7))
@@ -54,23 +101,11 @@ class TrajnetEvaluator:
             ground_truth = self.scenes_gt[i]
 
             ## Get Keys and Sub_keys
-            curr_type = None
-            sub_types = []
-
-            ## Main
-            for key in list(score.keys()):
-                if self.scenes_id_gt[i] in self.indexes[key]:
-                    curr_type = key
-                    break
-            # ## Sub
-            for sub_key in list(sub_score.keys()):
-                if self.scenes_id_gt[i] in self.sub_indexes[sub_key]:
-                    sub_types.append(sub_key)
-
-            ## Extract Prediction Frames
-            primary_tracks_all = [t for t in self.scenes_pred[i][0] if t.scene_id == self.scenes_id_gt[i]]
-            neighbours_tracks_all = [[t for t in self.scenes_pred[i][j] if t.scene_id == self.scenes_id_gt[i]] for j in range(1, len(self.scenes_pred[i]))]
-            neighbours_tracks_all = [track for track in neighbours_tracks_all if len(track)]   # Required for overlapping scenes
+            curr_type, sub_types = self.scene_types.get(self.scenes_id_gt[i], (None, []))
+
+            ## Extract Prediction Frames (rows of the scene, see bucket_predictions)
+            primary_tracks_all = self.scenes_pred[i][0]
+            neighbours_tracks_all = self.scenes_pred[i][1:]
 
             ##### --------------------------------------------------- SINGLE -------------------------------------------- ####
 
@@ -192,6 +227,82 @@ class TrajnetEvaluator:
         ground_truth = [track for track in ground_truth if track[0].frame < obs_end_frame]
         return ground_truth
 
+class ArrayTrajnetEvaluator(TrajnetEvaluator):
+    """TrajnetEvaluator computing the metrics of all scenes at once on padded arrays
+    (see evaluator.array_metrics). Files with scenes that cannot be represented
+    by the arrays are evaluated row by row."""
+
+    def aggregate(self):
+        scene_types = [self.scene_types.get(scene_id, (None, [])) for scene_id in self.scenes_id_gt]
+        try:
+            if any(curr_type is None for curr_type, _ in scene_types):
+                raise IrregularScene('scene without type')
+            arrays = scenes_to_arrays(self.scenes_gt, self.scenes_pred, self.obs_length, self.pred_length,
+                                      topk_modes=3 if self.num_predictions > 1 else 0,
+                                      n_samples=50 if self.num_predictions > 48 else 0,
+                                      collision=not self.disable_collision)
+            ade, fde = displacement_errors(arrays['gt'], arrays['pred'])
+            if self.num_predictions > 1:
+                topk_ade, topk_fde = topk_errors(ade[:, :3], fde[:, :3])
+        except IrregularScene:
+            return super().aggregate()
+
+        ## Per-scene values of every metric
+        values = dict(average_l2=ade[:, 0], final_l2=fde[:, 0])
+        if self.num_predictions > 1:
+            values['topk_ade'] = topk_ade
+            values['topk_fde'] = topk_fde
+        if self.num_predictions > 48:
+            values['nll'] = nll(arrays['samples'], arrays['gt'])
+
+        if not self.disable_collision:
+            primary = arrays['pred'][:, 0]
+            gt_col, _ = segment_collisions(primary, arrays['gt_neigh'], arrays['gt_neigh_mask'])
+            values['gt_col'] = gt_col.any(axis=1)
+
+            ## [Col-I] only if neighs in gt = neighs in prediction
+            ## Disabled from the first scene where the model does not predict all neighbours
+            mismatch = arrays['num_gt_neigh'] != arrays['num_pred_neigh']
+            pred_col, _ = segment_collisions(primary, arrays['pred_neigh'], arrays['pred_neigh_mask'])
+            pred_col = pred_col.any(axis=1)
+            if mismatch.any():
+                print("The model does not predict all neighbours in {} scenes".format(mismatch.sum()))
+                self.enable_col1 = False
+                pred_col[np.argmax(mismatch):] = False
+            values['pred_col'] = pred_col
+
+        ## Aggregate in scene order (same sums as the row-based evaluation)
+        score = {i:Metrics(*[0]*8) for i in range(1,5)}
+        sub_score = {i:Metrics(*[0]*8) for i in range(1,5)}
+        main_masks = {i: np.array([curr_type == i for curr_type, _ in scene_types]) for i in range(1,5)}
+        sub_masks = {i: np.array([i in sub_types for _, sub_types in scene_types]) for i in range(1,5)}
+        for metrics, mask in [(self.metrics, None)] + \
+                [(score[i], main_masks[i]) for i in range(1,5)] + [(sub_score[i], sub_masks[i]) for i in range(1,5)]:
+            if mask is not None:
+                metrics.N += int(mask.sum())
+            for name, value in values.items():
+                value = value if mask is None else value[mask]
+                if not len(value):
+                    continue
+                if value.dtype == bool:
+                    setattr(metrics, name, getattr(metrics, name) + int(value.sum()))
+                else:
+                    setattr(metrics, name, getattr(metrics, name) + float(sequential_sum(value)))
+            if not self.disable_collision and (mismatch if mask is None else mismatch[mask]).any():
+                metrics.pred_col = -1
+
+        # Main categories
+        self.categories.static_scenes = score[1]
+        self.categories.linear_scenes = score[2]
+        self.categories.forced_non_linear_scenes = score[3]
+        self.categories.non_linear_scenes = score[4]
+
+        ## Sub categories
+        self.sub_categories.lf = sub_score[1]
+        self.sub_categories.ca = sub_score[2]
+        self.sub_categories.grp = sub_score[3]
+        self.sub_categories.others = sub_score[4]
+
 def collision_test(list_sub, name, args):
     """ Simple Collision Test """
     submit_datasets = [args.path + name + '/' + f for f in list_sub if 'collision_test.ndjson' in f]
@@ -206,20 +317,31 @@ def collision_test(list_sub, name, args):
 
     return "NA"
 
-def eval(gt, input_file, args):
-    # Ground Truth
-    reader_gt = trajnetplusplustools.Reader(gt, scene_type='paths')
-    scenes_gt = [s for _, s in reader_gt.scenes()]
-    scenes_id_gt = [s_id for s_id, _ in reader_gt.scenes()]
+def load_ground_truth(gt, cache_dir=None):
+    """Parse the ground-truth file once.
+    If cache_dir is given, the parsed file is cached there (see evaluator.gt_cache)
+    and reused as long as the content of the file does not change.
+
+    Returns
+    -------
+    scenes_gt : List of ground-truth scenes (paths of TrackRow)
+    scenes_id_gt : List of scene ids
+    indexes, sub_indexes : Dictionaries deciding which scenes are in which type
+    """
+    if cache_dir is not None:
+        ground_truth, digest = gt_cache.load(gt, cache_dir)
+        if ground_truth is not None:
+            return ground_truth
 
-    # Scene Predictions
-    reader_pred = trajnetplusplustools.Reader(input_file, scene_type='paths')
-    scenes_pred = [s for _, s in reader_pred.scenes()]
+    reader_gt = trajnetplusplustools.Reader(gt, scene_type='paths')
+    scenes = list(reader_gt.scenes())
+    scenes_gt = [s for _, s in scenes]
+    scenes_id_gt = [s_id for s_id, _ in scenes]
 
     ## sub_indexes, indexes is dictionary deciding which scenes are in which type
     indexes = defaultdict(list)
     sub_indexes = defaultdict(list)
-    
+
     for scene in reader_gt.scenes_by_id:
         tags = reader_gt.scenes_by_id[scene].tag
         main_type, sub_types = tags[0], tags[1]
@@ -227,18 +349,50 @@ def eval(gt, input_file, args):
         for sub_type in sub_types:
             sub_indexes[sub_type].append(scene)
 
+    if cache_dir is not None:
+        ## The cache is an optimization only: never fail the evaluation on it
+        try:
+            gt_cache.save(gt, cache_dir, digest, (scenes_gt, scenes_id_gt, indexes, sub_indexes))
+        except OSError as error:
+            print('Could not cache the ground truth of {}: {}'.format(gt, error))
+    return scenes_gt, scenes_id_gt, indexes, sub_indexes
+
+def cache_ground_truth(gt, cache_dir):
+    """Parse the ground-truth file into the cache (if not cached yet)"""
+    if not gt_cache.is_cached(gt, cache_dir):
+        load_ground_truth(gt, cache_dir)
+
+def eval(gt, input_file, args, ground_truth=None, cache_dir=None):
+    """Evaluate the predictions of input_file against the ground truth gt.
+    ground_truth (optional): output of load_ground_truth(gt), shared across models
+    cache_dir (optional): ground-truth cache used if ground_truth is not given"""
+    # Ground Truth
+    if ground_truth is None:
+        ground_truth = load_ground_truth(gt, cache_dir)
+    scenes_gt, scenes_id_gt, indexes, sub_indexes = ground_truth
+
+    # Scene Predictions: rows bucketed by scene id
+    reader_pred = trajnetplusplustools.Reader(input_file, scene_type='paths')
+    scenes_pred = bucket_predictions(reader_pred, scenes_id_gt)
+
     # Evaluate
-    evaluator = TrajnetEvaluator(scenes_gt, scenes_id_gt, scenes_pred, indexes, sub_indexes, args)
+    if args.eval_backend == 'array':
+        evaluator = ArrayTrajnetEvaluator(scenes_gt, scenes_id_gt, scenes_pred, indexes, sub_indexes, args)
+    else:
+        evaluator = TrajnetEvaluator(scenes_gt, scenes_id_gt, scenes_pred, indexes, sub_indexes, args)
     evaluator.aggregate()
     result = evaluator.result()
     return result
 
 def trajnet_evaluate(args):
-    """Evaluates test_pred against test_private"""
+    """Evaluates test_pred against test_private.
+    The (model, dataset) pairs are evaluated in args.n_jobs processes"""
     model_names = [model.split('/')[-1].replace('.pkl', '') + '_modes' + str(args.modes) for model in args.output]
     labels = args.labels if args.labels is not None else model_names
     table = Table()
 
+    ## (model, dataset) pairs to evaluate
+    pairs = []
     for num, model_name in enumerate(model_names):
         print(model_name)
         model_preds = sorted([f for f in os.listdir(args.path + model_name) if not f.startswith('.')])
@@ -247,15 +401,42 @@ def trajnet_evaluate(args):
         col_result = collision_test(model_preds, model_name, args)
         table.add_collision_entry(labels[num], col_result)
 
-        pred_datasets = [args.path + model_name + '/' + f for f in model_preds if 'collision_test.ndjson' not in f]
-        true_datasets = [args.path.replace('pred', 'private') + f for f in model_preds if 'collision_test.ndjson' not in f]
+        pairs += [(num, f) for f in model_preds if 'collision_test.ndjson' not in f]
+
+    # Parse each True Dataset once, shared by all models (cached across runs unless --no_gt_cache)
+    true_datasets = sorted(set(f for _, f in pairs))
+    true_file = {f: args.path.replace('pred', 'private') + f for f in true_datasets}
+    tmp_cache_dir = None
+    if args.no_gt_cache and args.n_jobs > 1:
+        ## The workers still need a cache to share the parsed ground truth: removed at the end
+        tmp_cache_dir = tempfile.mkdtemp(prefix='gt_cache_')
+        cache_dirs = {f: tmp_cache_dir for f in true_datasets}
+    else:
+        cache_dirs = {f: None if args.no_gt_cache else gt_cache.default_cache_dir(true_file[f]) for f in true_datasets}
+
+    try:
+        if args.n_jobs == 1:
+            ground_truths = {f: load_ground_truth(true_file[f], cache_dirs[f]) for f in true_datasets}
+        else:
+            ## The parsed ground truth is large: rather than pickling it into every task,
+            ## the workers load it from the cache (parsed once here, in parallel)
+            Parallel(n_jobs=args.n_jobs)(delayed(cache_ground_truth)(true_file[f], cache_dirs[f])
+                                         for f in true_datasets)
+            ground_truths = {f: None for f in true_datasets}
 
         # Evaluate predicted datasets with True Datasets
-        results = {pred_datasets[i].replace(args.path, '').replace('.ndjson', ''):
-                   eval(true_datasets[i], pred_datasets[i], args) for i in range(len(true_datasets))}
-
-        # Add results to Table
-        final_result, sub_final_result = table.add_entry(labels[num], results)
+        results = Parallel(n_jobs=args.n_jobs)(delayed(eval)(true_file[f], args.path + model_names[num] + '/' + f,
+                                                             args, ground_truths[f], cache_dirs[f])
+                                               for num, f in pairs)
+    finally:
+        if tmp_cache_dir is not None:
+            shutil.rmtree(tmp_cache_dir, ignore_errors=True)
+
+    # Add results to Table (in the order of the models and datasets)
+    for num, model_name in enumerate(model_names):
+        model_results = {model_name + '/' + f.replace('.ndjson', ''): result
+                         for (pair_num, f), result in zip(pairs, results) if pair_num == num}
+        final_result, sub_final_result = table.add_entry(labels[num], model_results)
 
     # Output Result Table
     table.print_table()
@@ -1,3 +1,4 @@
+import json
 import pickle
 
 import numpy as np
@@ -39,43 +40,61 @@ def preprocess_test(scene, obs_len):
     return scene
 
 
-def write_predictions(pred_list, scenes, model_name, dataset_name, args):
+def format_scene_predictions(predictions, scene_id, paths, obs_length, pred_length):
+    """Format the scene row and all predicted tracks of one scene as ndjson lines.
+    The output is byte-for-byte identical to writing writers.trajnet(TrackRow(...))
+    line by line, but all coordinates of the scene are rounded and json-encoded
+    in a single call."""
+    seq_length = obs_length + pred_length
+    ## Extract 1) first_frame, 2) frame_diff 3) ped_ids for writing predictions
+    observed_path = paths[0]
+    frame_diff = observed_path[1].frame - observed_path[0].frame
+    first_frame = observed_path[obs_length-1].frame + frame_diff
+    ped_id = observed_path[0].pedestrian
+    ped_id_ = [path[0].pedestrian for path in paths[1:]] ## Only need neighbour ids
+
+    ## SceneRow
+    scenerow = trajnetplusplustools.SceneRow(scene_id, ped_id, observed_path[0].frame,
+                                             observed_path[0].frame + (seq_length - 1) * frame_diff, 2.5, 0)
+    scene_line = trajnetplusplustools.writers.trajnet(scenerow) + '\n'
+
+    ## Row fragments of every pedestrian and mode
+    scene_tail = ', "scene_id": ' + json.dumps(scene_id) + '}}\n'
+    heads = [', "p": ' + json.dumps(p) + ', "x": ' for p in [ped_id] + ped_id_]
+    tails = [', "prediction_number": ' + json.dumps(m) + scene_tail for m in range(len(predictions))]
+
+    ## Collect (head, tail, track) in writing order
+    tracks = []
+    for m in range(len(predictions)):
+        prediction, neigh_predictions = predictions[m]
+        tracks.append((heads[0], tails[m], np.asarray(prediction)[:, :2]))
+        ## Neighbours (if non-empty)
+        if len(neigh_predictions):
+            for n in range(neigh_predictions.shape[1]):
+                tracks.append((heads[n+1], tails[m], np.asarray(neigh_predictions[:, n])[:, :2]))
+    tracks = [track for track in tracks if len(track[2])]
+    if not tracks:
+        return scene_line
+
+    ## Round & json-encode all coordinates at once (json handles NaN / Infinity)
+    coordinates = np.concatenate([track for _, _, track in tracks]).ravel().tolist()
+    coordinates = json.dumps([round(value, 2) for value in coordinates])[1:-1].split(', ')
+
+    frames = ['{"track": {"f": ' + json.dumps(first_frame + i * frame_diff)
+              for i in range(max(len(track) for _, _, track in tracks))]
+    lines = [scene_line]
+    index = 0
+    for head, tail, track in tracks:
+        for i in range(len(track)):
+            lines.append(frames[i] + head + coordinates[index] + ', "y": ' + coordinates[index + 1] + tail)
+            index += 2
+
+    return ''.join(lines)
+
+
+def write_predictions(pred_list, scenes, model_name, dataset_name, args, buffer_size=1 << 20):
     """Write predictions corresponding to the scenes in the respective file"""
-    seq_length = args.obs_length + args.pred_length
-    with open(args.path + '{}/{}'.format(model_name, dataset_name), "a") as myfile:
+    with open(args.path + '{}/{}'.format(model_name, dataset_name), "a", buffering=buffer_size) as myfile:
         ## Write All Predictions
         for (predictions, (_, scene_id, paths)) in zip(pred_list, scenes):
-            ## Extract 1) first_frame, 2) frame_diff 3) ped_ids for writing predictions
-            observed_path = paths[0]
-            frame_diff = observed_path[1].frame - observed_path[0].frame
-            first_frame = observed_path[args.obs_length-1].frame + frame_diff
-            ped_id = observed_path[0].pedestrian
-            ped_id_ = []
-            for j, _ in enumerate(paths[1:]): ## Only need neighbour ids
-                ped_id_.append(paths[j+1][0].pedestrian)
-
-            ## Write SceneRow
-            scenerow = trajnetplusplustools.SceneRow(scene_id, ped_id, observed_path[0].frame, 
-                                                        observed_path[0].frame + (seq_length - 1) * frame_diff, 2.5, 0)
-            # scenerow = trajnetplusplustools.SceneRow(scenerow.scene, scenerow.pedestrian, scenerow.start, scenerow.end, 2.5, 0)
-            myfile.write(trajnetplusplustools.writers.trajnet(scenerow))
-            myfile.write('\n')
-
-            for m in range(len(predictions)):
-                prediction, neigh_predictions = predictions[m]
-                ## Write Primary
-                for i in range(len(prediction)):
-                    track = trajnetplusplustools.TrackRow(first_frame + i * frame_diff, ped_id,
-                                                            prediction[i, 0].item(), prediction[i, 1].item(), m, scene_id)
-                    myfile.write(trajnetplusplustools.writers.trajnet(track))
-                    myfile.write('\n')
-
-                ## Write Neighbours (if non-empty)
-                if len(neigh_predictions):
-                    for n in range(neigh_predictions.shape[1]):
-                        neigh = neigh_predictions[:, n]
-                        for j in range(len(neigh)):
-                            track = trajnetplusplustools.TrackRow(first_frame + j * frame_diff, ped_id_[n],
-                                                                    neigh[j, 0].item(), neigh[j, 1].item(), m, scene_id)
-                            myfile.write(trajnetplusplustools.writers.trajnet(track))
-                            myfile.write('\n')
+            myfile.write(format_scene_predictions(predictions, scene_id, paths, args.obs_length, args.pred_length))
@@ -0,0 +1,46 @@
+import numpy as np
+import trajnetplusplustools
+from trajnetplusplustools import TrackRow
+
+from evaluator.array_metrics import displacement_errors, topk_errors, nll
+
+
+def rows(xy, frames, prediction_number=None):
+    return [TrackRow(f, 0, x, y, prediction_number) for f, (x, y) in zip(frames, xy)]
+
+
+def test_displacement_errors():
+    rng = np.random.RandomState(0)
+    gt = rng.randn(4, 12, 2)
+    pred = rng.randn(4, 3, 12, 2)
+    ade, fde = displacement_errors(gt, pred)
+    frames = list(range(12))
+    for i in range(4):
+        for m in range(3):
+            expected_ade = trajnetplusplustools.metrics.average_l2(rows(gt[i], frames), rows(pred[i, m], frames))
+            expected_fde = trajnetplusplustools.metrics.final_l2(rows(gt[i], frames), rows(pred[i, m], frames))
+            assert np.isclose(ade[i, m], expected_ade, rtol=1e-12)
+            assert np.isclose(fde[i, m], expected_fde, rtol=1e-12)
+
+
+def test_topk_errors():
+    ade = np.array([[3.0, 1.0, 1.0], [np.nan, 2.0, 1e10]])
+    fde = np.array([[0.3, 0.1, 0.2], [0.4, 0.5, 0.6]])
+    topk_ade, topk_fde = topk_errors(ade, fde)
+    assert np.all(topk_ade == [1.0, 2.0])
+    assert np.all(topk_fde == [0.1, 0.5])
+
+
+def test_nll():
+    rng = np.random.RandomState(2)
+    samples = rng.randn(3, 12, 50, 2)
+    samples[1, :4] = 1.0  ## identical predictions are skipped
+    samples[2, :, :, 1] = samples[2, :, :, 0]  ## singular covariance is skipped
+    samples[2, 0] = rng.randn(50, 2)
+    gt = rng.randn(3, 12, 2)
+    values = nll(samples, gt)
+    frames = list(range(12))
+    for i in range(3):
+        primary_tracks = [TrackRow(f, 0, x, y, m) for m in range(50) for f, (x, y) in zip(frames, samples[i, :, m])]
+        expected = trajnetplusplustools.metrics.nll(primary_tracks, rows(gt[i], frames), n_samples=50)
+        assert np.isclose(values[i], expected, rtol=1e-9)
@@ -0,0 +1,64 @@
+import numpy as np
+import trajnetplusplustools
+from trajnetplusplustools import TrackRow
+
+from evaluator.eval_utils import segment_collisions, trajnet_batch_eval, trajnet_batch_multi_eval, topk_errors, \
+    ade, fde, pred_col, gt_col
+
+
+def rows(xy, frames):
+    return [TrackRow(f, 0, x, y) for f, (x, y) in zip(frames, xy)]
+
+
+def test_segment_collisions():
+    rng = np.random.RandomState(1)
+    primary = rng.rand(20, 12, 2)
+    neighbours = rng.rand(20, 3, 12, 2)
+    present = rng.rand(20, 3, 12) > 0.3
+    neighbours[:, 2] = primary + 0.15  ## collides only if two consecutive frames are present
+    neighbours[0, 1, 5] = np.nan
+    collide, collide_steps = segment_collisions(primary, neighbours, present)
+    assert collide_steps.shape == (20, 3, 12)
+    assert np.all(collide == collide_steps.any(axis=-1))
+    frames = list(range(12))
+    for i in range(20):
+        for j in range(3):
+            neighbour = [row for row, p in zip(rows(neighbours[i, j], frames), present[i, j]) if p]
+            assert collide[i, j] == trajnetplusplustools.metrics.collision(rows(primary[i], frames), neighbour)
+
+
+def test_trajnet_batch_eval():
+    rng = np.random.RandomState(2)
+    pred = rng.rand(10, 12, 2) * 2
+    gt = rng.rand(10, 12, 2) * 2
+    gt[5, 3:] = np.nan
+    seq_start_end = [(0, 3), (3, 4), (4, 10)]
+    s_ade, s_fde, s_pred_col, s_gt_col = trajnet_batch_eval(pred, gt, seq_start_end)
+
+    expected = np.sum([[ade(pred[start:end], gt[start:end]), fde(pred[start:end], gt[start:end]),
+                        pred_col(pred[start:end], gt[start:end]), gt_col(pred[start:end], gt[start:end])]
+                       for start, end in seq_start_end], axis=0)
+    assert np.allclose([s_ade, s_fde, s_pred_col, s_gt_col], expected, rtol=1e-12)
+
+
+def test_topk_errors():
+    rng = np.random.RandomState(3)
+    preds = rng.rand(5, 10, 12, 2)
+    gt = rng.rand(10, 12, 2)
+    preds[2, 0] = gt[0]  ## exact mode
+    preds[:, 3] = np.nan  ## no valid mode
+    seq_start_end = [(0, 3), (3, 4), (4, 10)]
+    topk_ade, topk_fde, best_ade_mode, best_fde_mode = topk_errors(preds, gt, seq_start_end)
+    assert topk_ade[0] == 0.0 and topk_fde[0] == 0.0
+    assert best_ade_mode[0] == 2 and best_fde_mode[0] == 2
+    assert topk_ade[1] == 1e10 and topk_fde[1] == 1e10
+
+    ade_m = [ade(pred[4:10], gt[4:10]) for pred in preds]
+    fde_m = [fde(pred[4:10], gt[4:10]) for pred in preds]
+    assert best_ade_mode[2] == np.argmin(ade_m) and best_fde_mode[2] == np.argmin(fde_m)
+    assert np.isclose(topk_ade[2], min(ade_m), rtol=1e-12)
+    assert np.isclose(topk_fde[2], min(fde_m), rtol=1e-12)
+
+    s_topk_ade, s_topk_fde, scenes = trajnet_batch_multi_eval(preds, gt, seq_start_end, return_scenes=True)
+    assert s_topk_ade == topk_ade.sum() and s_topk_fde == topk_fde.sum()
+    assert np.all(scenes[2] == best_ade_mode)
@@ -0,0 +1,38 @@
+import torch
+
+from trajnetbaselines.lstm.gridbased_pooling import GridBasedPooling
+
+
+def occupancy_grid(pool, positions):
+    obs = torch.Tensor([positions])
+    return pool.occupancies(obs, obs).view(len(positions), pool.n, pool.n)
+
+
+def test_occupancy_reduce():
+    ## Neighbours 1 & 2 in the same cell (0, 0), neighbour 3 out of the grid
+    positions = [[0.0, 0.0], [-3.5, -3.5], [-3.0, -3.9], [100.0, 100.0]]
+    last = occupancy_grid(GridBasedPooling(n=4, type_='occupancy', embedding_arch='None'), positions)
+    total = occupancy_grid(GridBasedPooling(n=4, type_='occupancy', embedding_arch='None', reduce='sum'), positions)
+    assert last[0, 0, 0] == 1.0
+    assert total[0, 0, 0] == 2.0
+    assert last[0].sum() == 1.0 and total[0].sum() == 2.0
+    ## Out of grid neighbours are ignored
+    assert last[3].sum() == 0.0 and total[3].sum() == 0.0
+
+
+def test_occupancy_constant():
+    positions = [[0.0, 0.0], [1.0, 1.0], [float('nan'), float('nan')]]
+    for reduce in ['last', 'sum']:
+        pool = GridBasedPooling(n=4, type_='occupancy', embedding_arch='None', constant=-1, reduce=reduce)
+        grid = occupancy_grid(pool, positions)
+        assert grid[0, 2, 2] == 1.0
+        assert (grid[0] == -1).sum() == 15
+
+
+def test_directional_last_write():
+    ## The last neighbour of a cell gives the relative velocity
+    pool = GridBasedPooling(n=4, type_='directional', embedding_arch='None')
+    obs1 = torch.Tensor([[[0.0, 0.0], [1.0, 1.0], [1.1, 1.1]]])
+    obs2 = torch.Tensor([[[0.0, 0.0], [1.0, 1.5], [1.2, 1.1]]])
+    grid = pool.directional(obs1, obs2).view(3, 2, 4, 4)
+    assert torch.allclose(grid[0, :, 2, 2], torch.Tensor([0.1, 0.0]))
@@ -0,0 +1,60 @@
+import os
+
+import trajnetplusplustools
+
+from evaluator import gt_cache
+from evaluator.trajnet_evaluator import load_ground_truth
+
+
+def write_scenes(path, rows):
+    path.write_text(''.join(trajnetplusplustools.writers.trajnet(row) + '\n' for row in rows))
+
+
+def test_load_ground_truth_cache(tmp_path):
+    rows = [trajnetplusplustools.SceneRow(0, 1, 0, 2, 2.5, [1, []]),
+            trajnetplusplustools.SceneRow(1, 2, 1, 3, 2.5, [3, [2, 4]]),
+            trajnetplusplustools.TrackRow(0, 1, 0.0, 0.0),
+            trajnetplusplustools.TrackRow(1, 1, 1.0, 0.5),
+            trajnetplusplustools.TrackRow(1, 2, 2.0, 2.0),
+            trajnetplusplustools.TrackRow(2, 1, 2.0, 1.0),
+            trajnetplusplustools.TrackRow(2, 2, 3.0, 3.0),
+            trajnetplusplustools.TrackRow(3, 2, 4, 4)]
+    gt = tmp_path / 'gt.ndjson'
+    write_scenes(gt, rows)
+    cache_dir = str(tmp_path / 'cache')
+
+    expected = load_ground_truth(str(gt))
+    assert load_ground_truth(str(gt), cache_dir) == expected
+    assert len(os.listdir(cache_dir)) == 1
+    ## Loaded from the cache
+    cached = load_ground_truth(str(gt), cache_dir)
+    assert cached == expected
+    assert cached[0][0][0][1] is cached[0][1][1][0]  ## rows shared by overlapping scenes
+
+    ## Modified file invalidates the cache
+    write_scenes(gt, rows[:1] + rows[2:5])
+    assert load_ground_truth(str(gt), cache_dir) == load_ground_truth(str(gt))
+    assert len(os.listdir(cache_dir)) == 1
+
+
+def test_pack_scenes_roundtrip():
+    row = trajnetplusplustools.TrackRow(1, 1, 1.0, 0.5)
+    scenes = [[[trajnetplusplustools.TrackRow(0, 1, 0.0, 0.0), row]],
+              [[row], [trajnetplusplustools.TrackRow(1, 2, 2.0, 2.0)]],
+              []]
+    columns, index, path_lengths, scene_lengths = gt_cache.pack_scenes(scenes)
+    assert len(columns[0]) == 3  ## shared row stored once
+    unpacked = gt_cache.unpack_scenes(columns, index, path_lengths, scene_lengths)
+    assert unpacked == scenes
+    assert unpacked[0][0][1] is unpacked[1][0][0]
+
+
+def test_unwritable_cache(tmp_path):
+    gt = tmp_path / 'gt.ndjson'
+    write_scenes(gt, [trajnetplusplustools.SceneRow(0, 1, 0, 1, 2.5, [1, []]),
+                      trajnetplusplustools.TrackRow(0, 1, 0.0, 0.0),
+                      trajnetplusplustools.TrackRow(1, 1, 1.0, 0.5)])
+    ## Cache directory cannot be created (a file is in the way)
+    (tmp_path / 'file').write_text('')
+    cache_dir = str(tmp_path / 'file' / 'cache')
+    assert load_ground_truth(str(gt), cache_dir) == load_ground_truth(str(gt))
@@ -0,0 +1,34 @@
+import torch
+
+from trajnetbaselines.lstm.loss import PredictionLoss, GaussianMixtureNLL
+
+
+def random_gaussians(num_samples):
+    torch.manual_seed(0)
+    inputs = torch.cat([torch.randn(num_samples, 2), 0.1 + torch.rand(num_samples, 2),
+                        1.6 * torch.rand(num_samples, 1) - 0.8], dim=1)
+    targets = torch.randn(num_samples, 2, dtype=torch.double)
+    return inputs.double().requires_grad_(), targets
+
+
+def test_mixture_nll_matches_gaussians():
+    inputs, targets = random_gaussians(50)
+    gaussian_2d = PredictionLoss.gaussian_2d
+
+    inputs_bg = inputs.clone()
+    inputs_bg[:, 2:4] = 3.0
+    inputs_bg[:, 4] = 0.0
+    expected = -torch.log(0.01 + 0.2 * gaussian_2d(inputs_bg, targets) + 0.79 * gaussian_2d(inputs, targets))
+    values = GaussianMixtureNLL.apply(inputs, targets, 0.2)
+    assert torch.allclose(values, expected)
+    assert torch.allclose(torch.autograd.grad(values.sum(), inputs)[0],
+                          torch.autograd.grad(expected.sum(), inputs)[0])
+
+
+def test_mixture_nll_gradcheck():
+    inputs, targets = random_gaussians(10)
+    targets.requires_grad_()
+    ## 0.99: no foreground Gaussian (-inf log-weight)
+    for background_rate in [0.0, 0.2, 0.99]:
+        assert torch.autograd.gradcheck(lambda i, t: GaussianMixtureNLL.apply(i, t, background_rate),
+                                        (inputs, targets))
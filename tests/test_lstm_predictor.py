@@ -0,0 +1,61 @@
+import argparse
+
+import numpy as np
+import torch
+import trajnetplusplustools
+
+from trajnetbaselines.lstm.lstm import LSTM, LSTMPredictor
+from trajnetbaselines.lstm.gridbased_pooling import GridBasedPooling
+from trajnetbaselines.lstm.non_gridbased_pooling import NearestNeighborMLP, HiddenStateMLPPooling, \
+    AttentionMLPPooling, NearestNeighborLSTM, TrajectronPooling
+from trajnetbaselines.lstm.more_non_gridbased_pooling import NMMP
+from trajnetbaselines.lstm.sparse_pooling import SparseNearestNeighborMLP, SparseHiddenStateMLPPooling, \
+    SparseAttentionMLPPooling, SparseGridBasedPooling
+
+
+def all_pools():
+    pools = [None,
+             NearestNeighborMLP(n=2, out_dim=16),
+             HiddenStateMLPPooling(hidden_dim=32, out_dim=16),
+             AttentionMLPPooling(hidden_dim=32, out_dim=16),
+             NearestNeighborLSTM(n=2, hidden_dim=32, out_dim=16),
+             TrajectronPooling(hidden_dim=32, out_dim=16),
+             NMMP(hidden_dim=32, out_dim=16, k=2),
+             SparseNearestNeighborMLP(n=2, out_dim=16),
+             SparseHiddenStateMLPPooling(hidden_dim=32, out_dim=16),
+             SparseAttentionMLPPooling(hidden_dim=32, out_dim=16)]
+    for type_ in ['occupancy', 'directional', 'social']:
+        for embedding_arch in ['one_layer', 'lstm_layer']:
+            for pool_class in [GridBasedPooling, SparseGridBasedPooling]:
+                pools.append(pool_class(type_=type_, n=4, cell_side=1.0, hidden_dim=32, out_dim=16,
+                                        embedding_arch=embedding_arch))
+    return pools
+
+
+def random_scenes(obs_length=9):
+    """Scenes of different sizes, with neighbours appearing and disappearing"""
+    rng = np.random.RandomState(0)
+    scenes = []
+    for num_tracks in [1, 4, 2, 6]:
+        paths = []
+        for ped in range(num_tracks):
+            start, end = (0, obs_length) if ped == 0 else sorted(rng.choice(obs_length + 1, 2, replace=False))
+            xy = rng.randn(2) * 2 + np.cumsum(rng.randn(end - start, 2) * 0.3, axis=0)
+            paths.append([trajnetplusplustools.TrackRow(frame, ped, x, y)
+                          for frame, (x, y) in zip(range(start, end), xy)])
+        scenes.append(paths)
+    goals = [np.zeros((len(paths), 2)) for paths in scenes]
+    return scenes, goals
+
+
+def test_predict_batch_matches_single_scenes():
+    scenes, goals = random_scenes()
+    args = argparse.Namespace(normalize_scene=False)
+    for pool in all_pools():
+        torch.manual_seed(0)
+        predictor = LSTMPredictor(LSTM(pool=pool, embedding_dim=16, hidden_dim=32))
+        batched = predictor.predict_batch(scenes, goals, n_predict=4, batch_size=len(scenes), args=args)
+        for paths, scene_goal, prediction in zip(scenes, goals, batched):
+            single = predictor(paths, scene_goal, n_predict=4, args=args)
+            np.testing.assert_allclose(prediction[0][0], single[0][0], atol=1e-5, err_msg=str(pool))
+            np.testing.assert_allclose(prediction[0][1], single[0][1], atol=1e-5, err_msg=str(pool))
@@ -0,0 +1,62 @@
+import torch
+
+from trajnetbaselines.lstm.lstm import LSTM, NAN
+
+
+def list_step(model, lstm, hidden_cell_state, obs1, obs2, goals):
+    """Reference step: one hidden-cell-state Tensor per track, updated in a loop"""
+    track_mask = (torch.isnan(obs1[:, 0]) + torch.isnan(obs2[:, 0])) == 0
+    hidden_cell_stacked = [
+        torch.stack([h for m, h in zip(track_mask, hidden_cell_state[0]) if m], dim=0),
+        torch.stack([c for m, c in zip(track_mask, hidden_cell_state[1]) if m], dim=0),
+    ]
+    input_emb = model.input_embedding((obs2 - obs1)[track_mask])
+    norm_factors = torch.norm(obs2 - goals, dim=1)
+    goal_direction = (obs2 - goals) / norm_factors.unsqueeze(1)
+    goal_direction[norm_factors == 0] = torch.tensor([0., 0.])
+    input_emb = torch.cat([input_emb, model.goal_embedding(goal_direction[track_mask])], dim=1)
+
+    hidden_cell_stacked = lstm(input_emb, hidden_cell_stacked)
+    normal_masked = model.hidden2normal(hidden_cell_stacked[0])
+    normal = torch.full((track_mask.size(0), 5), NAN)
+    mask_index = [i for i, m in enumerate(track_mask) if m]
+    for i, h, c, n in zip(mask_index, hidden_cell_stacked[0], hidden_cell_stacked[1], normal_masked):
+        hidden_cell_state[0][i] = h
+        hidden_cell_state[1][i] = c
+        normal[i] = n
+    return hidden_cell_state, normal
+
+
+def test_step_matches_list_step():
+    torch.manual_seed(0)
+    model = LSTM(embedding_dim=8, hidden_dim=16, goal_flag=True)
+    observed = torch.cumsum(torch.randn(8, 5, 2) * 0.3, dim=0)
+    ## Partial tracks: appearing late, disappearing early, absent in the middle
+    observed[:3, 1] = NAN
+    observed[5:, 2] = NAN
+    observed[3:5, 3] = NAN
+    goals = torch.randn(5, 2)
+    batch_split = torch.LongTensor([0, 5])
+    weights = torch.randn(5, 5)
+
+    def run(step, hidden_cell_state):
+        loss = 0
+        for t, (obs1, obs2) in enumerate(zip(observed[:-1], observed[1:])):
+            lstm = model.encoder if t < 4 else model.decoder
+            hidden_cell_state, normal = step(lstm, hidden_cell_state, obs1, obs2)
+            loss = loss + torch.sum(torch.nan_to_num(normal * weights))
+        grads = torch.autograd.grad(loss, list(model.parameters()))
+        return loss, hidden_cell_state, grads
+
+    loss, hidden_cell_state, grads = run(
+        lambda lstm, state, obs1, obs2: model.step(lstm, state, obs1, obs2, goals, batch_split),
+        (torch.zeros(5, 16), torch.zeros(5, 16)))
+    expected_loss, expected_state, expected_grads = run(
+        lambda lstm, state, obs1, obs2: list_step(model, lstm, state, obs1, obs2, goals),
+        ([torch.zeros(16) for _ in range(5)], [torch.zeros(16) for _ in range(5)]))
+
+    assert torch.allclose(loss, expected_loss)
+    assert torch.allclose(hidden_cell_state[0], torch.stack(expected_state[0]))
+    assert torch.allclose(hidden_cell_state[1], torch.stack(expected_state[1]))
+    for grad, expected_grad in zip(grads, expected_grads):
+        assert torch.allclose(grad, expected_grad, atol=1e-6)
@@ -0,0 +1,21 @@
+import torch
+
+from trajnetbaselines.lstm.more_non_gridbased_pooling import NMMP
+
+
+def test_nmmp_scenes_independent():
+    torch.manual_seed(0)
+    hidden = torch.randn(3, 5, 8)
+    obs2 = torch.randn(3, 5, 2)
+    ## Padding of the second scene, only the primary ped in the third scene
+    obs2[1, 3:], obs2[2, 1:] = float('nan'), float('nan')
+    hidden[torch.isnan(obs2).any(-1)] = float('nan')
+    pool = NMMP(hidden_dim=8, out_dim=16, k=3)
+
+    pool.reset(15, 4, 'cpu')
+    batched = pool(hidden, None, obs2).view(3, 5, -1)
+    for i, num_visible in enumerate([5, 3, 1]):
+        ## Message passing only between the visible tracks of the scene
+        expected = pool(hidden[i:i+1, :num_visible], None, obs2[i:i+1, :num_visible])
+        assert torch.allclose(batched[i, :num_visible], expected, atol=1e-6)
+    assert torch.equal(batched[2, 0], torch.zeros(16))
@@ -0,0 +1,34 @@
+import torch
+
+from trajnetbaselines.lstm.non_gridbased_pooling import NearestNeighborLSTM, TrajectronPooling
+
+
+def test_trajectron_scenes_independent():
+    torch.manual_seed(0)
+    obs2 = torch.randn(3, 5, 2)
+    obs1 = obs2 + 0.1 * torch.randn(3, 5, 2)
+    ## Padding of the second scene
+    obs1[1, 3:], obs2[1, 3:] = float('nan'), float('nan')
+    pool = TrajectronPooling(hidden_dim=8, out_dim=16)
+
+    pool.reset(15, 4, 'cpu')
+    batched = pool(None, obs1, obs2).view(3, 5, -1)
+    for i in range(3):
+        pool.reset(5, 4, 'cpu')
+        assert torch.allclose(batched[i], pool(None, obs1[i:i+1], obs2[i:i+1]), atol=1e-6)
+
+
+def test_interaction_state_masked_update():
+    torch.manual_seed(0)
+    obs = torch.randn(3, 2, 4, 2)
+    ## Track 1 of the first scene absent at the last time-step
+    obs[2, 0, 1] = float('nan')
+    for pool in [NearestNeighborLSTM(hidden_dim=8, out_dim=16), TrajectronPooling(hidden_dim=8, out_dim=16)]:
+        pool.reset(8, 3, 'cpu')
+        pool(None, obs[0], obs[1])
+        hidden, cell = pool.hidden_cell_state
+        pool(None, obs[1], obs[2])
+        assert pool.hidden_cell_state[0].shape == (8, 8)
+        assert torch.equal(pool.hidden_cell_state[0][1], hidden[1])
+        assert torch.equal(pool.hidden_cell_state[1][1], cell[1])
+        assert not torch.equal(pool.hidden_cell_state[0][0], hidden[0])
@@ -0,0 +1,29 @@
+import torch
+
+from trajnetbaselines.lstm.pooling_utils import off_diagonal_index, neighbour_values, relative_to_neighbours, \
+    nearest_neighbours, gather_tracks
+
+
+def test_off_diagonal_index():
+    index = off_diagonal_index(3, torch.device('cpu'))
+    assert index.tolist() == [[1, 2], [0, 2], [0, 1]]
+    assert off_diagonal_index(3, 'cpu') is index
+
+
+def test_neighbours_match_eye_mask():
+    values = torch.randn(2, 5, 3)
+    pairwise = values.unsqueeze(1) - values.unsqueeze(2)
+    mask = ~torch.eye(5).unsqueeze(0).repeat(2, 1, 1).bool()
+    expected = pairwise[mask].reshape(2, 5, 4, 3)
+    assert torch.equal(relative_to_neighbours(values), expected)
+    assert torch.equal(neighbour_values(values), values.unsqueeze(1).repeat(1, 5, 1, 1)[mask].reshape(2, 5, 4, 3))
+
+
+def test_nearest_neighbours():
+    obs = torch.Tensor([[[0.0, 0.0], [3.0, 0.0], [float('nan'), float('nan')], [1.0, 0.0]]])
+    index = nearest_neighbours(obs, 2)
+    assert index[0, 0].tolist() == [3, 1]
+    assert index[0, 1].tolist() == [3, 0]
+    assert gather_tracks(obs, index)[0, 0].tolist() == [[1.0, 0.0], [3.0, 0.0]]
+    ## Fewer neighbours than n, invisible neighbours last
+    assert nearest_neighbours(obs, 5)[0, 3].tolist() == [0, 1, 2]
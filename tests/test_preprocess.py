@@ -0,0 +1,42 @@
+import numpy as np
+
+from trajnetbaselines.preprocess import min_distances, batch_min_distances, concatenate_scenes, drop_distant
+
+NAN = float('nan')
+
+
+def test_drop_distant():
+    xy = np.array([
+        [[1.0, 1.0], [NAN, NAN], [3.0, 3.0], [40.0, 40.0]],
+        [[1.0, 1.0], [2.0, 2.0], [3.0, 3.0], [40.0, 40.0]],
+        [[1.0, 1.0], [2.0, 2.0], [NAN, NAN], [NAN, NAN]],
+    ])
+    dropped, mask = drop_distant(xy)
+    assert mask.tolist() == [True, True, True, False]
+    np.testing.assert_array_equal(dropped, xy[:, :3])
+
+    ## Precomputed distances, other radius
+    _, mask = drop_distant(xy, r=2.0, min_distance_2=min_distances(xy))
+    assert mask.tolist() == [True, True, False, False]
+
+
+def test_batch_min_distances():
+    rng = np.random.RandomState(0)
+    scenes = [rng.randn(num_frames, num_tracks, 2) * 5 for num_frames, num_tracks in [(5, 3), (8, 1), (6, 4)]]
+    scenes[2][:3, 1] = NAN
+    scenes[2][:, 3] = NAN
+    all_xy, offsets = concatenate_scenes(scenes, dtype=np.float64)
+    assert offsets.tolist() == [0, 3, 4, 8]
+    distances = batch_min_distances(all_xy, offsets)
+    for xy, start, end in zip(scenes, offsets[:-1], offsets[1:]):
+        np.testing.assert_array_equal(distances[start:end], min_distances(xy))
+    assert np.isnan(distances[7])
+
+
+def test_min_distances_empty():
+    ## No scenes (e.g. an empty sample of a file)
+    all_xy, offsets = concatenate_scenes([], dtype=np.float64)
+    assert offsets.tolist() == [0]
+    assert batch_min_distances(all_xy, offsets).shape == (0,)
+    ## No frames
+    assert np.isnan(min_distances(np.zeros((0, 2, 2)))).all()
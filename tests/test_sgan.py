@@ -0,0 +1,92 @@
+import copy
+import itertools
+
+import torch
+
+from trajnetbaselines.lstm.lstm import pooling_scatter_index
+from trajnetbaselines.lstm.non_gridbased_pooling import AttentionMLPPooling, NearestNeighborLSTM
+from trajnetbaselines.sgan import sgan
+from trajnetbaselines.sgan.sgan import SGAN, LSTMGenerator, LSTMDiscriminator
+
+NAN = float('nan')
+
+
+def random_batch():
+    torch.manual_seed(0)
+    scene = torch.cumsum(torch.randn(21, 5, 2) * 0.3, dim=0)
+    ## Two scenes, partial neighbour tracks
+    scene[:4, 1] = NAN
+    scene[15:, 2] = NAN
+    scene[:, 4] = scene[:, 3] + 1.0
+    scene[10:, 4] = NAN
+    goals = torch.randn(5, 2)
+    batch_split = torch.LongTensor([0, 3, 5])
+    return scene[:9], scene[9:], goals, batch_split
+
+
+def generators():
+    for pool in [None, NearestNeighborLSTM(n=2, hidden_dim=32, out_dim=16),
+                 AttentionMLPPooling(hidden_dim=32, out_dim=16)]:
+        torch.manual_seed(0)
+        yield LSTMGenerator(embedding_dim=16, hidden_dim=32, pool=pool, goal_flag=True).eval()
+
+
+def single_mode(generator, observed, goals, batch_split, prediction_truth):
+    """Reference: a single sample, noise drawn as (noise_dim,) as before the parallel decoding"""
+    num_tracks = observed.size(1)
+    hidden_cell_state = (torch.zeros(num_tracks, generator.hidden_dim), torch.zeros(num_tracks, generator.hidden_dim))
+    if generator.pool is not None:
+        max_num_neighbor = (batch_split[1:] - batch_split[:-1]).max() - 1
+        generator.pool.reset((len(batch_split) - 1) * (max_num_neighbor + 1), max_num_neighbor, device='cpu')
+    scatter_index = pooling_scatter_index(batch_split)
+    normals, positions = [], []
+    for obs1, obs2 in zip(observed[:-1], observed[1:]):
+        hidden_cell_state, normal = generator.step(generator.encoder, hidden_cell_state, obs1, obs2,
+                                                   goals, batch_split, scatter_index)
+        normals.append(normal)
+        positions.append(obs2 + normal[:, :2])
+
+    noise = sgan.get_noise((generator.noise_dim,), generator.noise_type, device='cpu')
+    hidden_state = generator.mlp_decoder_context(hidden_cell_state[0])
+    hidden_cell_state = (torch.cat([hidden_state, noise.repeat(num_tracks, 1)], dim=1), hidden_cell_state[1])
+
+    prediction_truth = copy.deepcopy(list(itertools.chain.from_iterable((observed[-1:], prediction_truth[:-1]))))
+    for obs1, obs2 in zip(prediction_truth[:-1], prediction_truth[1:]):
+        obs1[batch_split[:-1]] = positions[-2][batch_split[:-1]].detach()
+        obs2[batch_split[:-1]] = positions[-1][batch_split[:-1]].detach()
+        hidden_cell_state, normal = generator.step(generator.decoder, hidden_cell_state, obs1, obs2,
+                                                   goals, batch_split, scatter_index)
+        normals.append(normal)
+        positions.append(obs2 + normal[:, :2])
+    return torch.stack(normals, dim=0), torch.stack(positions, dim=0)
+
+
+def test_generator_modes(monkeypatch):
+    observed, prediction_truth, goals, batch_split = random_batch()
+    noise = torch.randn(3, 8)
+    for generator in generators():
+        monkeypatch.setattr(sgan, 'get_noise', lambda shape, *_, **__: noise[:shape[0]])
+        rel_pred_list, pred_list = generator(observed, goals, batch_split, prediction_truth, modes=3)
+        assert len(rel_pred_list) == len(pred_list) == 3
+        assert all(rel_pred.shape == (19, 5, 5) for rel_pred in rel_pred_list)
+        assert all(pred.shape == (19, 5, 2) for pred in pred_list)
+
+        ## Every mode is decoded independently of the others
+        for mode in range(3):
+            monkeypatch.setattr(sgan, 'get_noise', lambda shape, *_, **__: noise[mode:mode + 1])
+            rel_pred, pred = generator(observed, goals, batch_split, prediction_truth, modes=1)
+            assert torch.allclose(rel_pred[0], rel_pred_list[mode], atol=1e-6, equal_nan=True)
+            assert torch.allclose(pred[0], pred_list[mode], atol=1e-6, equal_nan=True)
+
+
+def test_discriminator_step_single_mode():
+    observed, prediction_truth, goals, batch_split = random_batch()
+    for generator in generators():
+        model = SGAN(generator=generator, discriminator=LSTMDiscriminator(embedding_dim=16, hidden_dim=32), k=3)
+        torch.manual_seed(1)
+        rel_pred_list, pred_list, _, _ = model(observed, goals, batch_split, prediction_truth, step_type='d')
+        torch.manual_seed(1)
+        expected_rel_pred, expected_pred = single_mode(generator, observed, goals, batch_split, prediction_truth)
+        assert len(rel_pred_list) == 1
+        assert torch.allclose(rel_pred_list[0], expected_rel_pred, atol=1e-6, equal_nan=True)
+        assert torch.allclose(pred_list[0], expected_pred, atol=1e-6, equal_nan=True)
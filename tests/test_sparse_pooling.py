@@ -0,0 +1,54 @@
+import torch
+
+from trajnetbaselines.lstm.gridbased_pooling import GridBasedPooling
+from trajnetbaselines.lstm.non_gridbased_pooling import HiddenStateMLPPooling, AttentionMLPPooling
+from trajnetbaselines.lstm.sparse_pooling import radius_neighbours, SparseGridBasedPooling, \
+    SparseHiddenStateMLPPooling, SparseAttentionMLPPooling
+
+
+def random_scenes():
+    torch.manual_seed(0)
+    obs2 = torch.rand(3, 8, 2) * 6
+    obs1 = obs2 + 0.1 * torch.randn(3, 8, 2)
+    hidden = torch.randn(3, 8, 16)
+    ## Padding of the second scene
+    obs1[1, 5:], obs2[1, 5:], hidden[1, 5:] = float('nan'), float('nan'), float('nan')
+    return hidden, obs1, obs2
+
+
+def test_radius_neighbours():
+    _, _, obs2 = random_scenes()
+    row, col = radius_neighbours(obs2, 1.5)
+
+    positions = obs2.view(-1, 2)
+    distance = torch.norm(positions.unsqueeze(1) - positions.unsqueeze(0), dim=-1)
+    scene = torch.arange(3).repeat_interleave(8)
+    expected = (distance <= 1.5) & (scene.unsqueeze(1) == scene.unsqueeze(0)) & ~torch.eye(24, dtype=torch.bool)
+    expected_row, expected_col = torch.nonzero(expected, as_tuple=True)
+    assert torch.equal(row, expected_row)
+    assert torch.equal(col, expected_col)
+
+
+def test_sparse_matches_dense():
+    hidden, obs1, obs2 = random_scenes()
+    visible = ~torch.isnan(obs2).any(dim=-1).view(-1)
+    for type_ in ['occupancy', 'directional', 'social']:
+        dense = GridBasedPooling(type_=type_, n=4, cell_side=0.5, hidden_dim=16, out_dim=8)
+        sparse = SparseGridBasedPooling(type_=type_, n=4, cell_side=0.5, hidden_dim=16, out_dim=8)
+        sparse.load_state_dict(dense.state_dict())
+        assert torch.equal(dense(hidden, obs1, obs2)[visible], sparse(hidden, obs1, obs2)[visible])
+
+    dense = HiddenStateMLPPooling(hidden_dim=16, out_dim=8)
+    sparse = SparseHiddenStateMLPPooling(hidden_dim=16, out_dim=8)
+    sparse.load_state_dict(dense.state_dict())
+    assert torch.allclose(dense(hidden, obs1, obs2)[visible], sparse(hidden, obs1, obs2)[visible])
+
+
+def test_sparse_attention_matches_dense():
+    ## Padded neighbours are masked in the dense attention
+    hidden, obs1, obs2 = random_scenes()
+    visible = ~torch.isnan(obs2).any(dim=-1).view(-1)
+    dense = AttentionMLPPooling(hidden_dim=16, out_dim=8)
+    sparse = SparseAttentionMLPPooling(hidden_dim=16, out_dim=8)
+    sparse.load_state_dict(dense.state_dict())
+    assert torch.allclose(dense(hidden, obs1, obs2)[visible], sparse(hidden, obs1, obs2)[visible], atol=1e-6)
@@ -0,0 +1,64 @@
+import argparse
+from collections import defaultdict
+
+import joblib
+import trajnetplusplustools
+
+from evaluator import trajnet_evaluator
+from evaluator.trajnet_evaluator import bucket_predictions, index_scene_types
+
+
+def test_index_scene_types():
+    indexes = defaultdict(list, {1: [0, 3], 3: [1], 4: [2]})
+    sub_indexes = defaultdict(list, {1: [1, 2], 3: [1], 4: [0]})
+    scene_types = index_scene_types(indexes, sub_indexes)
+    assert scene_types == {0: (1, [4]), 1: (3, [1, 3]), 2: (4, [1]), 3: (1, [])}
+
+
+def test_bucket_predictions(tmp_path):
+    rows = [trajnetplusplustools.SceneRow(5, 1, 0, 10),
+            trajnetplusplustools.SceneRow(6, 2, 10, 20),
+            trajnetplusplustools.TrackRow(10, 1, 1.0, 1.0, 0, 5),
+            trajnetplusplustools.TrackRow(0, 1, 0.0, 0.0, 0, 5),
+            trajnetplusplustools.TrackRow(10, 2, 2.0, 2.0, 0, 6),
+            trajnetplusplustools.TrackRow(10, 1, 3.0, 3.0, 0, 6),
+            trajnetplusplustools.TrackRow(20, 2, 4.0, 4.0, 0, 6)]
+    input_file = tmp_path / 'pred.ndjson'
+    input_file.write_text(''.join(trajnetplusplustools.writers.trajnet(row) + '\n' for row in rows))
+    reader_pred = trajnetplusplustools.Reader(str(input_file), scene_type='paths')
+
+    scenes_pred = bucket_predictions(reader_pred, [5, 6])
+    assert scenes_pred[0] == [[rows[3], rows[2]]]
+    assert scenes_pred[1] == [[rows[4], rows[6]], [rows[5]]]
+
+
+def write_rows(path, rows):
+    path.write_text(''.join(trajnetplusplustools.writers.trajnet(row) + '\n' for row in rows))
+
+
+def test_ground_truth_parsed_once(tmp_path, monkeypatch):
+    (tmp_path / 'test_private').mkdir()
+    write_rows(tmp_path / 'test_private' / 'a.ndjson',
+               [trajnetplusplustools.SceneRow(0, 1, 0, 20, 2.5, [1, []])] +
+               [trajnetplusplustools.TrackRow(f, 1, 0.1 * f, 0.0) for f in range(21)])
+    for model in ['m1_modes1', 'm2_modes1']:
+        (tmp_path / 'test_pred' / model).mkdir(parents=True)
+        write_rows(tmp_path / 'test_pred' / model / 'a.ndjson',
+                   [trajnetplusplustools.SceneRow(0, 1, 0, 20, 2.5, [1, []])] +
+                   [trajnetplusplustools.TrackRow(f, 1, 0.1 * f, 0.1, 0, 0) for f in range(9, 21)])
+
+    parsed = []
+    reader = trajnetplusplustools.Reader
+    def counting_reader(input_file, *args, **kwargs):
+        parsed.append(input_file)
+        return reader(input_file, *args, **kwargs)
+    monkeypatch.setattr(trajnetplusplustools, 'Reader', counting_reader)
+
+    ## --no_gt_cache with several jobs: the ground truth is still parsed once for both models
+    args = argparse.Namespace(disable_collision=False, eval_backend='array', labels=None, modes=1, n_jobs=2,
+                              no_gt_cache=True, obs_length=9, pred_length=12, output=['m1.pkl', 'm2.pkl'],
+                              path=str(tmp_path / 'test_pred') + '/')
+    with joblib.parallel_backend('threading'):
+        trajnet_evaluator.trajnet_evaluate(args)
+    assert sum('test_private' in f for f in parsed) == 1
+    assert sum('test_pred' in f for f in parsed) == 2
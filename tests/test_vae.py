@@ -0,0 +1,84 @@
+import torch
+
+from trajnetbaselines.lstm.non_gridbased_pooling import AttentionMLPPooling, NearestNeighborLSTM
+from trajnetbaselines.vae import vae
+from trajnetbaselines.vae.vae import VAE
+
+NAN = float('nan')
+
+
+def random_batch():
+    torch.manual_seed(0)
+    scene = torch.cumsum(torch.randn(21, 5, 2) * 0.3, dim=0)
+    ## Two scenes, partial neighbour tracks
+    scene[:4, 1] = NAN
+    scene[15:, 2] = NAN
+    scene[:, 4] = scene[:, 3] + 1.0
+    scene[10:, 4] = NAN
+    goals = torch.randn(5, 2)
+    batch_split = torch.LongTensor([0, 3, 5])
+    return scene[:9], scene[9:], goals, batch_split
+
+
+def models(num_modes):
+    for pool_class in [None, NearestNeighborLSTM, AttentionMLPPooling]:
+        torch.manual_seed(0)
+        pool = pool_class(hidden_dim=32, out_dim=16) if pool_class is not None else None
+        yield VAE(embedding_dim=16, hidden_dim=32, pool=pool, goal_flag=True, num_modes=num_modes, latent_dim=8)
+
+
+def test_vae_modes_shapes():
+    observed, prediction_truth, goals, batch_split = random_batch()
+    for model in models(num_modes=3):
+        rel_pred_list, pred_list, z_distr_xy, z_distr_x = model(observed, goals, batch_split, prediction_truth[:-1])
+        assert len(rel_pred_list) == len(pred_list) == 3
+        assert all(rel_pred.shape == (19, 5, 5) for rel_pred in rel_pred_list)
+        assert all(pred.shape == (19, 5, 2) for pred in pred_list)
+        assert z_distr_xy.shape == (5, 16)
+        assert z_distr_x is None  ## desire: fixed prior
+
+        model.eval()
+        rel_pred_list, pred_list, z_distr_xy, _ = model(observed, goals, batch_split, n_predict=12)
+        assert len(pred_list) == 3
+        assert all(pred.shape == (19, 5, 2) for pred in pred_list)
+        assert z_distr_xy is None
+
+
+def test_vae_modes_match_single_mode(monkeypatch):
+    observed, _, goals, batch_split = random_batch()
+    z_val = torch.randn(3, 5, 8)
+    for model, single_model in zip(models(num_modes=3), models(num_modes=1)):
+        model.eval()
+        single_model.eval()
+        monkeypatch.setattr(vae, 'sample_multivariate_distribution', lambda *_, **__: z_val)
+        _, pred_list, _, _ = model(observed, goals, batch_split, n_predict=12)
+
+        ## Every mode is decoded independently, from the same interaction-encoder state
+        for mode in range(3):
+            monkeypatch.setattr(vae, 'sample_multivariate_distribution', lambda *_, **__: z_val[mode:mode + 1])
+            _, pred, _, _ = single_model(observed, goals, batch_split, n_predict=12)
+            assert torch.allclose(pred[0], pred_list[mode], atol=1e-6, equal_nan=True)
+
+        ## Same latent sample, same prediction (also with a recurrent interaction encoder)
+        monkeypatch.setattr(vae, 'sample_multivariate_distribution', lambda *_, **__: z_val[:1].repeat(3, 1, 1))
+        _, pred_list, _, _ = model(observed, goals, batch_split, n_predict=12)
+        assert torch.allclose(pred_list[1], pred_list[0], equal_nan=True)
+        assert torch.allclose(pred_list[2], pred_list[0], equal_nan=True)
+
+
+def test_vae_modes_seeded_generator():
+    observed, prediction_truth, goals, batch_split = random_batch()
+    for model in models(num_modes=3):
+        for training in [False, True]:
+            model.train(training)
+            truth = prediction_truth[:-1] if training else None
+            n_predict = None if training else 12
+            runs = []
+            for seed in [1, 1, 2]:
+                ## Global RNG state must not matter
+                torch.manual_seed(len(runs))
+                _, pred_list, _, _ = model(observed, goals, batch_split, truth, n_predict,
+                                           generator=torch.Generator().manual_seed(seed))
+                runs.append(torch.stack(pred_list))
+            assert torch.equal(runs[0].nan_to_num(), runs[1].nan_to_num())
+            assert not torch.allclose(runs[0].nan_to_num(), runs[2].nan_to_num())
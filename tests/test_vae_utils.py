@@ -0,0 +1,25 @@
+import torch
+from trajnetbaselines.vae.utils import sample_multivariate_distribution
+
+
+def test_sample_shape():
+    mean = torch.zeros(3, 8)
+    var_log = torch.zeros(3, 8)
+    assert sample_multivariate_distribution(mean, var_log).shape == (3, 8)
+    assert sample_multivariate_distribution(mean, var_log, num_samples=5).shape == (5, 3, 8)
+
+
+def test_sample_generator():
+    mean = torch.zeros(3, 8)
+    var_log = torch.zeros(3, 8)
+    samples1 = sample_multivariate_distribution(mean, var_log, 4, generator=torch.Generator().manual_seed(42))
+    samples2 = sample_multivariate_distribution(mean, var_log, 4, generator=torch.Generator().manual_seed(42))
+    assert torch.equal(samples1, samples2)
+
+
+def test_sample_moments():
+    mean = torch.Tensor([[1.0, -2.0]])
+    var_log = torch.log(torch.Tensor([[0.25, 4.0]]))
+    samples = sample_multivariate_distribution(mean, var_log, 100000, generator=torch.Generator().manual_seed(0))
+    assert torch.allclose(samples.mean(dim=0), mean, atol=0.05)
+    assert torch.allclose(samples.var(dim=0), torch.exp(var_log), rtol=0.05)
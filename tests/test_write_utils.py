@@ -0,0 +1,44 @@
+import numpy as np
+import trajnetplusplustools
+
+from evaluator.write_utils import format_scene_predictions
+
+
+def reference_lines(predictions, scene_id, paths, obs_length, pred_length):
+    """Per-row serialization with writers.trajnet"""
+    seq_length = obs_length + pred_length
+    observed_path = paths[0]
+    frame_diff = observed_path[1].frame - observed_path[0].frame
+    first_frame = observed_path[obs_length-1].frame + frame_diff
+    ped_id = observed_path[0].pedestrian
+    scenerow = trajnetplusplustools.SceneRow(scene_id, ped_id, observed_path[0].frame,
+                                             observed_path[0].frame + (seq_length - 1) * frame_diff, 2.5, 0)
+    lines = [trajnetplusplustools.writers.trajnet(scenerow)]
+    for m in range(len(predictions)):
+        prediction, neigh_predictions = predictions[m]
+        tracks = [(ped_id, prediction)]
+        if len(neigh_predictions):
+            tracks += [(paths[n+1][0].pedestrian, neigh_predictions[:, n]) for n in range(neigh_predictions.shape[1])]
+        for p, track in tracks:
+            for i in range(len(track)):
+                row = trajnetplusplustools.TrackRow(first_frame + i * frame_diff, p,
+                                                    track[i, 0].item(), track[i, 1].item(), m, scene_id)
+                lines.append(trajnetplusplustools.writers.trajnet(row))
+    return ''.join(line + '\n' for line in lines)
+
+
+def test_format_scene_predictions():
+    rng = np.random.RandomState(0)
+    obs_length, pred_length, num_tracks = 9, 12, 4
+    paths = [[trajnetplusplustools.TrackRow(100 + 10 * t, 7 + p, 0.0, 0.0) for t in range(obs_length)]
+             for p in range(num_tracks)]
+    scene = rng.uniform(-50, 50, size=(pred_length, num_tracks, 2)).astype(np.float32)
+    scene[3, 2] = np.nan
+    scene[5, 1, 0] = np.inf
+    scene[6, 1, 1] = -np.inf
+    scene[:3, 3] = [[1.005, 2.675], [-0.004, -0.0], [1e-7, 123456.789]]
+    predictions = {0: [scene[:, 0], scene[:, 1:]],
+                   1: [scene[:, 0] + 0.005, []],
+                   2: [scene[:, 0] - 0.125, np.zeros((pred_length, 0, 2))]}
+    assert format_scene_predictions(predictions, 42, paths, obs_length, pred_length) == \
+        reference_lines(predictions, 42, paths, obs_length, pred_length)
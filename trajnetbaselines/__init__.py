@@ -1,6 +1,7 @@
 __version__ = '0.1.0'
 
 from . import augmentation
+from . import preprocess
 from . import lstm
 from . import sgan
 from . import classical
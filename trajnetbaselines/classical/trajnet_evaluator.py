@@ -109,6 +109,12 @@ def main():
                         help='disable writing new files')
     parser.add_argument('--disable-collision', action='store_true',
                         help='disable collision metrics')
+    parser.add_argument('--eval_backend', default='array', choices=('array', 'rows'),
+                        help='compute the metrics on padded arrays or row by row')
+    parser.add_argument('--n_jobs', default=1, type=int,
+                        help='number of processes evaluating (model, dataset) pairs')
+    parser.add_argument('--no_gt_cache', action='store_true',
+                        help='do not cache the parsed ground truth')
     parser.add_argument('--labels', required=False, nargs='+',
                         help='labels of models')
     parser.add_argument('--normalize_scene', action='store_true',
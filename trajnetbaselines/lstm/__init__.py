@@ -3,3 +3,6 @@ from .lstm import LSTM, LSTMPredictor
 from .gridbased_pooling import GridBasedPooling
 from .non_gridbased_pooling import NearestNeighborMLP, HiddenStateMLPPooling, AttentionMLPPooling
 from .non_gridbased_pooling import NearestNeighborLSTM, TrajectronPooling
+from .sparse_pooling import SparseNearestNeighborMLP, SparseHiddenStateMLPPooling
+from .sparse_pooling import SparseAttentionMLPPooling, SparseGridBasedPooling
+from .more_non_gridbased_pooling import NMMP
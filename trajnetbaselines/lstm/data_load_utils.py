@@ -1,10 +1,166 @@
 import trajnetplusplustools
+import json
 import os
 import pickle
+import random
+
+import numpy as np
+import torch
+
+from .. import augmentation
+from ..preprocess import batch_min_distances, concatenate_scenes, drop_distant
+from .utils import center_scene, random_rotation
+
+CACHE_VERSION = 2
+
+
+def scene_goals(goal_dict, paths):
+    """ Goals of the tracks of a scene in the track order of Reader.paths_to_xy """
+    frames = set(r.frame for r in paths[0])
+    paths = [path for path in paths if any(row.frame in frames for row in path)]
+    return [goal_dict[path[0].pedestrian] for path in paths]
+
+
+def _source_files(path, subset, goals):
+    """ Dataset (and goal) files of a subset with their size and modification time """
+    files = sorted(f.split('.')[-2] for f in os.listdir(path + subset) if f.endswith('.ndjson'))
+    sources = {}
+    for file in files:
+        source_files = [path + subset + file + '.ndjson']
+        if goals:
+            source_files.append('goal_files/' + subset + file + '.pkl')
+        sources[file] = [[os.path.getsize(f), os.path.getmtime(f)] for f in source_files]
+    return files, sources
+
+
+def compile_scenes(path, subset='/train/', goals=True, cache_dir=None):
+    """ Compiles all scenes of a subset into a memory-mappable NumPy store
+
+    The store consists of:
+        xy.npy : float32 [max_num_frames, total_tracks, 2]
+            x-y coordinates of all tracks of all scenes (nan for blanks)
+        offsets.npy : int64 [num_scenes + 1]
+            Track offsets of each scene in xy.npy
+        num_frames.npy : int64 [num_scenes]
+            Number of frames of each scene
+        scene_ids.npy : int64 [num_scenes]
+            Scene id of each scene in its dataset file
+        file_index.npy : int64 [num_scenes]
+            Index of the dataset file of each scene (see manifest.json)
+        min_distance_2.npy : float32 [total_tracks]
+            Minimum squared distance of each track to the primary ped of its scene (see drop_distant)
+        goals.npy : float32 [total_tracks, 2]
+            Goal of each track (only if 'goals' is True)
+        manifest.json
+            Dataset file names and the stats used to detect stale stores
+
+    Parameters
+    ----------
+    subset: String ['/train/', '/val/']
+        Determines the subset of data to be processed
+    goals: Bool
+        If true, the goals of each track are compiled as well
+    cache_dir: String
+        Output directory. Default: <path><subset>.cache/
+
+    Returns
+    -------
+    cache_dir: String
+        Directory of the compiled store
+    """
+    if cache_dir is None:
+        cache_dir = path + subset + '.cache/'
+    os.makedirs(cache_dir, exist_ok=True)
+
+    files, sources = _source_files(path, subset, goals)
+    scenes_xy, scene_goals_list = [], []
+    num_frames, scene_ids, file_index = [], [], []
+    for file_i, file in enumerate(files):
+        reader = trajnetplusplustools.Reader(path + subset + file + '.ndjson', scene_type='paths')
+        if goals:
+            goal_dict = pickle.load(open('goal_files/' + subset + file + '.pkl', "rb"))
+        for s_id, paths in reader.scenes():
+            xy = trajnetplusplustools.Reader.paths_to_xy(paths)
+            scenes_xy.append(xy)
+            if goals:
+                scene_goals_list.append(np.array(scene_goals(goal_dict, paths)).reshape(-1, 2))
+            num_frames.append(xy.shape[0])
+            scene_ids.append(s_id)
+            file_index.append(file_i)
+
+    ## Concatenate scenes of different lengths along the track dimension
+    all_xy, offsets = concatenate_scenes(scenes_xy)
+
+    np.save(cache_dir + 'xy.npy', all_xy)
+    np.save(cache_dir + 'offsets.npy', offsets)
+    np.save(cache_dir + 'min_distance_2.npy', batch_min_distances(all_xy, offsets))
+    np.save(cache_dir + 'num_frames.npy', np.array(num_frames, dtype=np.int64))
+    np.save(cache_dir + 'scene_ids.npy', np.array(scene_ids, dtype=np.int64))
+    np.save(cache_dir + 'file_index.npy', np.array(file_index, dtype=np.int64))
+    if goals:
+        all_goals = np.concatenate(scene_goals_list, axis=0) if scene_goals_list else np.zeros((0, 2))
+        np.save(cache_dir + 'goals.npy', all_goals.astype(np.float32))
+
+    ## Written last: a store without manifest is never considered valid
+    with open(cache_dir + 'manifest.json', 'w') as f:
+        json.dump({'version': CACHE_VERSION, 'goals': goals, 'files': files, 'sources': sources}, f)
+    return cache_dir
+
+
+def load_compiled_scenes(cache_dir, sample=1.0, goals=True):
+    """ Loads a store written by compile_scenes (memory-mapped)
+
+    Returns
+    -------
+    all_scenes: List
+        List of (filename, scene_id, xy, min_distance_2) where xy is a read-only view
+        Array [num_frames, num_tracks, 2] into the memory-mapped store
+        and min_distance_2 the Array [num_tracks] of the scene (see drop_distant)
+    all_goals: Dictionary
+        Dictionary of goals corresponding to each dataset file.
+        None if 'goals' argument is False.
+    """
+    with open(cache_dir + 'manifest.json') as f:
+        files = json.load(f)['files']
+    xy = np.load(cache_dir + 'xy.npy', mmap_mode='r')
+    offsets = np.load(cache_dir + 'offsets.npy')
+    num_frames = np.load(cache_dir + 'num_frames.npy')
+    scene_ids = np.load(cache_dir + 'scene_ids.npy')
+    file_index = np.load(cache_dir + 'file_index.npy')
+    min_distance_2 = np.load(cache_dir + 'min_distance_2.npy')
+    all_goals_xy = np.load(cache_dir + 'goals.npy', mmap_mode='r') if goals else None
+
+    all_goals = {} if goals else None
+    all_scenes = []
+    for file_i, file in enumerate(files):
+        scene_index = np.flatnonzero(file_index == file_i).tolist()
+        ## Same per-file sampling as prepare_data
+        scene_index = random.sample(scene_index, int(len(scene_index) * sample))
+        scene = [(file, int(scene_ids[i]), xy[:num_frames[i], offsets[i]:offsets[i+1]],
+                  min_distance_2[offsets[i]:offsets[i+1]]) for i in scene_index]
+        if goals:
+            all_goals[file] = {int(scene_ids[i]): all_goals_xy[offsets[i]:offsets[i+1]] for i in scene_index}
+        all_scenes += scene
+    return all_scenes, all_goals
+
+
+def is_compiled(path, subset='/train/', goals=True, cache_dir=None):
+    """ True if a compiled store of the subset exists and is up to date """
+    if cache_dir is None:
+        cache_dir = path + subset + '.cache/'
+    if not os.path.isfile(cache_dir + 'manifest.json'):
+        return False
+    with open(cache_dir + 'manifest.json') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != CACHE_VERSION or (goals and not manifest['goals']):
+        return False
+    files, sources = _source_files(path, subset, manifest['goals'])
+    return manifest['files'] == files and manifest['sources'] == sources
+
+
+def prepare_data(path, subset='/train/', sample=1.0, goals=True, cache=False):
+    """ Prepares the train/val scenes and corresponding goals
 
-def prepare_data(path, subset='/train/', sample=1.0, goals=True):
-    """ Prepares the train/val scenes and corresponding goals 
-    
     Parameters
     ----------
     subset: String ['/train/', '/val/']
@@ -15,11 +171,17 @@ def prepare_data(path, subset='/train/', sample=1.0, goals=True):
         If true, the goals of each track are extracted
         The corresponding goal file must be present in the 'goal_files' folder
         The name of the goal file must be the same as the name of the training file
+    cache: Bool
+        If true, the subset is compiled once into a NumPy store (see compile_scenes)
+        which is memory-mapped on every subsequent call.
+        The store is recompiled when the dataset files change.
 
     Returns
     -------
     all_scenes: List
-        List of all processed scenes
+        List of all processed scenes as (filename, scene_id, xy, min_distance_2)
+        where xy is Array [num_frames, num_tracks, 2] and min_distance_2 is
+        Array [num_tracks], the minimum squared distance of each track to the primary ped
     all_goals: Dictionary
         Dictionary of goals corresponding to each dataset file.
         None if 'goals' argument is False.
@@ -36,6 +198,13 @@ def prepare_data(path, subset='/train/', sample=1.0, goals=True):
             print("Validation folder does NOT exist")
             return None, None, False
 
+    if cache:
+        if not is_compiled(path, subset, goals):
+            print("Compiling {} scenes of {}".format(subset.strip('/'), path))
+            compile_scenes(path, subset, goals)
+        all_scenes, all_goals = load_compiled_scenes(path + subset + '.cache/', sample=sample, goals=goals)
+        return all_scenes, all_goals, True
+
     ## read goal files
     all_goals = {}
     all_scenes = []
@@ -45,14 +214,124 @@ def prepare_data(path, subset='/train/', sample=1.0, goals=True):
     ## Iterate over file names
     for file in files:
         reader = trajnetplusplustools.Reader(path + subset + file + '.ndjson', scene_type='paths')
+        ## Sample scenes
+        scene_ids = random.sample(list(reader.scenes_by_id), int(len(reader.scenes_by_id) * sample))
         ## Necessary modification of train scene to add filename
-        scene = [(file, s_id, s) for s_id, s in reader.scenes(sample=sample)]
+        scene = [(file, s_id, s) for s_id, s in reader.scenes(ids=scene_ids)]
         if goals:
             goal_dict = pickle.load(open('goal_files/' + subset + file +'.pkl', "rb"))
             ## Get goals corresponding to train scene
-            all_goals[file] = {s_id: [goal_dict[path[0].pedestrian] for path in s] for _, s_id, s in scene}
-        all_scenes += scene
+            all_goals[file] = {s_id: scene_goals(goal_dict, s) for _, s_id, s in scene}
+        ## Convert paths to xy once instead of every epoch
+        scenes_xy = [trajnetplusplustools.Reader.paths_to_xy(s) for _, _, s in scene]
+        ## Distances to the primary ped of all scenes of the file at once
+        all_xy, offsets = concatenate_scenes(scenes_xy, dtype=np.float64)
+        min_distance_2 = batch_min_distances(all_xy, offsets)
+        all_scenes += [(file, s_id, xy, min_distance_2[start:end])
+                       for (_, s_id, _), xy, start, end in zip(scene, scenes_xy, offsets[:-1], offsets[1:])]
 
     if goals:
         return all_scenes, all_goals, True
     return all_scenes, None, True
+
+
+class SceneDataset(torch.utils.data.Dataset):
+    """ Preprocessed scenes of prepare_data for training / validation
+
+    Each item is (scene, scene_goal): the scene after dropping distant
+    pedestrians (more than drop_distance away from the primary ped),
+    normalization and augmentation, and the goals of its tracks.
+
+    Attributes
+    ----------
+    scenes : List
+        List of (filename, scene_id, xy, min_distance_2) as returned by prepare_data
+    goals : Dictionary
+        Dictionary of goals corresponding to each dataset file (or None)
+    obs_length : Scalar
+        Observation length (used for normalization and noise augmentation)
+    normalize_scene : Bool
+        If True, rotate scene so primary pedestrian moves northwards at end of observation
+    augment : Bool
+        If True, perform random rotation augmentation
+    augment_noise : Bool
+        If True, add noise to the observed neighbour positions
+    drop_distance : Scalar
+        Radius (in m) around the primary ped beyond which pedestrians are dropped
+    """
+    def __init__(self, scenes, goals=None, obs_length=9, normalize_scene=False, augment=False, augment_noise=False,
+                 drop_distance=6.0):
+        self.scenes = scenes
+        self.goals = goals
+        self.obs_length = obs_length
+        self.normalize_scene = normalize_scene
+        self.augment = augment
+        self.augment_noise = augment_noise
+        self.drop_distance = drop_distance
+
+    def __len__(self):
+        return len(self.scenes)
+
+    def __getitem__(self, index):
+        filename, scene_id, scene, min_distance_2 = self.scenes[index]
+
+        ## get goals
+        if self.goals is not None:
+            scene_goal = np.array(self.goals[filename][scene_id])
+        else:
+            scene_goal = np.zeros((scene.shape[1], 2))
+
+        ## Drop Distant
+        scene, mask = drop_distant(scene, r=self.drop_distance, min_distance_2=min_distance_2)
+        scene_goal = scene_goal[mask]
+
+        ##process scene
+        if self.normalize_scene:
+            scene, _, _, scene_goal = center_scene(scene, self.obs_length, goals=scene_goal)
+        if self.augment:
+            scene, scene_goal = random_rotation(scene, goals=scene_goal)
+        if self.augment_noise:
+            scene = augmentation.add_noise(scene, thresh=0.02, obs_length=self.obs_length, ped='neigh')
+
+        return scene, scene_goal
+
+
+def collate_scenes(batch):
+    """ Concatenates a list of (scene, scene_goal) into a batch of scenes
+
+    Returns
+    -------
+    batch_scene : Tensor [seq_length, num_tracks, 2]
+        Tensor of batch of scenes.
+    batch_scene_goal : Tensor [num_tracks, 2]
+        Tensor of goals of each track in batch
+    batch_split : Tensor [batch_size + 1]
+        Tensor defining the split of the batch.
+        Required to identify the tracks of to the same scene
+    """
+    batch_scene = np.concatenate([scene for scene, _ in batch], axis=1)
+    batch_scene_goal = np.concatenate([scene_goal for _, scene_goal in batch], axis=0)
+    batch_split = np.cumsum([0] + [scene.shape[1] for scene, _ in batch])
+
+    return torch.Tensor(batch_scene), torch.Tensor(batch_scene_goal), torch.Tensor(batch_split).long()
+
+
+def seed_worker(worker_id):
+    """ Seeds numpy (noise augmentation) in DataLoader workers.
+    torch and random are already seeded per worker by the DataLoader """
+    np.random.seed(torch.initial_seed() % 2**32)
+
+
+def scene_loader(dataset, batch_size=8, num_workers=0, pin_memory=False, prefetch_factor=2):
+    """ DataLoader over a SceneDataset yielding (batch_scene, batch_scene_goal, batch_split)
+
+    Scenes are batched in the order of the dataset (the trainers shuffle the scenes
+    every epoch). With num_workers > 0, the preprocessing of the next
+    'prefetch_factor' batches per worker overlaps with the forward/backward pass.
+    """
+    kwargs = {}
+    if num_workers > 0:
+        kwargs = dict(prefetch_factor=prefetch_factor, worker_init_fn=seed_worker)
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False,
+                                       num_workers=num_workers, collate_fn=collate_scenes,
+                                       pin_memory=pin_memory, **kwargs)
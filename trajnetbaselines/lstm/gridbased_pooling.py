@@ -6,17 +6,13 @@ import matplotlib.pyplot as plt
 
 import torch
 
-def one_cold(i, n):
-    """Inverse one-hot encoding."""
-    x = torch.ones(n, dtype=torch.bool)
-    x[i] = 0
-    return x
+from .pooling_utils import neighbour_values, relative_to_neighbours, visible_tracks, masked_lstm_step
 
 class GridBasedPooling(torch.nn.Module):
     def __init__(self, cell_side=2.0, n=4, hidden_dim=128, out_dim=None,
                  type_='occupancy', pool_size=1, blur_size=1, front=False,
                  embedding_arch='one_layer', pretrained_pool_encoder=None,
-                 constant=0, norm=0, layer_dims=None, latent_dim=16):
+                 constant=0, norm=0, layer_dims=None, latent_dim=16, reduce='last'):
         """
         Pools in a grid of size 'n * cell_side' centred at the ped location
         cell_side: Scalar
@@ -37,6 +33,8 @@ class GridBasedPooling(torch.nn.Module):
             background values of pooling grid
         norm: Scalar 
             normalization scheme of pool grid [Default: None]
+        reduce: ('last', 'sum')
+            value of a cell with several neighbours: the one of the last neighbour or the sum
         """
         super(GridBasedPooling, self).__init__()
         self.cell_side = cell_side
@@ -52,6 +50,7 @@ class GridBasedPooling(torch.nn.Module):
         self.constant = constant
         self.norm = norm
         self.pool_scale = 1.0
+        self.reduce = reduce
 
         ## Type of pooling
         self.pooling_dim = 1
@@ -105,6 +104,8 @@ class GridBasedPooling(torch.nn.Module):
 
         ## Embed grid
         grid = grid.reshape(batch_size * num_tracks, -1)
+        if self.embedding_arch == 'lstm_layer':
+            return self.lstm_forward(grid, visible_tracks(obs1, obs2))
         if self.embedding:
             return self.embedding(grid)
         return grid
@@ -128,15 +129,8 @@ class GridBasedPooling(torch.nn.Module):
             return self.occupancy(obs2, None, past_obs=obs1)
 
         ## Generate values to input in directional grid tensor (relative velocities in this case) 
-        vel = obs2 - obs1
-        unfolded = vel.unsqueeze(1).repeat(1, vel.size(1), 1, 1)
-        ## [batch_size, num_tracks, 2] --> [batch_size, num_tracks, num_tracks, 2]
-        relative = unfolded - vel.unsqueeze(2)
-        ## Deleting Diagonal (Ped wrt itself)
-        ## mask: [batch_size, num_tracks, num_tracks]
-        mask = ~torch.eye(num_tracks).unsqueeze(0).repeat(batch_size, 1, 1).bool()
-        ## [batch_size, num_tracks, num_tracks, 2] --> [batch_size, num_tracks, num_tracks-1, 2]
-        relative = relative[mask].reshape(batch_size, num_tracks, num_tracks-1, 2)
+        ## [batch_size, num_tracks, 2] --> [batch_size, num_tracks, num_tracks-1, 2] (Ped wrt itself excluded)
+        relative = relative_to_neighbours(obs2 - obs1)
         relative = torch.nan_to_num(relative)
 
         ## Generate Occupancy Map
@@ -156,15 +150,10 @@ class GridBasedPooling(torch.nn.Module):
             return self.occupancy(obs2, None, past_obs=obs1)
 
         ## Generate values to input in hiddenstate grid tensor (compressed hidden-states in this case)
-        ## [batch_size, num_tracks, hidden_dim] --> [batch_size, num_tracks, num_tracks, pooling_dim]
-        hidden_state_grid = hidden_state.unsqueeze(1).repeat(1, num_tracks, 1, 1)
-        ## Deleting Diagonal (Ped wrt itself)
-        ## mask: [batch_size, num_tracks, num_tracks]
-        mask = ~torch.eye(num_tracks).unsqueeze(0).repeat(batch_size, 1, 1).bool()
-        ## [batch_size, num_tracks, num_tracks, 2] --> [batch_size, num_tracks, num_tracks-1, 2]
-        hidden_state_grid = hidden_state_grid[mask].reshape(batch_size, num_tracks, num_tracks-1, -1)
-        hidden_state_grid = torch.nan_to_num(hidden_state_grid)
-        hidden_state_grid = self.hidden_dim_encoding(hidden_state_grid)
+        ## Encode each pedestrian once, then gather the neighbours (Ped wrt itself excluded)
+        ## [batch_size, num_tracks, hidden_dim] --> [batch_size, num_tracks, num_tracks-1, pooling_dim]
+        hidden_state_grid = self.hidden_dim_encoding(torch.nan_to_num(hidden_state))
+        hidden_state_grid = neighbour_values(hidden_state_grid)
         
         ## Generate Occupancy Map
         return self.occupancy(obs2, hidden_state_grid, past_obs=obs1)
@@ -183,30 +172,18 @@ class GridBasedPooling(torch.nn.Module):
             return self.occupancy(obs2, None, past_obs=obs1)
 
         ## Generate values to input in directional grid tensor (relative velocities in this case) 
-        vel = obs2 - obs1
-        unfolded = vel.unsqueeze(1).repeat(1, vel.size(1), 1, 1)
-        ## [batch_size, num_tracks, 2] --> [batch_size, num_tracks, num_tracks, 2]
-        relative = unfolded - vel.unsqueeze(2)
-        ## Deleting Diagonal (Ped wrt itself)
-        ## mask: [batch_size, num_tracks, num_tracks]
-        mask = ~torch.eye(num_tracks).unsqueeze(0).repeat(batch_size, 1, 1).bool()
-        ## [batch_size, num_tracks, num_tracks, 2] --> [batch_size, num_tracks, num_tracks-1, 2]
-        relative = relative[mask].reshape(batch_size, num_tracks, num_tracks-1, 2)
+        ## [batch_size, num_tracks, 2] --> [batch_size, num_tracks, num_tracks-1, 2] (Ped wrt itself excluded)
+        relative = relative_to_neighbours(obs2 - obs1)
         relative = torch.nan_to_num(relative)
 
         ## Generate values to input in hiddenstate grid tensor (compressed hidden-states in this case)
-        ## [batch_size, num_tracks, hidden_dim] --> [batch_size, num_tracks, num_tracks, pooling_dim]
-        hidden_state_grid = hidden_state.unsqueeze(1).repeat(1, num_tracks, 1, 1)
-        ## Deleting Diagonal (Ped wrt itself)
-        ## mask: [batch_size, num_tracks, num_tracks]
-        mask = ~torch.eye(num_tracks).unsqueeze(0).repeat(batch_size, 1, 1).bool()
-        ## [batch_size, num_tracks, num_tracks, 2] --> [batch_size, num_tracks, num_tracks-1, 2]
-        hidden_state_grid = hidden_state_grid[mask].reshape(batch_size, num_tracks, num_tracks-1, -1)
-        hidden_state_grid = torch.nan_to_num(hidden_state_grid)
-        hidden_state_grid = self.hidden_dim_encoding(hidden_state_grid)
+        ## Encode each pedestrian once, then gather the neighbours (Ped wrt itself excluded)
+        ## [batch_size, num_tracks, hidden_dim] --> [batch_size, num_tracks, num_tracks-1, pooling_dim]
+        hidden_state_grid = self.hidden_dim_encoding(torch.nan_to_num(hidden_state))
+        hidden_state_grid = neighbour_values(hidden_state_grid)
 
         # Combine representations
-        dir_social_rep = torch.cat([relative, hidden_state_grid], dim=2)
+        dir_social_rep = torch.cat([relative, hidden_state_grid], dim=-1)
 
         ## Generate Occupancy Map
         return self.occupancy(obs2, dir_social_rep, past_obs=obs1)
@@ -245,22 +222,16 @@ class GridBasedPooling(torch.nn.Module):
         num_tracks = obs.size(1)
 
         ##mask unseen
-        mask = torch.isnan(obs).any(dim=-1)
-        obs[mask] = -500.0
+        mask = torch.isnan(obs).any(dim=-1, keepdim=True)
+        obs = torch.where(mask, torch.full_like(obs, -500.0), obs)
 
         ## if only primary pedestrian present
         if num_tracks == 1:
-            return self.constant*torch.ones(1, self.pooling_dim, self.n, self.n, device=obs.device)
-
-        ## Get relative position
-        ## [batch_size, num_tracks, 2] --> [batch_size, num_tracks, num_tracks, 2]
-        unfolded = obs.unsqueeze(1).repeat(1, obs.size(1), 1, 1)
-        relative = unfolded - obs.unsqueeze(2)
-        ## Deleting Diagonal (Ped wrt itself)
-        ## mask: [batch_size, num_tracks, num_tracks]
-        mask = ~torch.eye(num_tracks).unsqueeze(0).repeat(batch_size, 1, 1).bool()
-        ## [batch_size, num_tracks, num_tracks, 2] --> [batch_size, num_tracks, num_tracks-1, 2]
-        relative = relative[mask].reshape(batch_size, num_tracks, num_tracks-1, 2)
+            return self.constant*torch.ones(batch_size, self.pooling_dim, self.n, self.n, device=obs.device)
+
+        ## Get relative position of the neighbours (Ped wrt itself excluded)
+        ## [batch_size, num_tracks, 2] --> [batch_size, num_tracks, num_tracks-1, 2]
+        relative = relative_to_neighbours(obs)
 
         ## In case of 'occupancy' pooling
         if other_values is None:
@@ -270,29 +241,43 @@ class GridBasedPooling(torch.nn.Module):
         # if self.norm_pool:
         #     relative = self.normalize(relative, obs, past_obs)
 
+        ## Flatten: neighbours out of range go to an extra cell (removed below)
+        oi, range_mask = self.cell_index(relative)
+        num_cells = (self.n * self.pool_size) ** 2
+        oi = torch.where(range_mask, oi, torch.full_like(oi, num_cells))
+        oi = oi.view(batch_size * num_tracks, num_tracks-1)
+        other_values = other_values.reshape(batch_size * num_tracks, num_tracks-1, -1)
+
+        ## Fill occupancy map with attributes
+        if self.reduce == 'sum':
+            occ = self.cell_sum(oi, other_values, num_cells)
+        else:
+            occ = self.cell_last(oi, other_values, num_cells)
+        return self.pool_cells(occ[:, :num_cells])
+
+    def cell_index(self, relative):
+        """Flat grid cell of each neighbour
+        relative: Tensor [..., 2]
+            Relative positions of the neighbours
+        Returns oi: LongTensor [...] and range_mask: BoolTensor [...] (False if out of the grid)
+        """
+        grid_size = self.n * self.pool_size
         if self.front:
-            oij = (relative / (self.cell_side / self.pool_size) + torch.Tensor([self.n * self.pool_size / 2, 0]))
+            oij = (relative / (self.cell_side / self.pool_size) + relative.new_tensor([grid_size / 2, 0]))
         else:
-            oij = (relative / (self.cell_side / self.pool_size) + self.n * self.pool_size / 2)
-
-        range_violations = torch.sum((oij < 0) + (oij >= self.n * self.pool_size), dim=-1)
-        range_mask = range_violations == 0
-
-        oij[~range_mask] = 0
-        other_values[~range_mask] = self.constant
-        other_values = other_values.view(batch_size * num_tracks, num_tracks-1, -1)
+            oij = (relative / (self.cell_side / self.pool_size) + grid_size / 2)
+        range_mask = ((oij >= 0) & (oij < grid_size)).all(dim=-1)
         oij = oij.long()
+        return oij[..., 0] * grid_size + oij[..., 1], range_mask
 
-        ## Flatten
-        oi = oij[:, :, :, 0] * self.n * self.pool_size + oij[:, :, :, 1]
-        oi = oi.view(batch_size * num_tracks, -1)
-        # faster occupancy
-        occ = self.constant*torch.ones(batch_size * num_tracks, self.n**2 * self.pool_size**2, self.pooling_dim, device=obs.device)
-
-        ## Fill occupancy map with attributes
-        occ[torch.arange(occ.size(0)).unsqueeze(1), oi] = other_values
+    def pool_cells(self, occ):
+        """Blurs and pools the filled cells
+        occ: Tensor [num_grids, num_cells, pooling_dim]
+        Returns grid: Tensor [num_grids, pooling_dim, self.n, self.n]
+        """
+        grid_size = self.n * self.pool_size
         occ = torch.transpose(occ, 1, 2)
-        occ_2d = occ.view(batch_size * num_tracks, -1, self.n * self.pool_size, self.n * self.pool_size)
+        occ_2d = occ.reshape(occ.size(0), -1, grid_size, grid_size)
 
         if self.blur_size == 1:
             occ_blurred = occ_2d
@@ -304,6 +289,36 @@ class GridBasedPooling(torch.nn.Module):
         # occ_summed = torch.nn.functional.avg_pool2d(occ_blurred, self.pool_size)  # faster?
         return occ_summed
 
+    def cell_sum(self, oi, values, num_cells):
+        """Sum of the values of the neighbours in each cell (self.constant if empty)
+        oi: Tensor [batch_size * num_tracks, num_tracks-1]
+            Cell of each neighbour (num_cells if out of the grid)
+        values: Tensor [batch_size * num_tracks, num_tracks-1, pooling_dim]
+        Returns occ: Tensor [batch_size * num_tracks, num_cells + 1, pooling_dim]
+        """
+        index = oi.unsqueeze(-1).expand_as(values)
+        occ = values.new_zeros(oi.size(0), num_cells + 1, values.size(-1)).scatter_add(1, index, values)
+        if self.constant != 0:
+            count = values.new_zeros(oi.size(0), num_cells + 1, 1).scatter_add(1, oi.unsqueeze(-1), torch.ones_like(values[..., :1]))
+            occ = torch.where(count > 0, occ, torch.full_like(occ, self.constant))
+        return occ
+
+    def cell_last(self, oi, values, num_cells):
+        """Value of the last neighbour in each cell (self.constant if empty)
+        See cell_sum for the arguments
+        """
+        ## Only the last neighbour of each cell is written (deterministic scatter)
+        sorted_oi, order = torch.sort(oi, dim=-1, stable=True)
+        is_last = torch.cat([sorted_oi[:, 1:] != sorted_oi[:, :-1],
+                             torch.ones_like(sorted_oi[:, :1], dtype=torch.bool)], dim=-1)
+        is_last = torch.zeros_like(is_last).scatter(-1, order, is_last)
+        oi = torch.where(is_last, oi, torch.full_like(oi, num_cells))
+
+        index = oi.unsqueeze(-1).expand_as(values)
+        occ = torch.full((oi.size(0), num_cells + 1, values.size(-1)), float(self.constant),
+                         dtype=values.dtype, device=values.device)
+        return occ.scatter(1, index, values)
+
     ## Architectures of Encoding Grid
     def one_layer(self, input_dim=None):
         if input_dim is None:
@@ -346,37 +361,21 @@ class GridBasedPooling(torch.nn.Module):
         self.track_mask = None
         if self.embedding_arch == 'lstm_layer':
             self.hidden_cell_state = (
-                [torch.zeros(self.hidden_dim, device=device) for _ in range(num_tracks)],
-                [torch.zeros(self.hidden_dim, device=device) for _ in range(num_tracks)],
+                torch.zeros(num_tracks, self.hidden_dim, device=device),
+                torch.zeros(num_tracks, self.hidden_dim, device=device),
             )
 
-    def lstm_forward(self, grid):
-        """ Forward process for LSTM-based grid encoding"""
+    def lstm_forward(self, grid, track_mask):
+        """ Forward process for LSTM-based grid encoding
+        grid: Tensor [num_tracks, self.n * self.n * self.pooling_dim]
+        track_mask: Bool [num_tracks]
+            Tracks visible at the current time-step (the state of the others is kept)
+        """
         grid_embedding = self.embedding(grid)
 
-        num_tracks = grid.size(0)
-        ## If only primary pedestrian of the scene present
-        if torch.sum(self.track_mask).item() == 1:
-            return torch.zeros(num_tracks, self.out_dim, device=grid.device)
-
-        hidden_cell_stacked = [
-            torch.stack([h for m, h in zip(self.track_mask, self.hidden_cell_state[0]) if m], dim=0),
-            torch.stack([c for m, c in zip(self.track_mask, self.hidden_cell_state[1]) if m], dim=0),
-        ]
-
         ## Update interaction-encoder LSTM
-        hidden_cell_stacked = self.pool_lstm(grid_embedding, hidden_cell_stacked)
-        interaction_vector = self.hidden2pool(hidden_cell_stacked[0])
-
-        ## Save hidden-cell-states
-        mask_index = [i for i, m in enumerate(self.track_mask) if m]
-        for i, h, c in zip(mask_index,
-                           hidden_cell_stacked[0],
-                           hidden_cell_stacked[1]):
-            self.hidden_cell_state[0][i] = h
-            self.hidden_cell_state[1][i] = c
-
-        return interaction_vector
+        self.hidden_cell_state = masked_lstm_step(self.pool_lstm, grid_embedding, self.hidden_cell_state, track_mask)
+        return self.hidden2pool(self.hidden_cell_state[0])
 
     def make_grid(self, obs):
         """ Make the grids for all time-steps together 
@@ -70,16 +70,7 @@ class PredictionLoss(torch.nn.Module):
         ## Loss calculation
         inputs = inputs.reshape(-1, 5)
         targets = targets.reshape(-1, 2)
-        inputs_bg = inputs.clone()
-        inputs_bg[:, 2] = 3.0  # sigma_x
-        inputs_bg[:, 3] = 3.0  # sigma_y
-        inputs_bg[:, 4] = 0.0  # rho
-
-        values = -torch.log(
-            0.01 +
-            self.background_rate * self.gaussian_2d(inputs_bg, targets) +
-            (0.99 - self.background_rate) * self.gaussian_2d(inputs, targets)
-        )
+        values = GaussianMixtureNLL.apply(inputs, targets, self.background_rate)
 
         ## Used in variety loss (SGAN)
         if self.keep_batch_dim:
@@ -90,6 +81,81 @@ class PredictionLoss(torch.nn.Module):
             return torch.mean(values) * self.loss_multiplier + col_loss * self.loss_multiplier
         return (torch.mean(values) * self.loss_multiplier)
 
+class GaussianMixtureNLL(torch.autograd.Function):
+    """Negative log-likelihood of PredictionLoss in a single pass.
+
+    -log(0.01 + rate * N(x|mu, 3.0) + (0.99 - rate) * N(x|mu, sigma))
+
+    The three terms are combined in log-space with logsumexp and the
+    gradients are computed analytically (no clone of the inputs, no
+    intermediate densities kept for autograd).
+
+    inputs : Tensor [num_samples, 5] (mu1, mu2, s1, s2, rho)
+    targets : Tensor [num_samples, 2]
+    output : Tensor [num_samples]
+    """
+    background_sigma = 3.0
+
+    @staticmethod
+    def _log_terms(inputs, targets, background_rate):
+        mu1, mu2, s1, s2, rho = inputs.unbind(1)
+        norm1 = targets[:, 0] - mu1
+        norm2 = targets[:, 1] - mu2
+        u1, u2 = norm1 / s1, norm2 / s2
+        one_minus_rho2 = 1 - rho ** 2
+        z = u1 ** 2 + u2 ** 2 - 2 * rho * u1 * u2
+
+        ## log N(x|mu, sigma) and log N(x|mu, 3.0), weighted
+        sigma_bg_2 = GaussianMixtureNLL.background_sigma ** 2
+        log_fg = (-z / (2 * one_minus_rho2) - math.log(2 * math.pi)
+                  - torch.log(s1) - torch.log(s2) - 0.5 * torch.log(one_minus_rho2))
+        log_bg = -(norm1 ** 2 + norm2 ** 2) / (2 * sigma_bg_2) - math.log(2 * math.pi * sigma_bg_2)
+        log_fg = log_fg + _log_weight(0.99 - background_rate)
+        log_bg = log_bg + _log_weight(background_rate)
+        return log_fg, log_bg, (norm1, norm2, u1, u2, s1, s2, rho, one_minus_rho2, z)
+
+    @staticmethod
+    def forward(ctx, inputs, targets, background_rate):
+        log_fg, log_bg, _ = GaussianMixtureNLL._log_terms(inputs, targets, background_rate)
+        log_floor = torch.full_like(log_fg, math.log(0.01))
+        values = -torch.logsumexp(torch.stack([log_floor, log_bg, log_fg]), dim=0)
+        ctx.save_for_backward(inputs, targets, values)
+        ctx.background_rate = background_rate
+        return values
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_values):
+        inputs, targets, values = ctx.saved_tensors
+        log_fg, log_bg, intermediates = GaussianMixtureNLL._log_terms(inputs, targets, ctx.background_rate)
+        norm1, norm2, u1, u2, s1, s2, rho, one_minus_rho2, z = intermediates
+
+        ## Posterior weights of the two Gaussians, scaled by the upstream gradient
+        w_fg = -torch.exp(log_fg + values) * grad_values
+        w_bg = -torch.exp(log_bg + values) * grad_values
+
+        ## d log N / d params
+        a1 = (u1 - rho * u2) / one_minus_rho2
+        a2 = (u2 - rho * u1) / one_minus_rho2
+        sigma_bg_2 = GaussianMixtureNLL.background_sigma ** 2
+        grad_mu1 = w_fg * a1 / s1 + w_bg * norm1 / sigma_bg_2
+        grad_mu2 = w_fg * a2 / s2 + w_bg * norm2 / sigma_bg_2
+        grad_s1 = w_fg * (u1 * a1 - 1) / s1
+        grad_s2 = w_fg * (u2 * a2 - 1) / s2
+        grad_rho = w_fg * (u1 * u2 - z * rho / one_minus_rho2 + rho) / one_minus_rho2
+
+        grad_inputs = grad_targets = None
+        if ctx.needs_input_grad[0]:
+            grad_inputs = torch.stack([grad_mu1, grad_mu2, grad_s1, grad_s2, grad_rho], dim=1)
+        if ctx.needs_input_grad[1]:
+            grad_targets = -torch.stack([grad_mu1, grad_mu2], dim=1)
+        return grad_inputs, grad_targets, None
+
+
+def _log_weight(weight):
+    return math.log(weight) if weight > 0 else -math.inf
+
+
 class L2Loss(torch.nn.Module):
     """L2 Loss (deterministic version of PredictionLoss)
 
@@ -9,39 +9,102 @@ import trajnetplusplustools
 from .modules import Hidden2Normal, InputEmbedding
 
 from .. import augmentation
+from ..preprocess import drop_distant
 from .utils import center_scene
 
 NAN = float('nan')
 
-def drop_distant(xy, r=6.0):
-    """
-    Drops pedestrians more than r meters away from primary ped
+
+def pooling_scatter_index(batch_split, device=None):
+    """ Index of every track in the padded [batch_size, max # neighbor] pooling layout
+
+    Built once per batch and shared by all timesteps (see generate_pooling_inputs).
+
+    Parameters
+    ----------
+    batch_split : Tensor [batch_size + 1]
+        Tensor defining the split of the batch.
+    device : torch.device, optional
+        Device of the returned index (defaults to the device of batch_split)
+
+    Returns
+    -------
+    scatter_index : tuple (index, batch_size, max_num_neighbor)
+        index : Tensor [num_tracks]
+            Flat position of every track in the [batch_size * max_num_neighbor] layout
     """
-    distance_2 = np.sum(np.square(xy - xy[:, 0:1]), axis=2)
-    mask = np.nanmin(distance_2, axis=0) < r**2
-    return xy[:, mask], mask
-
-
-def generate_pooling_inputs(obs2, obs1, hidden_cell_state, track_mask, batch_split):
-    hidden_states_to_pool = torch.stack(hidden_cell_state[0]).clone() # detach?
-    hidden_dim = hidden_states_to_pool.size(-1)
-    # tensor for pooling; filled with nan-mask [bs, max # neighbor, 2]
-    max_num_neighbor = (batch_split[1:] - batch_split[:-1]).max()   # number of agents in a scene minus the primary
-    batch_size = len(batch_split) - 1
-    curr_positions = torch.empty(batch_size, max_num_neighbor, 2).fill_(float('nan')).to(obs1.device) # placeholder
-    prev_positions = torch.empty(batch_size, max_num_neighbor, 2).fill_(float('nan')).to(obs1.device) # placeholder
-    curr_hidden_state = torch.empty(batch_size, max_num_neighbor, hidden_dim).fill_(float('nan')).to(obs1.device) # placeholder
-    track_mask_positions = torch.empty(batch_size, max_num_neighbor).fill_(False).bool().to(obs1.device)  # placeholder
-
-    for i in range(batch_size):
-        curr_positions[i, :batch_split[i+1]-batch_split[i]] = obs2[batch_split[i]:batch_split[i+1]]
-        prev_positions[i, :batch_split[i+1]-batch_split[i]] = obs1[batch_split[i]:batch_split[i+1]]
-        curr_hidden_state[i, :batch_split[i+1]-batch_split[i]] = hidden_states_to_pool[batch_split[i]:batch_split[i+1]]
-        track_mask_positions[i, :batch_split[i+1]-batch_split[i]] = track_mask[batch_split[i]:batch_split[i+1]].bool()
+    if device is None:
+        device = batch_split.device
+    batch_split = batch_split.to(device)
+    num_neighbors = batch_split[1:] - batch_split[:-1]
+    batch_size = len(num_neighbors)
+    max_num_neighbor = int(num_neighbors.max())   # number of agents in a scene minus the primary
+    scene_index = torch.repeat_interleave(torch.arange(batch_size, device=device), num_neighbors)
+    track_index = torch.arange(int(batch_split[-1]), device=device)
+    index = scene_index * max_num_neighbor + track_index - batch_split[:-1][scene_index]
+    return index, batch_size, max_num_neighbor
+
+
+def generate_pooling_inputs(obs2, obs1, hidden_cell_state, track_mask, batch_split, scatter_index=None):
+    if isinstance(hidden_cell_state[0], torch.Tensor):
+        hidden_states_to_pool = hidden_cell_state[0]
+    else:
+        hidden_states_to_pool = torch.stack(hidden_cell_state[0])
+    if scatter_index is None:
+        scatter_index = pooling_scatter_index(batch_split, device=obs1.device)
+    index, batch_size, max_num_neighbor = scatter_index
+
+    def scatter(values, fill_value):
+        # tensor for pooling; filled with nan-mask [bs, max # neighbor, ...]
+        padded = values.new_full((batch_size * max_num_neighbor,) + values.shape[1:], fill_value)
+        padded = padded.index_put((index,), values)
+        return padded.view((batch_size, max_num_neighbor) + values.shape[1:])
+
+    curr_positions = scatter(obs2, float('nan'))
+    prev_positions = scatter(obs1, float('nan'))
+    curr_hidden_state = scatter(hidden_states_to_pool, float('nan'))
+    track_mask_positions = scatter(track_mask.bool(), False)
 
     return curr_positions, prev_positions, curr_hidden_state, track_mask_positions
 
 
+def repeat_batch_split(batch_split, num_tracks, modes):
+    """ Batch split of `modes` copies of the batch stacked along the track dimension
+
+    Parameters
+    ----------
+    batch_split : Tensor [batch_size + 1]
+        Tensor defining the split of the batch.
+    num_tracks : int
+        Number of tracks in the batch
+    modes : int
+        Number of copies
+
+    Returns
+    -------
+    batch_split : Tensor [modes * batch_size + 1]
+    """
+    offsets = torch.arange(modes, device=batch_split.device) * num_tracks
+    starts = (batch_split[:-1].unsqueeze(0) + offsets.unsqueeze(1)).view(-1)
+    return torch.cat([starts, starts.new_tensor([modes * num_tracks])])
+
+
+def repeat_pooling_state(pool, modes):
+    """ Tile the recurrent state of the interaction encoder (if any) for `modes`
+    copies of the batch. The state is laid out per padded scene slot, so the
+    copies are simply concatenated. """
+    state = getattr(pool, 'hidden_cell_state', None)
+    if state is None:
+        return
+
+    def repeat(s):
+        if torch.is_tensor(s):
+            return s.repeat(modes, *([1] * (s.dim() - 1)))
+        return list(s) * modes
+
+    pool.hidden_cell_state = type(state)(repeat(s) for s in state)
+
+
 class LSTM(torch.nn.Module):
     def __init__(self, embedding_dim=64, hidden_dim=128, pool=None, pool_to_input=True, goal_dim=None, goal_flag=False):
         """ Initialize the LSTM forecasting model
@@ -88,7 +151,7 @@ class LSTM(torch.nn.Module):
         # mu_vel_x, mu_vel_y, sigma_vel_x, sigma_vel_y, rho
         self.hidden2normal = Hidden2Normal(self.hidden_dim)
 
-    def step(self, lstm, hidden_cell_state, obs1, obs2, goals, batch_split):
+    def step(self, lstm, hidden_cell_state, obs1, obs2, goals, batch_split, scatter_index=None):
         """Do one step of prediction: two inputs to one normal prediction.
         
         Parameters
@@ -96,13 +159,18 @@ class LSTM(torch.nn.Module):
         lstm: torch nn module [Encoder / Decoder]
             The module responsible for prediction
         hidden_cell_state : tuple (hidden_state, cell_state)
-            Current hidden_cell_state of the pedestrians
+            Current hidden_cell_state of the pedestrians.
+            Each element is a Tensor [num_tracks, hidden_dim]
         obs1 : Tensor [num_tracks, 2]
             Previous x-y positions of the pedestrians
         obs2 : Tensor [num_tracks, 2]
             Current x-y positions of the pedestrians
         goals : Tensor [num_tracks, 2]
             Goal coordinates of the pedestrians
+        batch_split : Tensor [batch_size + 1]
+            Tensor defining the split of the batch.
+        scatter_index : tuple, optional
+            Precomputed output of pooling_scatter_index(batch_split)
         
         Returns
         -------
@@ -119,8 +187,8 @@ class LSTM(torch.nn.Module):
 
         ## Masked Hidden Cell State
         hidden_cell_stacked = [
-            torch.stack([h for m, h in zip(track_mask, hidden_cell_state[0]) if m], dim=0),
-            torch.stack([c for m, c in zip(track_mask, hidden_cell_state[1]) if m], dim=0),
+            hidden_cell_state[0][track_mask],
+            hidden_cell_state[1][track_mask],
         ]
 
         ## Mask current velocity & embed
@@ -141,7 +209,7 @@ class LSTM(torch.nn.Module):
         ## Mask & Pool per scene
         if self.pool is not None:
             curr_positions, prev_positions, curr_hidden_state, track_mask_positions = \
-                generate_pooling_inputs(obs2, obs1, hidden_cell_state, track_mask, batch_split)
+                generate_pooling_inputs(obs2, obs1, hidden_cell_state, track_mask, batch_split, scatter_index)
             pool_sample = self.pool(curr_hidden_state, prev_positions, curr_positions)
             pooled = pool_sample[track_mask_positions.view(-1)]
 
@@ -155,15 +223,14 @@ class LSTM(torch.nn.Module):
         normal_masked = self.hidden2normal(hidden_cell_stacked[0])
 
         # unmask [Update hidden-states and next velocities of pedestrians]
+        # Out-of-place index_put: the hidden-cell-states of absent pedestrians
+        # are carried over unchanged and remain part of the backprop graph.
+        hidden_cell_state = (
+            hidden_cell_state[0].index_put((track_mask,), hidden_cell_stacked[0]),
+            hidden_cell_state[1].index_put((track_mask,), hidden_cell_stacked[1]),
+        )
         normal = torch.full((track_mask.size(0), 5), NAN, device=obs1.device)
-        mask_index = [i for i, m in enumerate(track_mask) if m]
-        for i, h, c, n in zip(mask_index,
-                              hidden_cell_stacked[0],
-                              hidden_cell_stacked[1],
-                              normal_masked):
-            hidden_cell_state[0][i] = h
-            hidden_cell_state[1][i] = c
-            normal[i] = n
+        normal = normal.index_put((track_mask,), normal_masked)
 
         return hidden_cell_state, normal
 
@@ -199,14 +266,13 @@ class LSTM(torch.nn.Module):
             # -1 because one prediction is done by the encoder already
             prediction_truth = [None for _ in range(n_predict - 1)]
 
-        # initialize: Because of tracks with different lengths and the masked
-        # update, the hidden state for every LSTM needs to be a separate object
-        # in the backprop graph. Therefore: list of hidden states instead of
-        # a single higher rank Tensor.
+        # initialize: hidden-cell-states of all tracks as single [num_tracks, hidden_dim]
+        # Tensors. Tracks with different lengths are handled by the masked
+        # (out-of-place) update in self.step.
         num_tracks = observed.size(1)
         hidden_cell_state = (
-            [torch.zeros(self.hidden_dim, device=observed.device) for _ in range(num_tracks)],
-            [torch.zeros(self.hidden_dim, device=observed.device) for _ in range(num_tracks)],
+            torch.zeros(num_tracks, self.hidden_dim, device=observed.device),
+            torch.zeros(num_tracks, self.hidden_dim, device=observed.device),
         )
 
         ## Reset LSTMs of Interaction Encoders.
@@ -214,6 +280,10 @@ class LSTM(torch.nn.Module):
             max_num_neighbor = (batch_split[1:] - batch_split[:-1]).max() - 1
             batch_size = len(batch_split) - 1
             self.pool.reset(batch_size * (max_num_neighbor+1), max_num_neighbor, device=observed.device)
+            ## Padded pooling layout is shared by all timesteps
+            scatter_index = pooling_scatter_index(batch_split, device=observed.device)
+        else:
+            scatter_index = None
 
         # list of predictions
         normals = []  # predicted normal parameters for both phases
@@ -225,7 +295,7 @@ class LSTM(torch.nn.Module):
         # encoder
         for obs1, obs2 in zip(observed[:-1], observed[1:]):
             ##LSTM Step
-            hidden_cell_state, normal = self.step(self.encoder, hidden_cell_state, obs1, obs2, goals, batch_split)
+            hidden_cell_state, normal = self.step(self.encoder, hidden_cell_state, obs1, obs2, goals, batch_split, scatter_index)
 
             # concat predictions
             normals.append(normal)
@@ -237,18 +307,17 @@ class LSTM(torch.nn.Module):
         )))
 
         # decoder, predictions
+        primary_ids = batch_split[:-1]
         for obs1, obs2 in zip(prediction_truth[:-1], prediction_truth[1:]):
             if obs1 is None:
                 obs1 = positions[-2].detach()  # DETACH!!!
             else:
-                for primary_id in batch_split[:-1]:
-                    obs1[primary_id] = positions[-2][primary_id].detach()  # DETACH!!!
+                obs1[primary_ids] = positions[-2][primary_ids].detach()  # DETACH!!!
             if obs2 is None:
                 obs2 = positions[-1].detach()
             else:
-                for primary_id in batch_split[:-1]:
-                    obs2[primary_id] = positions[-1][primary_id].detach()  # DETACH!!!
-            hidden_cell_state, normal = self.step(self.decoder, hidden_cell_state, obs1, obs2, goals, batch_split)
+                obs2[primary_ids] = positions[-1][primary_ids].detach()  # DETACH!!!
+            hidden_cell_state, normal = self.step(self.decoder, hidden_cell_state, obs1, obs2, goals, batch_split, scatter_index)
 
             # concat predictions
             normals.append(normal)
@@ -283,31 +352,63 @@ class LSTMPredictor(object):
 
 
     def __call__(self, paths, scene_goal, n_predict=12, modes=1, predict_all=True, obs_length=9, start_length=0, args=None):
+        return self.predict_batch([paths], [scene_goal], n_predict=n_predict, modes=modes, obs_length=obs_length,
+                                  start_length=start_length, args=args)[0]
+
+    def predict_batch(self, scenes, scene_goals, n_predict=12, modes=1, obs_length=9, start_length=0,
+                      batch_size=64, args=None):
+        """ Predicts multiple scenes, batch_size scenes per forward pass
+
+        Parameters
+        ----------
+        scenes : List of paths
+            Test scenes (list of paths for each scene)
+        scene_goals : List of Array [num_tracks, 2]
+            Goal coordinates of the pedestrians of each scene
+        batch_size : Int
+            Number of scenes packed into one batch_split
+
+        Returns
+        -------
+        predictions : List of Dictionaries
+            Dictionary of predictions of each scene. Each key corresponds to one mode
+        """
         self.model.eval()
         # self.model.train()
+        predictions = []
         with torch.no_grad():
-            xy = trajnetplusplustools.Reader.paths_to_xy(paths)
-            # xy = augmentation.add_noise(xy, thresh=args.thresh, ped=args.ped_type)
-            batch_split = [0, xy.shape[1]]
-
-            if args.normalize_scene:
-                xy, rotation, center, scene_goal = center_scene(xy, obs_length, goals=scene_goal)
-            
-            xy = torch.Tensor(xy)  #.to(self.device)
-            scene_goal = torch.Tensor(scene_goal) #.to(device)
-            batch_split = torch.Tensor(batch_split).long()
-
-            multimodal_outputs = {}
-            for num_p in range(modes):
-                # _, output_scenes = self.model(xy[start_length:obs_length], scene_goal, batch_split, xy[obs_length:-1].clone())
-                _, output_scenes = self.model(xy[start_length:obs_length], scene_goal, batch_split, n_predict=n_predict)
-                output_scenes = output_scenes.numpy()
-                if args.normalize_scene:
-                    output_scenes = augmentation.inverse_scene(output_scenes, rotation, center)
-                output_primary = output_scenes[-n_predict:, 0]
-                output_neighs = output_scenes[-n_predict:, 1:]
-                ## Dictionary of predictions. Each key corresponds to one mode
-                multimodal_outputs[num_p] = [output_primary, output_neighs]
-
-        ## Return Dictionary of predictions. Each key corresponds to one mode
-        return multimodal_outputs
+            for batch_start in range(0, len(scenes), batch_size):
+                batch_paths = scenes[batch_start:batch_start + batch_size]
+                batch_goals = scene_goals[batch_start:batch_start + batch_size]
+
+                batch_xy, batch_scene_goal, transforms = [], [], []
+                for paths, scene_goal in zip(batch_paths, batch_goals):
+                    xy = trajnetplusplustools.Reader.paths_to_xy(paths)
+                    # xy = augmentation.add_noise(xy, thresh=args.thresh, ped=args.ped_type)
+                    if args.normalize_scene:
+                        xy, rotation, center, scene_goal = center_scene(xy, obs_length, goals=scene_goal)
+                        transforms.append((rotation, center))
+                    batch_xy.append(xy[start_length:obs_length])
+                    batch_scene_goal.append(scene_goal)
+                batch_split = np.cumsum([0] + [xy.shape[1] for xy in batch_xy])
+
+                xy = torch.Tensor(np.concatenate(batch_xy, axis=1))  #.to(self.device)
+                scene_goal = torch.Tensor(np.concatenate(batch_scene_goal, axis=0)) #.to(device)
+                batch_split = torch.Tensor(batch_split).long()
+
+                batch_outputs = [{} for _ in batch_paths]
+                for num_p in range(modes):
+                    _, output_scenes = self.model(xy, scene_goal, batch_split, n_predict=n_predict)
+                    output_scenes = output_scenes.numpy()
+                    for scene_i, outputs in enumerate(batch_outputs):
+                        output_scene = output_scenes[:, batch_split[scene_i]:batch_split[scene_i+1]]
+                        if args.normalize_scene:
+                            output_scene = augmentation.inverse_scene(output_scene, *transforms[scene_i])
+                        output_primary = output_scene[-n_predict:, 0]
+                        output_neighs = output_scene[-n_predict:, 1:]
+                        ## Dictionary of predictions. Each key corresponds to one mode
+                        outputs[num_p] = [output_primary, output_neighs]
+                predictions += batch_outputs
+
+        ## Return Dictionary of predictions of each scene. Each key corresponds to one mode
+        return predictions
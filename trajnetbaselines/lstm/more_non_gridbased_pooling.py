@@ -2,6 +2,7 @@ from collections import defaultdict
 
 import torch
 
+
 class NMMP(torch.nn.Module):
     """ Interaction vector is obtained by message passing between
         hidden-state of all neighbours. Proposed in NMMP, CVPR 2020
@@ -35,45 +36,70 @@ class NMMP(torch.nn.Module):
         self.out_projection = torch.nn.Linear(mlp_dim, self.out_dim)
         self.k = k
 
-    def message_pass(self, node_embeddings):
-        # Perform a single iteration of message passing
-        n = node_embeddings.size(0)
-        arrange1 = node_embeddings.repeat(n, 1, 1) ## c
-        arrange2 = arrange1.transpose(0, 1) ## d
+    def message_pass(self, node_embeddings, visible):
+        """ Performs a single iteration of message passing in all scenes of the batch
+
+        Parameters
+        ----------
+        node_embeddings : Tensor [batch_size, num_tracks, mlp_dim]
+            Embeddings of all nodes
+        visible : Tensor [batch_size, num_tracks, 1]
+            1.0 for the nodes visible at the current time-step, 0.0 otherwise
+
+        Returns
+        -------
+        refined_embeddings : Tensor [batch_size, num_tracks, mlp_dim]
+        """
+        ## Mean embedding of the visible neighbours of each node (node itself excluded)
+        ## [batch_size, num_tracks, mlp_dim]
+        node_embeddings = node_embeddings * visible
+        num_neighbours = torch.sum(visible, dim=1, keepdim=True) - visible
+        neighbours = (torch.sum(node_embeddings, dim=1, keepdim=True) - node_embeddings) / num_neighbours.clamp(min=1)
 
+        ## The edge embedding is linear: the mean of the edge embeddings [node; neighbour]
+        ## is the embedding of [node; mean neighbour] (no [n, n, 2*mlp_dim] edge tensors)
         ## e_out
-        e_out_all = torch.cat([arrange2, arrange1], dim=2)
-        e_out_neighbours = e_out_all[~torch.eye(n).bool()].reshape(n, n-1, 2*self.mlp_dim)
-        e_out_edges = self.node_to_edge_embedding(e_out_neighbours)
-        e_out_sumpool = torch.mean(e_out_edges, dim=1)
+        e_out_sumpool = self.node_to_edge_embedding(torch.cat([node_embeddings, neighbours], dim=-1))
 
         ## e_in
-        e_in_all = torch.cat([arrange1, arrange2], dim=2)
-        e_in_neighbours = e_in_all[~torch.eye(n).bool()].reshape(n, n-1, 2*self.mlp_dim)
-        e_in_edges = self.node_to_edge_embedding(e_in_neighbours)
-        e_in_sumpool = torch.mean(e_in_edges, dim=1)
+        e_in_sumpool = self.node_to_edge_embedding(torch.cat([neighbours, node_embeddings], dim=-1))
 
         ## [e_in; e_out]
-        concat_nodes = torch.cat([e_in_sumpool, e_out_sumpool], dim=1)
+        concat_nodes = torch.cat([e_in_sumpool, e_out_sumpool], dim=-1)
 
         ## refined node
         refined_embeddings = self.edge_to_node_embedding(concat_nodes)
         return refined_embeddings
 
-    def reset(self, _, device):
+    def reset(self, num_tracks, max_num_neigh, device):
         self.track_mask = None
 
     def forward(self, hidden_states, _, obs2):
+        """ Forward function. All agents of a scene exchange messages
+
+        Parameters
+        ----------
+        hidden_states :  Tensor [batch_size, num_tracks, hidden_dim]
+            LSTM hidden state of all agents at current time-step t
+        obs2 :  Tensor [batch_size, num_tracks, 2]
+            x-y positions of all agents at current time-step t
 
-        ## If only primary present
-        num_tracks = obs2.size(0)
-        if num_tracks == 1:
-            return torch.zeros(1, self.out_dim, device=obs2.device)
+        Returns
+        -------
+        interaction_vector : Tensor [batch_size * num_tracks, self.out_dim]
+            interaction vector of all agents in the scene (zeros if no neighbour)
+        """
+        batch_size, num_tracks = obs2.size(0), obs2.size(1)
+        visible = (~torch.isnan(obs2).any(dim=-1, keepdim=True)).float()
 
         ## Embed hidden-state
-        node_embeddings = self.hidden_embedding(hidden_states)
+        node_embeddings = self.hidden_embedding(torch.nan_to_num(hidden_states))
         ## Iterative Message Passing
         for _ in range(self.k):
-            node_embeddings = self.message_pass(node_embeddings)
+            node_embeddings = self.message_pass(node_embeddings, visible)
 
-        return self.out_projection(node_embeddings)
+        ## If only primary present (no neighbour)
+        has_neighbours = torch.sum(visible, dim=1, keepdim=True) - visible > 0
+        interaction_vector = self.out_projection(node_embeddings)
+        interaction_vector = torch.where(has_neighbours, interaction_vector, torch.zeros_like(interaction_vector))
+        return interaction_vector.view(batch_size * num_tracks, -1)
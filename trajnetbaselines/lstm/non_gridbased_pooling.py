@@ -3,12 +3,8 @@ import numpy as np
 
 import torch
 
-def one_cold(i, n):
-    """Inverse one-hot encoding."""
-    x = torch.ones(n, dtype=torch.bool)
-    x[i] = 0
-    return x
-
+from .pooling_utils import nearest_neighbours, gather_tracks
+from .pooling_utils import visible_tracks, masked_lstm_step
 
 def rel_obs(obs):
     """ Provides relative position of neighbours wrt one another
@@ -17,8 +13,7 @@ def rel_obs(obs):
     relative : Tensor [batch_size, num_tracks, num_tracks, 2]
     """
     ## [batch_size, num_tracks, 2] --> [batch_size, num_tracks, num_tracks, 2]
-    unfolded = obs.unsqueeze(1).repeat(1, obs.size(1), 1, 1)
-    relative = unfolded - obs.unsqueeze(2)
+    relative = obs.unsqueeze(1) - obs.unsqueeze(2)
     return relative
 
 
@@ -32,22 +27,37 @@ def rel_directional(obs1, obs2):
     """
     ## Generate values to input in directional grid tensor (relative velocities in this case) 
     vel = obs2 - obs1
-    unfolded = vel.unsqueeze(1).repeat(1, vel.size(1), 1, 1)
     ## [batch_size, num_tracks, 2] --> [batch_size, num_tracks, num_tracks, 2]
-    relative = unfolded - vel.unsqueeze(2)
+    relative = vel.unsqueeze(1) - vel.unsqueeze(2)
     return relative
 
 
-def delete_diagonal(input, batch_size, num_tracks):
-    """ Deletes the effects of each pedestrian on itself.
-    input: Tensor [batch_size, num_tracks, num_tracks, 2]
-    output : Tensor [batch_size, num_tracks, num_tracks-1, 2]
+def nearest_neighbour_grid(obs1, obs2, n, no_velocity=False):
+    """ Relative positions (and velocities) of the n nearest neighbours of each pedestrian.
+    Only the attributes of the selected neighbours are gathered.
+    obs1 :  Tensor [batch_size, num_tracks, 2]
+        x-y positions of all agents at previous time-step t-1
+    obs2 :  Tensor [batch_size, num_tracks, 2]
+        x-y positions of all agents at current time-step t
+    nearest_grid : Tensor [batch_size, num_tracks, n, 2 or 4]
+        Nearest first, zeros for missing neighbours
     """
-    # mask: [batch_size, num_tracks, num_tracks]
-    mask = ~torch.eye(num_tracks).unsqueeze(0).repeat(batch_size, 1, 1).bool()
-    last_dim = input.size(-1)
-    # [batch_size, num_tracks, num_tracks, last_dim] --> [batch_size, num_tracks, num_tracks-1, last_dim]
-    return input[mask].reshape(batch_size, num_tracks, num_tracks-1, last_dim)
+    # Get nearest n neighours [batch_size, num_tracks, min(n, num_tracks-1)]
+    index = nearest_neighbours(obs2, n)
+
+    # Relative position (and velocity) of the selected neighbours
+    nearest_grid = gather_tracks(obs2, index) - obs2.unsqueeze(2)
+    if not no_velocity:
+        vel = obs2 - obs1
+        rel_direction = gather_tracks(vel, index) - vel.unsqueeze(2)
+        nearest_grid = torch.cat([nearest_grid, rel_direction], dim=-1)
+
+    # Zero-padding if fewer than n neighbours
+    if index.size(-1) < n:
+        nearest_grid = torch.nn.functional.pad(nearest_grid, (0, 0, 0, n - index.size(-1)))
+
+    # Remove NaNs
+    return torch.nan_to_num(nearest_grid)
 
 
 def embed_with_masking(embedding_module, input, out_dim, fill_value=-100):
@@ -111,36 +121,8 @@ class NearestNeighborMLP(torch.nn.Module):
         num_tracks = obs2.size(1)
         batch_size = obs2.size(0)
 
-        # Get relative position of all agents wrt one another 
-        # [batch_size, num_tracks, 2] --> [batch_size, num_tracks, num_tracks, 2]
-        rel_position = rel_obs(obs2)
-        ## Deleting Diagonal (Ped wrt itself)
-        ## [batch_size, num_tracks, num_tracks, 2] --> [batch_size, num_tracks, num_tracks-1, 2]
-        rel_position = delete_diagonal(rel_position, batch_size, num_tracks)
-
-        # Get relative velocities of all agents wrt one another 
-        # [batch_size, num_tracks, 2] --> [batch_size, num_tracks, num_tracks, 2]
-        rel_direction = rel_directional(obs1, obs2)
-        ## Deleting Diagonal (Ped wrt itself)
-        ## [batch_size, num_tracks, num_tracks, 2] --> [batch_size, num_tracks, num_tracks-1, 2]
-        rel_direction = delete_diagonal(rel_direction, batch_size, num_tracks)
-
-        # Combine [batch_size, num_tracks, num_tracks - 1, self.input_dim]
-        overall_grid = torch.cat([rel_position, rel_direction], dim=-1) if not self.no_velocity else rel_position
-
-        # Get nearest n neighours
-        rel_distance = torch.norm(rel_position, dim=-1)
-        rel_distance = torch.nan_to_num(rel_distance, nan=1000)  # High dummy distance
-        if (num_tracks - 1) < self.n:
-            nearest_grid = torch.zeros((batch_size, num_tracks, self.n, self.input_dim), device=obs2.device)
-            _, dist_index = torch.topk(-rel_distance, num_tracks-1, dim=-1)
-            nearest_grid[:, :, :(num_tracks-1)] = torch.gather(overall_grid, 2, dist_index.unsqueeze(-1).repeat(1, 1, 1, self.input_dim))
-        else:
-            _, dist_index = torch.topk(-rel_distance, self.n, dim=-1)
-            nearest_grid = torch.gather(overall_grid, 2, dist_index.unsqueeze(-1).repeat(1, 1, 1, self.input_dim))
-
-        # Remove NaNs
-        nearest_grid = torch.nan_to_num(nearest_grid)
+        # Attributes of the nearest n neighbours [batch_size, num_tracks, self.n, self.input_dim]
+        nearest_grid = nearest_neighbour_grid(obs1, obs2, self.n, self.no_velocity)
 
         ## Embed top-n relative neighbour attributes
         nearest_grid = self.embedding(nearest_grid)
@@ -224,7 +206,7 @@ class HiddenStateMLPPooling(torch.nn.Module):
             # [batch_size, num_tracks, hidden_dim] --> [batch_size, num_tracks, mlp_dim_hidden]
             hidden = embed_with_masking(self.hidden_embedding, hidden_states, self.mlp_dim_hidden)
             # [batch_size, num_tracks, mlp_dim_hidden] --> [batch_size, num_tracks, num_tracks, mlp_dim_hidden]
-            hidden_unfolded = hidden.unsqueeze(1).repeat(1, num_tracks, 1, 1)
+            hidden_unfolded = hidden.unsqueeze(1).expand(-1, num_tracks, -1, -1)
             embedded = torch.cat([embedded, hidden_unfolded], dim=-1)
 
         if self.mlp_dim_vel:
@@ -324,7 +306,7 @@ class AttentionMLPPooling(torch.nn.Module):
             # [batch_size, num_tracks, hidden_dim] --> [batch_size, num_tracks, mlp_dim_hidden]
             hidden = embed_with_masking(self.hidden_embedding, hidden_states, self.mlp_dim_hidden, fill_value=0)
             # [batch_size, num_tracks, mlp_dim_hidden] --> [batch_size, num_tracks, num_tracks, mlp_dim_hidden]
-            hidden_unfolded = hidden.unsqueeze(1).repeat(1, num_tracks, 1, 1)
+            hidden_unfolded = hidden.unsqueeze(1).expand(-1, num_tracks, -1, -1)
             embedded = torch.cat([embedded, hidden_unfolded], dim=-1)
 
         if self.mlp_dim_vel:
@@ -334,21 +316,23 @@ class AttentionMLPPooling(torch.nn.Module):
             directional = embed_with_masking(self.vel_embedding, rel_vel*4, self.mlp_dim_vel, self.fill_value)
             embedded = torch.cat([embedded, directional], dim=-1)
 
-        ## Attention
-        # [batch_size, num_tracks, num_tracks, mlp_dim] --> [batch_size * num_tracks, num_tracks, mlp_dim]
-        embedded = embedded.view(batch_size * num_tracks, num_tracks, -1)
-        # [batch, seq, mlp_dim] --> [seq, batch, mlp_dim]
-        embedded = embedded.transpose(0, 1)
-        query = self.wq(embedded)
+        ## Attention: one query per pedestrian (embedding wrt itself) over all its neighbours
+        # [batch_size, num_tracks, num_tracks, mlp_dim] --> [1, batch_size * num_tracks, mlp_dim]
+        query = torch.diagonal(embedded, dim1=1, dim2=2).transpose(1, 2).reshape(1, batch_size * num_tracks, -1)
+        # [batch_size, num_tracks, num_tracks, mlp_dim] --> [num_tracks, batch_size * num_tracks, mlp_dim]
+        embedded = embedded.view(batch_size * num_tracks, num_tracks, -1).transpose(0, 1)
+        query = self.wq(query)
         key = self.wk(embedded)
         value = self.wv(embedded)
-        attn_output, _ = self.multihead_attn(query, key, value)
 
-        # We need to select entries along diagonal of each scene; along the first axis.
-        attn_output = attn_output.transpose(0, 1)
-        attn_output = attn_output.reshape(batch_size, num_tracks, num_tracks, -1)
-        attn_output_ped = attn_output[torch.eye(num_tracks).bool().unsqueeze(0).repeat(batch_size, 1, 1)]
-        return self.out_projection(attn_output_ped)
+        ## Mask the neighbours that are not visible (padding), never the pedestrian itself
+        # [batch_size, num_tracks] --> [batch_size * num_tracks, num_tracks]
+        padding_mask = torch.isnan(obs2).any(dim=-1).unsqueeze(1)
+        padding_mask = padding_mask & ~torch.eye(num_tracks, dtype=torch.bool, device=obs2.device)
+        padding_mask = padding_mask.view(batch_size * num_tracks, num_tracks)
+
+        attn_output, _ = self.multihead_attn(query, key, value, key_padding_mask=padding_mask)
+        return self.out_projection(attn_output[0])
 
 
 class NearestNeighborLSTM(torch.nn.Module):
@@ -383,10 +367,10 @@ class NearestNeighborLSTM(torch.nn.Module):
         self.hidden2pool = torch.nn.Linear(hidden_dim, out_dim)
 
     def reset(self, num_tracks, max_num_neigh, device):
-        self.hidden_cell_state = [
-            [torch.zeros(self.hidden_dim, device=device) for _ in range(num_tracks)],
-            [torch.zeros(self.hidden_dim, device=device) for _ in range(num_tracks)],
-        ]
+        self.hidden_cell_state = (
+            torch.zeros(num_tracks, self.hidden_dim, device=device),
+            torch.zeros(num_tracks, self.hidden_dim, device=device),
+        )
 
     def forward(self, _, obs1, obs2):
         """ Forward function. All agents must belong to the same scene
@@ -407,52 +391,17 @@ class NearestNeighborLSTM(torch.nn.Module):
         batch_size = obs2.size(0)
         num_tracks = obs2.size(1)
 
-        hidden_cell_stacked = [
-            torch.stack(self.hidden_cell_state[0], dim=0),
-            torch.stack(self.hidden_cell_state[1], dim=0),
-        ]
-
-        # Get relative position of all agents wrt one another 
-        # [batch_size, num_tracks, 2] --> [batch_size, num_tracks, num_tracks, 2]
-        rel_position = rel_obs(obs2)
-        ## Deleting Diagonal (Ped wrt itself)
-        ## [batch_size, num_tracks, num_tracks, 2] --> [batch_size, num_tracks, num_tracks-1, 2]
-        rel_position = delete_diagonal(rel_position, batch_size, num_tracks)
+        # Attributes of the nearest n neighbours [batch_size, num_tracks, self.n, 4]
+        nearest_grid = nearest_neighbour_grid(obs1, obs2, self.n)
 
-        # Get relative velocities of all agents wrt one another 
-        # [batch_size, num_tracks, 2] --> [batch_size, num_tracks, num_tracks, 2]
-        rel_direction = rel_directional(obs1, obs2)
-        ## Deleting Diagonal (Ped wrt itself)
-        ## [batch_size, num_tracks, num_tracks, 2] --> [batch_size, num_tracks, num_tracks-1, 2]
-        rel_direction = delete_diagonal(rel_direction, batch_size, num_tracks)
-
-        # Combine [batch_size, num_tracks, num_tracks - 1, 4]
-        overall_grid = torch.cat([rel_position, rel_direction], dim=-1)
-
-        # Get nearest n neighours
-        rel_distance = torch.norm(rel_position, dim=-1)
-        rel_distance = torch.nan_to_num(rel_distance, nan=1000)  # High dummy distance
-        if (num_tracks - 1) < self.n:
-            nearest_grid = torch.zeros((batch_size, num_tracks, self.n, self.input_dim), device=obs2.device)
-            _, dist_index = torch.topk(-rel_distance, num_tracks-1, dim=-1)
-            nearest_grid[:, :, :(num_tracks-1)] = torch.gather(overall_grid, 2, dist_index.unsqueeze(-1).repeat(1, 1, 1, self.input_dim))
-        else:
-            _, dist_index = torch.topk(-rel_distance, self.n, dim=-1)
-            nearest_grid = torch.gather(overall_grid, 2, dist_index.unsqueeze(-1).repeat(1, 1, 1, self.input_dim))
-
-        # Remove NaNs
-        nearest_grid = torch.nan_to_num(nearest_grid)
         ## Embed top-n relative neighbour attributes
         nearest_grid = self.embedding(nearest_grid)
         nearest_grid = nearest_grid.view(batch_size * num_tracks, -1)
 
-        ## Update interaction-encoder LSTM
-        hidden_cell_stacked = self.pool_lstm(nearest_grid, hidden_cell_stacked)
-        interaction_vector = self.hidden2pool(hidden_cell_stacked[0])
-
-        self.hidden_cell_state[0] = list(hidden_cell_stacked[0])
-        self.hidden_cell_state[1] = list(hidden_cell_stacked[1])
-        return interaction_vector
+        ## Update interaction-encoder LSTM (only for visible tracks)
+        self.hidden_cell_state = masked_lstm_step(self.pool_lstm, nearest_grid, self.hidden_cell_state,
+                                                  visible_tracks(obs1, obs2))
+        return self.hidden2pool(self.hidden_cell_state[0])
 
 class TrajectronPooling(torch.nn.Module):
     """ Interaction vector is obtained by sum-pooling the absolute coordinates and passed
@@ -482,10 +431,10 @@ class TrajectronPooling(torch.nn.Module):
         self.track_mask = track_mask
 
     def reset(self, num_tracks, max_num_neigh, device):
-        self.hidden_cell_state = [
-            [torch.zeros(self.hidden_dim, device=device) for _ in range(num_tracks)],
-            [torch.zeros(self.hidden_dim, device=device) for _ in range(num_tracks)],
-        ]
+        self.hidden_cell_state = (
+            torch.zeros(num_tracks, self.hidden_dim, device=device),
+            torch.zeros(num_tracks, self.hidden_dim, device=device),
+        )
 
     def forward(self, _, obs1, obs2):
         """ Forward function. All agents must belong to the same scene
@@ -506,33 +455,25 @@ class TrajectronPooling(torch.nn.Module):
         batch_size = obs2.size(0)
         num_tracks = obs2.size(1)
 
-        hidden_cell_stacked = [
-            torch.stack(self.hidden_cell_state[0], dim=0),
-            torch.stack(self.hidden_cell_state[1], dim=0),
-        ]
-
         ## Construct Neighbour grid using current position and velocity (We need "relative" !)
         curr_vel = obs2 - obs1
         curr_pos = obs2
         states = torch.cat([curr_pos, curr_vel], dim=-1)
-        states = states.view(batch_size * num_tracks, -1)
 
         ## Only consider visible pedestrians
-        neigh_grid = torch.zeros(batch_size * num_tracks, self.out_dim, device=obs1.device)
-        nan_mask = torch.isnan(states).any(dim=-1)
-        states_vis = states[~nan_mask]
-        ## Get neighbour configuration embedding
-        neigh_grid_vis = torch.stack([
-            torch.cat([states_vis[i], torch.sum(states_vis[one_cold(i, len(states_vis))], dim=0)])
-            for i in range(len(states_vis))], dim=0)
-        neigh_grid_vis = self.embedding(neigh_grid_vis)
-        neigh_grid[~nan_mask] = neigh_grid_vis
+        nan_mask = torch.isnan(states).any(dim=-1, keepdim=True)
+        states = torch.where(nan_mask, torch.zeros_like(states), states)
 
-        ## Update interaction-encoder LSTM
-        hidden_cell_stacked = self.pool_lstm(neigh_grid, hidden_cell_stacked)
-        interaction_vector = self.hidden2pool(hidden_cell_stacked[0])
+        ## Sum of the states of the other pedestrians of the same scene (total - self)
+        # [batch_size, num_tracks, 4] --> [batch_size, num_tracks, 4]
+        neigh_states = torch.sum(states, dim=1, keepdim=True) - states
 
-        self.hidden_cell_state[0] = list(hidden_cell_stacked[0])
-        self.hidden_cell_state[1] = list(hidden_cell_stacked[1])
-
-        return interaction_vector
+        ## Get neighbour configuration embedding
+        neigh_grid = self.embedding(torch.cat([states, neigh_states], dim=-1))
+        neigh_grid = torch.where(nan_mask, torch.zeros_like(neigh_grid), neigh_grid)
+        neigh_grid = neigh_grid.view(batch_size * num_tracks, -1)
+
+        ## Update interaction-encoder LSTM (only for visible tracks)
+        self.hidden_cell_state = masked_lstm_step(self.pool_lstm, neigh_grid, self.hidden_cell_state,
+                                                  ~nan_mask.view(-1))
+        return self.hidden2pool(self.hidden_cell_state[0])
@@ -0,0 +1,77 @@
+import torch
+
+## Cache of off-diagonal indices per (num_tracks, device)
+_OFF_DIAGONAL_INDEX = {}
+
+
+def off_diagonal_index(num_tracks, device):
+    """ Index of the neighbours j != i of each pedestrian i (cached per num_tracks and device)
+    output : LongTensor [num_tracks, num_tracks-1]
+    """
+    key = (num_tracks, str(device))
+    if key not in _OFF_DIAGONAL_INDEX:
+        index = torch.arange(num_tracks, device=device).repeat(num_tracks, 1)
+        mask = ~torch.eye(num_tracks, dtype=torch.bool, device=device)
+        _OFF_DIAGONAL_INDEX[key] = index[mask].view(num_tracks, num_tracks-1)
+    return _OFF_DIAGONAL_INDEX[key]
+
+
+def neighbour_values(values):
+    """ Values of the neighbours of each pedestrian (Ped wrt itself excluded)
+    values : Tensor [batch_size, num_tracks, D]
+    output : Tensor [batch_size, num_tracks, num_tracks-1, D]
+    """
+    return values[:, off_diagonal_index(values.size(1), values.device)]
+
+
+def relative_to_neighbours(values):
+    """ Values of the neighbours relative to each pedestrian (e.g. relative positions)
+    values : Tensor [batch_size, num_tracks, D]
+    output : Tensor [batch_size, num_tracks, num_tracks-1, D]
+    """
+    return neighbour_values(values) - values.unsqueeze(2)
+
+
+def gather_tracks(values, index):
+    """ Values of the tracks given by index, in each scene
+    values : Tensor [batch_size, num_tracks, D]
+    index : LongTensor [batch_size, num_tracks, k]
+    output : Tensor [batch_size, num_tracks, k, D]
+    """
+    batch_index = torch.arange(values.size(0), device=values.device).view(-1, 1, 1)
+    return values[batch_index, index]
+
+
+def nearest_neighbours(obs, n):
+    """ Index of the n nearest neighbours of each pedestrian, nearest first (Ped wrt itself excluded)
+    Neighbours that are not visible come last.
+    obs : Tensor [batch_size, num_tracks, 2]
+    output : LongTensor [batch_size, num_tracks, min(n, num_tracks-1)]
+    """
+    batch_size, num_tracks = obs.size(0), obs.size(1)
+    rel_distance = torch.norm(relative_to_neighbours(obs), dim=-1)
+    rel_distance = torch.nan_to_num(rel_distance, nan=1000)  # High dummy distance
+    _, dist_index = torch.topk(-rel_distance, min(n, num_tracks-1), dim=-1)
+    index = off_diagonal_index(num_tracks, obs.device).unsqueeze(0).expand(batch_size, -1, -1)
+    return torch.gather(index, 2, dist_index)
+
+
+def visible_tracks(obs1, obs2):
+    """ Mask of the tracks visible at both time-steps
+    obs1, obs2 : Tensor [batch_size, num_tracks, 2]
+    output : Bool [batch_size * num_tracks]
+    """
+    return ~(torch.isnan(obs1) | torch.isnan(obs2)).any(dim=-1).view(-1)
+
+
+def masked_lstm_step(lstm, input, hidden_cell_state, mask):
+    """ One step of an interaction-encoder LSTMCell. The state of the tracks
+    not in mask (absent or padding) is kept as is.
+    input : Tensor [num_tracks, input_dim]
+    hidden_cell_state : (Tensor [num_tracks, hidden_dim], Tensor [num_tracks, hidden_dim])
+    mask : Bool [num_tracks]
+    """
+    hidden, cell = lstm(input, hidden_cell_state)
+    mask = mask.unsqueeze(-1)
+    return (torch.where(mask, hidden, hidden_cell_state[0]),
+            torch.where(mask, cell, hidden_cell_state[1]))
@@ -0,0 +1,288 @@
+""" Sparse backend of the interaction modules for large crowds
+
+The dense interaction modules embed all [batch_size, num_tracks, num_tracks] pairs of
+pedestrians. Here, the neighbours of each pedestrian are first found with a cell list
+(spatial hash of the positions) and only the pairs within a radius are embedded. The
+reductions (max-pooling, attention, top-n, grid filling) then run over the pairs of
+each pedestrian, gathered in a [batch_size * num_tracks, max # neighbours] layout.
+
+The sparse modules share the parameters of their dense counterpart. For the visible
+pedestrians, they give the same outputs as the dense modules when the radius covers
+all neighbours (the grid, for grid-based pooling). Only the visible neighbours are
+pooled: the dense hidden-state MLP module also pools the hidden states of the tracks
+of the scene that are not visible at the current time-step.
+"""
+import torch
+
+from .gridbased_pooling import GridBasedPooling
+from .non_gridbased_pooling import NearestNeighborMLP, HiddenStateMLPPooling, AttentionMLPPooling
+from .non_gridbased_pooling import embed_with_masking
+from .pooling_utils import visible_tracks
+
+## Neighbouring cells in the cell list
+_CELL_OFFSETS = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+
+
+def radius_neighbours(positions, radius=None, self_loops=False, exact=True):
+    """ Pairs of visible pedestrians of the same scene closer than radius
+
+    Parameters
+    ----------
+    positions : Tensor [batch_size, num_tracks, 2]
+        x-y positions of all agents (NaN if not visible)
+    radius : Scalar
+        Neighbourhood radius, also the cell size of the cell list.
+        All pairs of each scene are returned if None
+    self_loops : Bool
+        If True, each visible pedestrian is also its own neighbour
+    exact : Bool
+        If False, returns all the pairs of neighbouring cells (|dx|, |dy| <= radius)
+
+    Returns
+    -------
+    row, col : LongTensor [num_pairs]
+        Flat indices (in batch_size * num_tracks) of the pedestrians and of their neighbours.
+        The pairs are sorted by pedestrian, then by neighbour.
+    """
+    num_tracks = positions.size(1)
+    device = positions.device
+    positions = positions.reshape(-1, 2)
+    visible = torch.nonzero(~torch.isnan(positions).any(dim=-1)).view(-1)
+    if len(visible) == 0:
+        return visible, visible
+    positions = positions[visible]
+    scene = torch.div(visible, num_tracks, rounding_mode='floor')
+
+    ## Cell of each pedestrian (offset by one cell: neighbouring cells are non-negative)
+    if radius is None:
+        cell = torch.zeros_like(positions, dtype=torch.long)
+        offsets = [(0, 0)]
+    else:
+        cell = torch.floor(positions / radius).long()
+        cell = cell - cell.min(dim=0)[0] + 1
+        offsets = _CELL_OFFSETS
+    size = cell.max(dim=0)[0] + 2
+
+    def cell_hash(cell):
+        return (scene.view(-1, *([1] * (cell.dim() - 2))) * size[0] + cell[..., 0]) * size[1] + cell[..., 1]
+
+    ## Sort the pedestrians by cell
+    sorted_hash, order = torch.sort(cell_hash(cell))
+
+    ## [num_visible, 2] --> [num_visible, 9, 2] cells to search
+    neighbour_cells = cell.unsqueeze(1) + torch.tensor(offsets, device=device)
+    neighbour_hash = cell_hash(neighbour_cells).view(-1)
+    start = torch.searchsorted(sorted_hash, neighbour_hash)
+    count = torch.searchsorted(sorted_hash, neighbour_hash, right=True) - start
+
+    ## One pair per pedestrian of the searched cells
+    row = torch.arange(len(positions), device=device).repeat_interleave(len(offsets))
+    row = row.repeat_interleave(count)
+    first = torch.cumsum(count, dim=0) - count
+    col = order[(start - first).repeat_interleave(count) + torch.arange(len(row), device=device)]
+
+    keep = torch.ones_like(row, dtype=torch.bool) if self_loops else row != col
+    if exact and radius is not None:
+        keep = keep & (torch.sum((positions[col] - positions[row]) ** 2, dim=-1) <= radius ** 2)
+    row, col = visible[row[keep]], visible[col[keep]]
+
+    ## Sort by pedestrian, then by neighbour (same order as the dense modules)
+    order = torch.argsort(row * (visible[-1] + 1) + col)
+    return row[order], col[order]
+
+
+def pad_neighbours(values, row, num_rows, fill_value=0.0):
+    """ Gathers the values of the pairs of each pedestrian
+
+    Parameters
+    ----------
+    values : Tensor [num_pairs, ...]
+        Values of the pairs
+    row : LongTensor [num_pairs]
+        Pedestrian of each pair (sorted)
+    num_rows : Scalar
+        Number of pedestrians
+
+    Returns
+    -------
+    padded : Tensor [num_rows, max # neighbours, ...]
+        Values of the pairs of each pedestrian, filled with 'fill_value'
+    mask : Bool [num_rows, max # neighbours]
+        True for the slots of the pairs
+    """
+    count = torch.bincount(row, minlength=num_rows)
+    max_count = max(int(count.max()), 1) if len(row) else 1
+    slot = torch.arange(len(row), device=row.device) - (torch.cumsum(count, dim=0) - count)[row]
+    padded = values.new_full((num_rows, max_count) + values.shape[1:], fill_value)
+    padded = padded.index_put((row, slot), values)
+    mask = torch.arange(max_count, device=row.device).unsqueeze(0) < count.unsqueeze(1)
+    return padded, mask
+
+
+def pairwise(values, row, col):
+    """ Values of the neighbours relative to each pedestrian, for the pairs (row, col)
+    values : Tensor [batch_size, num_tracks, D]
+    output : Tensor [num_pairs, D]
+    """
+    values = values.reshape(-1, values.size(-1))
+    return values[col] - values[row]
+
+
+class SparseNearestNeighborMLP(NearestNeighborMLP):
+    """ NearestNeighborMLP selecting the top-n neighbours within 'radius' """
+    def __init__(self, radius=None, **kwargs):
+        super(SparseNearestNeighborMLP, self).__init__(**kwargs)
+        self.radius = radius
+
+    def forward(self, _, obs1, obs2):
+        num_rows = obs2.size(0) * obs2.size(1)
+        row, col = radius_neighbours(obs2, self.radius)
+
+        # Relative position and velocity of the pairs [num_pairs, self.input_dim]
+        rel_position = pairwise(obs2, row, col)
+        overall_grid = rel_position
+        if not self.no_velocity:
+            overall_grid = torch.cat([rel_position, pairwise(obs2 - obs1, row, col)], dim=-1)
+
+        # [num_pairs, .] --> [batch_size * num_tracks, max # neighbours, .]
+        overall_grid, _ = pad_neighbours(overall_grid, row, num_rows)
+        rel_distance, _ = pad_neighbours(torch.norm(rel_position, dim=-1), row, num_rows, fill_value=1000)
+
+        # Get nearest n neighours
+        num_neighbours = min(self.n, overall_grid.size(1))
+        nearest_grid = torch.zeros((num_rows, self.n, self.input_dim), device=obs2.device)
+        _, dist_index = torch.topk(-rel_distance, num_neighbours, dim=-1)
+        nearest_grid[:, :num_neighbours] = torch.gather(overall_grid, 1, dist_index.unsqueeze(-1).expand(-1, -1, self.input_dim))
+
+        # Remove NaNs
+        nearest_grid = torch.nan_to_num(nearest_grid)
+
+        ## Embed top-n relative neighbour attributes
+        nearest_grid = self.embedding(nearest_grid)
+        return nearest_grid.view(num_rows, -1)
+
+
+class SparseHiddenStateMLPPooling(HiddenStateMLPPooling):
+    """ HiddenStateMLPPooling max-pooling the neighbours within 'radius' """
+    def __init__(self, radius=None, **kwargs):
+        super(SparseHiddenStateMLPPooling, self).__init__(**kwargs)
+        self.radius = radius
+
+    def forward(self, hidden_states, obs1, obs2):
+        num_rows = obs2.size(0) * obs2.size(1)
+        row, col = radius_neighbours(obs2, self.radius, self_loops=True)
+
+        # Embed relative position of the pairs [num_pairs, mlp_dim_spatial]
+        embedded = self.spatial_embedding(pairwise(obs2, row, col))
+
+        if self.mlp_dim_hidden:
+            # Embed hidden states with proper masking, then gather the neighbours
+            hidden = embed_with_masking(self.hidden_embedding, hidden_states.reshape(num_rows, -1), self.mlp_dim_hidden)
+            embedded = torch.cat([embedded, hidden[col]], dim=-1)
+
+        if self.mlp_dim_vel:
+            # Embed relative velocity with proper masking
+            rel_vel = pairwise(obs2 - obs1, row, col)
+            directional = embed_with_masking(self.vel_embedding, rel_vel*4, self.mlp_dim_vel)
+            embedded = torch.cat([embedded, directional], dim=-1)
+
+        # Max Pool over the neighbours of each pedestrian
+        embedded, _ = pad_neighbours(embedded, row, num_rows, fill_value=-100)
+        pooled, _ = torch.max(embedded, dim=1)
+        return self.out_projection(pooled)
+
+
+class SparseAttentionMLPPooling(AttentionMLPPooling):
+    """ AttentionMLPPooling attending to the neighbours within 'radius' """
+    def __init__(self, radius=None, **kwargs):
+        super(SparseAttentionMLPPooling, self).__init__(**kwargs)
+        self.radius = radius
+
+    def forward(self, hidden_states, obs1, obs2):
+        num_rows = obs2.size(0) * obs2.size(1)
+        row, col = radius_neighbours(obs2, self.radius, self_loops=True)
+
+        # Embed relative position of the pairs [num_pairs, mlp_dim_spatial]
+        embedded = self.spatial_embedding(pairwise(obs2, row, col))
+
+        if self.mlp_dim_hidden:
+            # Embed hidden states with proper masking, then gather the neighbours
+            hidden = embed_with_masking(self.hidden_embedding, hidden_states.reshape(num_rows, -1), self.mlp_dim_hidden, fill_value=0)
+            embedded = torch.cat([embedded, hidden[col]], dim=-1)
+
+        if self.mlp_dim_vel:
+            # Embed relative velocity with proper masking
+            rel_vel = pairwise(obs2 - obs1, row, col)
+            directional = embed_with_masking(self.vel_embedding, rel_vel*4, self.mlp_dim_vel, self.fill_value)
+            embedded = torch.cat([embedded, directional], dim=-1)
+
+        ## Attention: each pedestrian (pair with itself) attends to its neighbours
+        is_self = row == col
+        query = embedded.new_zeros(num_rows, embedded.size(-1)).index_put((row[is_self],), embedded[is_self])
+        # [num_pairs, mlp_dim] --> [batch_size * num_tracks, max # neighbours, mlp_dim]
+        embedded, mask = pad_neighbours(embedded, row, num_rows)
+        ## Pedestrians that are not visible attend to an empty slot
+        mask[:, 0] = True
+        # [batch, seq, mlp_dim] --> [seq, batch, mlp_dim]
+        embedded = embedded.transpose(0, 1)
+        query = self.wq(query).unsqueeze(0)
+        key = self.wk(embedded)
+        value = self.wv(embedded)
+        attn_output, _ = self.multihead_attn(query, key, value, key_padding_mask=~mask)
+        return self.out_projection(attn_output[0])
+
+
+class SparseGridBasedPooling(GridBasedPooling):
+    """ GridBasedPooling filling the grid with the neighbours within 'radius'
+    (all the neighbours in the grid if None) """
+    def __init__(self, radius=None, **kwargs):
+        super(SparseGridBasedPooling, self).__init__(**kwargs)
+        self.radius = radius
+
+    def forward(self, hidden_state, obs1, obs2):
+        batch_size, num_tracks = obs1.size(0), obs1.size(1)
+        grid = self.sparse_occupancy(hidden_state, obs1, obs2)
+
+        ## Embed grid
+        grid = grid.reshape(batch_size * num_tracks, -1)
+        if self.embedding_arch == 'lstm_layer':
+            return self.lstm_forward(grid, visible_tracks(obs1, obs2))
+        if self.embedding:
+            return self.embedding(grid)
+        return grid
+
+    def sparse_occupancy(self, hidden_state, obs1, obs2):
+        """Returns the occupancy maps [num_tracks, self.pooling_dim, self.n, self.n] of the chosen type"""
+        num_rows = obs2.size(0) * obs2.size(1)
+
+        ## Candidate neighbours: the neighbouring cells of the cell list cover the grid
+        extent = self.n * self.cell_side if self.front else self.n * self.cell_side / 2
+        row, col = radius_neighbours(obs2, extent, exact=False)
+        relative = pairwise(obs2, row, col)
+        oi, keep = self.cell_index(relative)
+        if self.radius is not None:
+            keep = keep & (torch.sum(relative ** 2, dim=-1) <= self.radius ** 2)
+
+        ## Attributes of the neighbours to fill in the grid [num_pairs, self.pooling_dim]
+        if self.type_ == 'occupancy':
+            values = torch.ones(len(row), self.pooling_dim, device=obs2.device)
+        else:
+            values = []
+            if self.type_ in ('directional', 'dir_social'):
+                values.append(torch.nan_to_num(pairwise(obs2 - obs1, row, col)))
+            if self.type_ in ('social', 'dir_social'):
+                hidden_state_grid = self.hidden_dim_encoding(torch.nan_to_num(hidden_state))
+                values.append(hidden_state_grid.reshape(num_rows, -1)[col])
+            values = torch.cat(values, dim=-1)
+
+        ## Flatten: the cells of all the grids one after the other
+        num_cells = (self.n * self.pool_size) ** 2
+        oi = (row * num_cells + oi)[keep].unsqueeze(0)
+        values = values[keep].unsqueeze(0)
+
+        ## Fill occupancy maps with attributes
+        if self.reduce == 'sum':
+            occ = self.cell_sum(oi, values, num_rows * num_cells)
+        else:
+            occ = self.cell_last(oi, values, num_rows * num_cells)
+        return self.pool_cells(occ[0, :-1].view(num_rows, num_cells, -1))
@@ -9,27 +9,25 @@ import random
 import os
 import pickle
 import torch
-import numpy as np
 
-import trajnetplusplustools
-
-from .. import augmentation
 from .loss import PredictionLoss, L2Loss
-from .lstm import LSTM, LSTMPredictor, drop_distant
+from .lstm import LSTM, LSTMPredictor
 from .gridbased_pooling import GridBasedPooling
 from .non_gridbased_pooling import NearestNeighborMLP, HiddenStateMLPPooling, AttentionMLPPooling
 from .non_gridbased_pooling import NearestNeighborLSTM, TrajectronPooling
+from .sparse_pooling import SparseNearestNeighborMLP, SparseHiddenStateMLPPooling
+from .sparse_pooling import SparseAttentionMLPPooling, SparseGridBasedPooling
+from .more_non_gridbased_pooling import NMMP
 
 from .. import __version__ as VERSION
 
-from .utils import center_scene, random_rotation
-from .data_load_utils import prepare_data
+from .data_load_utils import prepare_data, SceneDataset, scene_loader
 
 class Trainer(object):
     def __init__(self, model=None, criterion=None, optimizer=None, lr_scheduler=None,
                  device=None, batch_size=8, obs_length=9, pred_length=12, augment=True,
                  normalize_scene=False, save_every=1, start_length=0, obs_dropout=False,
-                 augment_noise=False, val_flag=True):
+                 augment_noise=False, val_flag=True, num_workers=0, pin_memory=False, prefetch_factor=2, drop_distance=6.0):
         self.model = model if model is not None else LSTM()
         self.criterion = criterion if criterion is not None else PredictionLoss()
         self.optimizer = optimizer if optimizer is not None else \
@@ -57,6 +55,14 @@ class Trainer(object):
 
         self.val_flag = val_flag
 
+        ## Data loading
+        self.num_workers = num_workers
+        self.pin_memory = pin_memory
+        self.prefetch_factor = prefetch_factor
+
+        ## Preprocessing
+        self.drop_distance = drop_distance
+
     def loop(self, train_scenes, val_scenes, train_goals, val_goals, out, epochs=35, start_epoch=0):
         for epoch in range(start_epoch, epochs):
             if epoch % self.save_every == 0:
@@ -88,71 +94,36 @@ class Trainer(object):
         self.model.train()
         self.optimizer.zero_grad()
 
-        ## Initialize batch of scenes
-        batch_scene = []
-        batch_scene_goal = []
-        batch_split = [0]
+        ## Preprocess scenes in the background while training
+        dataset = SceneDataset(scenes, goals, obs_length=self.obs_length, normalize_scene=self.normalize_scene,
+                               augment=self.augment, augment_noise=self.augment_noise,
+                               drop_distance=self.drop_distance)
+        loader = scene_loader(dataset, batch_size=self.batch_size, num_workers=self.num_workers,
+                              pin_memory=self.pin_memory, prefetch_factor=self.prefetch_factor)
 
-        for scene_i, (filename, scene_id, paths) in enumerate(scenes):
-            scene_start = time.time()
+        scene_start = time.time()
+        for batch_i, (batch_scene, batch_scene_goal, batch_split) in enumerate(loader):
+            batch_scene = batch_scene.to(self.device, non_blocking=self.pin_memory)
+            batch_scene_goal = batch_scene_goal.to(self.device, non_blocking=self.pin_memory)
+            batch_split = batch_split.to(self.device)
+
+            preprocess_time = time.time() - scene_start
 
-            ## make new scene
-            scene = trajnetplusplustools.Reader.paths_to_xy(paths)
-
-            ## get goals
-            if goals is not None:
-                scene_goal = np.array(goals[filename][scene_id])
-            else:
-                scene_goal = np.array([[0, 0] for path in paths])
-
-            ## Drop Distant
-            scene, mask = drop_distant(scene)
-            scene_goal = scene_goal[mask]
-
-            ##process scene
-            if self.normalize_scene:
-                scene, _, _, scene_goal = center_scene(scene, self.obs_length, goals=scene_goal)
-            if self.augment:
-                scene, scene_goal = random_rotation(scene, goals=scene_goal)
-            if self.augment_noise:
-                scene = augmentation.add_noise(scene, thresh=0.02, ped='neigh')
-
-            ## Augment scene to batch of scenes
-            batch_scene.append(scene)
-            batch_split.append(int(scene.shape[1]))
-            batch_scene_goal.append(scene_goal)
-
-            if ((scene_i + 1) % self.batch_size == 0) or ((scene_i + 1) == len(scenes)):
-                ## Construct Batch
-                batch_scene = np.concatenate(batch_scene, axis=1)
-                batch_scene_goal = np.concatenate(batch_scene_goal, axis=0)
-                batch_split = np.cumsum(batch_split)
-                
-                batch_scene = torch.Tensor(batch_scene).to(self.device)
-                batch_scene_goal = torch.Tensor(batch_scene_goal).to(self.device)
-                batch_split = torch.Tensor(batch_split).to(self.device).long()
-
-                preprocess_time = time.time() - scene_start
-
-                ## Train Batch
-                loss = self.train_batch(batch_scene, batch_scene_goal, batch_split)
-                epoch_loss += loss
-                total_time = time.time() - scene_start
-
-                ## Reset Batch
-                batch_scene = []
-                batch_scene_goal = []
-                batch_split = [0]
-
-            if (scene_i + 1) % (10*self.batch_size) == 0:
+            ## Train Batch
+            loss = self.train_batch(batch_scene, batch_scene_goal, batch_split)
+            epoch_loss += loss
+            total_time = time.time() - scene_start
+
+            if (batch_i + 1) % 10 == 0:
                 self.log.info({
                     'type': 'train',
-                    'epoch': epoch, 'batch': scene_i, 'n_batches': len(scenes),
+                    'epoch': epoch, 'batch': (batch_i + 1) * self.batch_size - 1, 'n_batches': len(scenes),
                     'time': round(total_time, 3),
                     'data_time': round(preprocess_time, 3),
                     'lr': self.get_lr(),
                     'loss': round(loss, 3),
                 })
+            scene_start = time.time()
 
         self.lr_scheduler.step()
         self.log.info({
@@ -169,52 +140,19 @@ class Trainer(object):
         test_loss = 0.0
         self.model.train()
 
-        ## Initialize batch of scenes
-        batch_scene = []
-        batch_scene_goal = []
-        batch_split = [0]
-
-        for scene_i, (filename, scene_id, paths) in enumerate(scenes):
-            ## make new scene
-            scene = trajnetplusplustools.Reader.paths_to_xy(paths)
-
-            ## get goals
-            if goals is not None:
-                scene_goal = np.array(goals[filename][scene_id])
-            else:
-                scene_goal = np.array([[0, 0] for path in paths])
-
-            ## Drop Distant
-            scene, mask = drop_distant(scene)
-            scene_goal = scene_goal[mask]
-
-            ##process scene
-            if self.normalize_scene:
-                scene, _, _, scene_goal = center_scene(scene, self.obs_length, goals=scene_goal)
-
-            ## Augment scene to batch of scenes
-            batch_scene.append(scene)
-            batch_split.append(int(scene.shape[1]))
-            batch_scene_goal.append(scene_goal)
-
-            if ((scene_i + 1) % self.batch_size == 0) or ((scene_i + 1) == len(scenes)):
-                ## Construct Batch
-                batch_scene = np.concatenate(batch_scene, axis=1)
-                batch_scene_goal = np.concatenate(batch_scene_goal, axis=0)
-                batch_split = np.cumsum(batch_split)
-                
-                batch_scene = torch.Tensor(batch_scene).to(self.device)
-                batch_scene_goal = torch.Tensor(batch_scene_goal).to(self.device)
-                batch_split = torch.Tensor(batch_split).to(self.device).long()
-                
-                loss_val_batch, loss_test_batch = self.val_batch(batch_scene, batch_scene_goal, batch_split)
-                val_loss += loss_val_batch
-                test_loss += loss_test_batch
-
-                ## Reset Batch
-                batch_scene = []
-                batch_scene_goal = []
-                batch_split = [0]
+        dataset = SceneDataset(scenes, goals, obs_length=self.obs_length, normalize_scene=self.normalize_scene,
+                               drop_distance=self.drop_distance)
+        loader = scene_loader(dataset, batch_size=self.batch_size, num_workers=self.num_workers,
+                              pin_memory=self.pin_memory, prefetch_factor=self.prefetch_factor)
+
+        for batch_scene, batch_scene_goal, batch_split in loader:
+            batch_scene = batch_scene.to(self.device, non_blocking=self.pin_memory)
+            batch_scene_goal = batch_scene_goal.to(self.device, non_blocking=self.pin_memory)
+            batch_split = batch_split.to(self.device)
+
+            loss_val_batch, loss_test_batch = self.val_batch(batch_scene, batch_scene_goal, batch_split)
+            val_loss += loss_val_batch
+            test_loss += loss_test_batch
 
         eval_time = time.time() - eval_start
 
@@ -339,10 +277,20 @@ def main(epochs=25):
                         help='loss objective, L2 loss (L2) and Gaussian loss (pred)')
     parser.add_argument('--type', default='vanilla',
                         choices=('vanilla', 'occupancy', 'directional', 'social', 'hiddenstatemlp',
-                                 'nn', 'attentionmlp', 'nn_lstm', 'traj_pool'),
+                                 'nn', 'attentionmlp', 'nn_lstm', 'traj_pool', 'nmmp'),
                         help='type of interaction encoder')
     parser.add_argument('--sample', default=1.0, type=float,
                         help='sample ratio when loading train/val scenes')
+    parser.add_argument('--cache_data', action='store_true',
+                        help='compile train/val scenes once into a memory-mapped store')
+    parser.add_argument('--num_workers', default=0, type=int,
+                        help='number of DataLoader workers preprocessing the scenes')
+    parser.add_argument('--prefetch_factor', default=2, type=int,
+                        help='number of batches prefetched by each DataLoader worker')
+    parser.add_argument('--pin_memory', action='store_true',
+                        help='copy batches to pinned memory (faster host to GPU transfer)')
+    parser.add_argument('--drop_distance', default=6.0, type=float,
+                        help='pedestrians further than drop_distance (in m) from the primary pedestrian are dropped')
     parser.add_argument('--seed', type=int, default=42)
 
     ## Augmentations
@@ -386,6 +334,8 @@ def main(epochs=25):
                                  help='interaction encoding arch for gridbased pooling')
     hyperparameters.add_argument('--pool_constant', default=0, type=int,
                                  help='background value (when cell empty) of gridbased pooling')
+    hyperparameters.add_argument('--pool_reduce', default='last', choices=('last', 'sum'),
+                                 help='value of a cell with several neighbours in gridbased pooling (last or sum)')
     hyperparameters.add_argument('--norm_pool', action='store_true',
                                  help='normalize the scene along direction of movement during grid-based pooling')
     hyperparameters.add_argument('--front', action='store_true',
@@ -404,6 +354,11 @@ def main(epochs=25):
                                  help='embedding dimension for relative velocity')
     hyperparameters.add_argument('--neigh', default=4, type=int,
                                  help='number of nearest neighbours to consider')
+    hyperparameters.add_argument('--sparse_pool', action='store_true',
+                                 help='sparse interaction module: only embeds the pairs of neighbours within pool_radius')
+    hyperparameters.add_argument('--pool_radius', default=None, type=float,
+                                 help='neighbourhood radius (in m) of the sparse interaction module '
+                                      '(default: all neighbours, the grid for grid-based pooling)')
     hyperparameters.add_argument('--mp_iters', default=5, type=int,
                                  help='message passing iterations in NMMP')
 
@@ -413,6 +368,8 @@ def main(epochs=25):
     hyperparameters.add_argument('--col_distance', default=0.2, type=float,
                                  help='distance threshold post which collision occurs')
     args = parser.parse_args()
+    if args.sparse_pool and args.type in ('vanilla', 'nn_lstm', 'traj_pool', 'nmmp'):
+        parser.error('--sparse_pool is not available for --type {}'.format(args.type))
 
     ## Set seed for reproducibility
     torch.manual_seed(args.seed)
@@ -459,32 +416,43 @@ def main(epochs=25):
 
     args.path = 'DATA_BLOCK/' + args.path
     ## Prepare data
-    train_scenes, train_goals, _ = prepare_data(args.path, subset='/train/', sample=args.sample, goals=args.goals)
-    val_scenes, val_goals, val_flag = prepare_data(args.path, subset='/val/', sample=args.sample, goals=args.goals)
+    train_scenes, train_goals, _ = prepare_data(args.path, subset='/train/', sample=args.sample, goals=args.goals,
+                                                cache=args.cache_data)
+    val_scenes, val_goals, val_flag = prepare_data(args.path, subset='/val/', sample=args.sample, goals=args.goals,
+                                                   cache=args.cache_data)
 
     ## pretrained pool model (if any)
     pretrained_pool = None
 
     # create interaction/pooling modules
     pool = None
+    ## Sparse backend: only pool the neighbours within pool_radius (large crowds)
+    sparse_args = dict(radius=args.pool_radius) if args.sparse_pool else {}
     if args.type == 'hiddenstatemlp':
-        pool = HiddenStateMLPPooling(hidden_dim=args.hidden_dim, out_dim=args.pool_dim,
-                                     mlp_dim_vel=args.vel_dim)
+        pool_class = SparseHiddenStateMLPPooling if args.sparse_pool else HiddenStateMLPPooling
+        pool = pool_class(hidden_dim=args.hidden_dim, out_dim=args.pool_dim,
+                          mlp_dim_vel=args.vel_dim, **sparse_args)
     elif args.type == 'attentionmlp':
-        pool = AttentionMLPPooling(hidden_dim=args.hidden_dim, out_dim=args.pool_dim,
-                                   mlp_dim_spatial=args.spatial_dim, mlp_dim_vel=args.vel_dim)
+        pool_class = SparseAttentionMLPPooling if args.sparse_pool else AttentionMLPPooling
+        pool = pool_class(hidden_dim=args.hidden_dim, out_dim=args.pool_dim,
+                          mlp_dim_spatial=args.spatial_dim, mlp_dim_vel=args.vel_dim, **sparse_args)
     elif args.type == 'nn':
-        pool = NearestNeighborMLP(n=args.neigh, out_dim=args.pool_dim, no_vel=args.no_vel)
+        pool_class = SparseNearestNeighborMLP if args.sparse_pool else NearestNeighborMLP
+        pool = pool_class(n=args.neigh, out_dim=args.pool_dim, no_vel=args.no_vel, **sparse_args)
     elif args.type == 'nn_lstm':
         pool = NearestNeighborLSTM(n=args.neigh, hidden_dim=args.hidden_dim, out_dim=args.pool_dim)
     elif args.type == 'traj_pool':
         pool = TrajectronPooling(hidden_dim=args.hidden_dim, out_dim=args.pool_dim)
+    elif args.type == 'nmmp':
+        pool = NMMP(hidden_dim=args.hidden_dim, out_dim=args.pool_dim, k=args.mp_iters)
     elif args.type != 'vanilla':
-        pool = GridBasedPooling(type_=args.type, hidden_dim=args.hidden_dim,
-                                cell_side=args.cell_side, n=args.n, front=args.front,
-                                out_dim=args.pool_dim, embedding_arch=args.embedding_arch,
-                                constant=args.pool_constant, pretrained_pool_encoder=pretrained_pool,
-                                norm=args.norm, layer_dims=args.layer_dims, latent_dim=args.latent_dim)
+        pool_class = SparseGridBasedPooling if args.sparse_pool else GridBasedPooling
+        pool = pool_class(type_=args.type, hidden_dim=args.hidden_dim,
+                          cell_side=args.cell_side, n=args.n, front=args.front,
+                          out_dim=args.pool_dim, embedding_arch=args.embedding_arch,
+                          constant=args.pool_constant, pretrained_pool_encoder=pretrained_pool,
+                          norm=args.norm, layer_dims=args.layer_dims, latent_dim=args.latent_dim,
+                          reduce=args.pool_reduce, **sparse_args)
 
     # create forecasting model
     model = LSTM(pool=pool,
@@ -527,7 +495,9 @@ def main(epochs=25):
                       criterion=criterion, batch_size=args.batch_size, obs_length=args.obs_length,
                       pred_length=args.pred_length, augment=args.augment, normalize_scene=args.normalize_scene,
                       save_every=args.save_every, start_length=args.start_length, obs_dropout=args.obs_dropout,
-                      augment_noise=args.augment_noise, val_flag=val_flag)
+                      augment_noise=args.augment_noise, val_flag=val_flag,
+                      num_workers=args.num_workers, pin_memory=args.pin_memory,
+                      prefetch_factor=args.prefetch_factor, drop_distance=args.drop_distance)
     trainer.loop(train_scenes, val_scenes, train_goals, val_goals, args.output, epochs=args.epochs, start_epoch=start_epoch)
 
 
@@ -2,7 +2,6 @@ import os
 import argparse
 import pickle
 
-from joblib import Parallel, delayed
 import scipy
 import torch
 from tqdm import tqdm
@@ -12,11 +11,15 @@ from evaluator.write_utils import load_test_datasets, preprocess_test, write_pre
 from .lstm import LSTMPredictor
 
 
-def predict_scene(predictor, model_name, paths, scene_goal, args):
-    """For each scene, get model predictions"""
-    paths = preprocess_test(paths, args.obs_length)
-    predictions = predictor(paths, scene_goal, n_predict=args.pred_length, obs_length=args.obs_length, modes=args.modes, args=args)
-    return predictions
+def predict_scenes(predictor, scenes, scene_goals, args):
+    """Get model predictions for all scenes, args.batch_size scenes per forward pass"""
+    paths = [preprocess_test(paths, args.obs_length) for _, _, paths in scenes]
+    pred_list = []
+    for i in tqdm(range(0, len(paths), args.batch_size)):
+        pred_list += predictor.predict_batch(paths[i:i + args.batch_size], scene_goals[i:i + args.batch_size],
+                                             n_predict=args.pred_length, obs_length=args.obs_length,
+                                             modes=args.modes, batch_size=args.batch_size, args=args)
+    return pred_list
 
 
 def load_predictor(model, device='cpu'):
@@ -56,11 +59,9 @@ def get_predictions(args):
             # Load dataset
             dataset_name, scenes, scene_goals = load_test_datasets(dataset, goal_flag, args)
 
-            # Get all predictions in parallel. Faster!
-            scenes = tqdm(scenes)
-            pred_list = Parallel(n_jobs=12)(delayed(predict_scene)(predictor, model_name, paths, scene_goal, args)
-                                            for (_, _, paths), scene_goal in zip(scenes, scene_goals))
-            
+            # Get all predictions in batches of scenes. Faster!
+            pred_list = predict_scenes(predictor, scenes, scene_goals, args)
+
             # Write all predictions
             write_predictions(pred_list, scenes, model_name, dataset_name, args)
 
@@ -79,12 +80,20 @@ def main():
                         help='disable writing new files')
     parser.add_argument('--disable-collision', action='store_true',
                         help='disable collision metrics')
+    parser.add_argument('--eval_backend', default='array', choices=('array', 'rows'),
+                        help='compute the metrics on padded arrays or row by row')
+    parser.add_argument('--n_jobs', default=1, type=int,
+                        help='number of processes evaluating (model, dataset) pairs')
+    parser.add_argument('--no_gt_cache', action='store_true',
+                        help='do not cache the parsed ground truth')
     parser.add_argument('--labels', required=False, nargs='+',
                         help='labels of models')
     parser.add_argument('--normalize_scene', action='store_true',
                         help='augment scenes')
     parser.add_argument('--modes', default=1, type=int,
                         help='number of modes to predict')
+    parser.add_argument('--batch_size', default=64, type=int,
+                        help='number of scenes predicted in one forward pass')
     args = parser.parse_args()
 
     scipy.seterr('ignore')
@@ -0,0 +1,55 @@
+import numpy as np
+
+
+def min_distances(xy):
+    """
+    Minimum squared distance of each track to the primary ped (first track) over all frames
+    (nan if the track is never visible together with the primary ped or if there are no frames)
+
+    xy : Array [num_frames, num_tracks, 2]
+    output : Array [num_tracks]
+    """
+    distance_2 = np.sum(np.square(xy - xy[:, 0:1]), axis=2)
+    return np.fmin.reduce(distance_2, axis=0, initial=np.nan)
+
+
+def batch_min_distances(xy, offsets):
+    """
+    min_distances of all scenes at once. The scenes are concatenated along
+    the track dimension: the tracks of scene i are xy[:, offsets[i]:offsets[i+1]]
+    and its primary ped is the track offsets[i] (see concatenate_scenes)
+
+    xy : Array [max_num_frames, total_tracks, 2]
+    offsets : Array [num_scenes + 1]
+    output : Array [total_tracks]
+    """
+    primary = np.repeat(offsets[:-1], np.diff(offsets))
+    distance_2 = np.sum(np.square(xy - xy[:, primary]), axis=2)
+    return np.fmin.reduce(distance_2, axis=0, initial=np.nan)
+
+
+def concatenate_scenes(scenes_xy, dtype=np.float32):
+    """
+    Concatenates scenes of different lengths along the track dimension (nan for blanks)
+
+    scenes_xy : List of Array [num_frames, num_tracks, 2]
+    output : Array [max_num_frames, total_tracks, 2] and track offsets Array [num_scenes + 1]
+    """
+    offsets = np.cumsum([0] + [xy.shape[1] for xy in scenes_xy]).astype(np.int64)
+    all_xy = np.full((max((len(xy) for xy in scenes_xy), default=0), offsets[-1], 2), np.nan, dtype=dtype)
+    for xy, start, end in zip(scenes_xy, offsets[:-1], offsets[1:]):
+        all_xy[:len(xy), start:end] = xy
+    return all_xy, offsets
+
+
+def drop_distant(xy, r=6.0, min_distance_2=None):
+    """
+    Drops pedestrians more than r meters away from primary ped
+
+    min_distance_2 : Array [num_tracks]
+        Precomputed min_distances of the scene (computed if None)
+    """
+    if min_distance_2 is None:
+        min_distance_2 = min_distances(xy)
+    mask = min_distance_2 < r**2
+    return xy[:, mask], mask
@@ -2,7 +2,6 @@ from collections import defaultdict
 import itertools
 import copy
 
-import numpy as np
 import torch
 import torch.nn as nn
 
@@ -11,19 +10,12 @@ import trajnetplusplustools
 from ..lstm.modules import Hidden2Normal, InputEmbedding
 
 from .. import augmentation
+from ..preprocess import drop_distant
 from ..lstm.utils import center_scene
-from ..lstm.lstm import generate_pooling_inputs
+from ..lstm.lstm import generate_pooling_inputs, pooling_scatter_index, repeat_batch_split, repeat_pooling_state
 
 NAN = float('nan')
 
-def drop_distant(xy, r=6.0):
-    """
-    Drops pedestrians more than r meters away from primary ped
-    """
-    distance_2 = np.sum(np.square(xy - xy[:, 0:1]), axis=2)
-    mask = np.nanmin(distance_2, axis=0) < r**2
-    return xy[:, mask], mask
-
 def get_noise(shape, noise_type, device):
     if noise_type == 'gaussian':
         return torch.randn(*shape, device=device)
@@ -112,16 +104,11 @@ class SGAN(torch.nn.Module):
             Discriminator scores of prediction primary tracks
         """
 
-        rel_pred_list = []
-        pred_list = []
-        for _ in range(self.k):
-            # print("k:", k)
-            rel_pred_scene, pred_scene = self.generator(observed, goals, batch_split, prediction_truth, n_predict)
-            rel_pred_list.append(rel_pred_scene)
-            pred_list.append(pred_scene)
-
-            if step_type == 'd':
-                break
+        ## All k modes are decoded in parallel from a single encoding
+        ## Discriminator step requires a single sample
+        modes = 1 if step_type == 'd' else self.k
+        rel_pred_list, pred_list = self.generator(observed, goals, batch_split, prediction_truth, n_predict, modes=modes)
+        pred_scene = pred_list[-1]
 
         ## Get real scores and fake scores from discriminator
         if self.d_steps and (prediction_truth is not None):
@@ -197,30 +184,43 @@ class LSTMGenerator(torch.nn.Module):
         )
         ###############################
 
-    def adding_noise(self, hidden_cell_state):
-        ## Adds noise to hidden_cell_state for multimodal prediction
+    def adding_noise(self, hidden_cell_state, modes=1):
+        """ Tile hidden_cell_state for `modes` samples and add noise for multimodal prediction
 
-        if self.no_noise:
-            return hidden_cell_state
+        Parameters
+        ----------
+        hidden_cell_state : tuple (hidden_state, cell_state)
+            Encoded hidden_cell_state of the pedestrians, each Tensor [num_tracks, hidden_dim]
+        modes : int
+            Number of samples. Every sample draws a single noise vector shared by all tracks.
 
-        hidden_cell_state = (
-            torch.stack([h for h in hidden_cell_state[0]], dim=0),
-            torch.stack([c for c in hidden_cell_state[1]], dim=0),
-        )
+        Returns
+        -------
+        hidden_cell_state : tuple (hidden_state, cell_state)
+            Each Tensor [modes * num_tracks, hidden_dim]. Sample m occupies
+            rows [m * num_tracks, (m + 1) * num_tracks)
+        """
+
+        if self.no_noise:
+            return (
+                hidden_cell_state[0].repeat(modes, 1),
+                hidden_cell_state[1].repeat(modes, 1),
+            )
 
         ## Add noise to hidden state
         ## [num_tracks, hidden_dim] --> [num_tracks, hidden_dim - noise_dim]
         new_hidden_state = self.mlp_decoder_context(hidden_cell_state[0])
-        noise = get_noise((self.noise_dim, ), self.noise_type, device=hidden_cell_state[0].device)
-        z_decoder = noise.repeat(new_hidden_state.size(0), 1)
-        new_hidden_state = torch.cat([new_hidden_state, z_decoder], dim=1)
+        num_tracks = new_hidden_state.size(0)
+        noise = get_noise((modes, self.noise_dim), self.noise_type, device=new_hidden_state.device)
+        z_decoder = noise.repeat_interleave(num_tracks, dim=0)
+        new_hidden_state = torch.cat([new_hidden_state.repeat(modes, 1), z_decoder], dim=1)
 
         return (
-            list(new_hidden_state),
-            list(hidden_cell_state[1]),
+            new_hidden_state,
+            hidden_cell_state[1].repeat(modes, 1),
         )
 
-    def step(self, lstm, hidden_cell_state, obs1, obs2, goals, batch_split):
+    def step(self, lstm, hidden_cell_state, obs1, obs2, goals, batch_split, scatter_index=None):
         """Do one step of prediction: two inputs to one normal prediction.
         
         Parameters
@@ -235,6 +235,10 @@ class LSTMGenerator(torch.nn.Module):
             Current x-y positions of the pedestrians
         goals : Tensor [num_tracks, 2]
             Goal coordinates of the pedestrians
+        batch_split : Tensor [batch_size + 1]
+            Tensor defining the split of the batch.
+        scatter_index : tuple, optional
+            Precomputed output of pooling_scatter_index(batch_split)
         
         Returns
         -------
@@ -251,8 +255,8 @@ class LSTMGenerator(torch.nn.Module):
 
         ## Masked Hidden Cell State
         hidden_cell_stacked = [
-            torch.stack([h for m, h in zip(track_mask, hidden_cell_state[0]) if m], dim=0),
-            torch.stack([c for m, c in zip(track_mask, hidden_cell_state[1]) if m], dim=0),
+            hidden_cell_state[0][track_mask],
+            hidden_cell_state[1][track_mask],
         ]
 
         ## Mask current velocity & embed
@@ -273,7 +277,7 @@ class LSTMGenerator(torch.nn.Module):
         ## Mask & Pool per scene
         if self.pool is not None:
             curr_positions, prev_positions, curr_hidden_state, track_mask_positions = \
-                generate_pooling_inputs(obs2, obs1, hidden_cell_state, track_mask, batch_split)
+                generate_pooling_inputs(obs2, obs1, hidden_cell_state, track_mask, batch_split, scatter_index)
             pool_sample = self.pool(curr_hidden_state, prev_positions, curr_positions)
             pooled = pool_sample[track_mask_positions.view(-1)]
 
@@ -287,20 +291,20 @@ class LSTMGenerator(torch.nn.Module):
         normal_masked = self.hidden2normal(hidden_cell_stacked[0])
 
         # unmask [Update hidden-states and next velocities of pedestrians]
+        # Out-of-place index_put: the hidden-cell-states of absent pedestrians
+        # are carried over unchanged and remain part of the backprop graph.
+        hidden_cell_state = (
+            hidden_cell_state[0].index_put((track_mask,), hidden_cell_stacked[0]),
+            hidden_cell_state[1].index_put((track_mask,), hidden_cell_stacked[1]),
+        )
         normal = torch.full((track_mask.size(0), 5), NAN, device=obs1.device)
-        mask_index = [i for i, m in enumerate(track_mask) if m]
-        for i, h, c, n in zip(mask_index,
-                              hidden_cell_stacked[0],
-                              hidden_cell_stacked[1],
-                              normal_masked):
-            hidden_cell_state[0][i] = h
-            hidden_cell_state[1][i] = c
-            normal[i] = n
+        normal = normal.index_put((track_mask,), normal_masked)
 
         return hidden_cell_state, normal
 
-    def forward(self, observed, goals, batch_split, prediction_truth=None, n_predict=None):
-        """Forecast the entire sequence 
+    def forward(self, observed, goals, batch_split, prediction_truth=None, n_predict=None, modes=1):
+        """Forecast the entire sequence for `modes` noise samples.
+        The observation is encoded once and all samples are decoded in parallel.
         
         Parameters
         ----------
@@ -316,13 +320,17 @@ class LSTMGenerator(torch.nn.Module):
             Helps in teacher forcing wrt neighbours positions during training
         n_predict: Int
             Length of sequence to be predicted during test time
+        modes: Int
+            Number of samples to be predicted
 
         Returns
         -------
-        rel_pred_scene : Tensor [pred_length, num_tracks, 5]
+        rel_pred_list : List of length modes
+            Each element of the list is Tensor [pred_length, num_tracks, 5]
             Predicted velocities of pedestrians as multivariate normal
             i.e. positions relative to previous positions
-        pred_scene : Tensor [pred_length, num_tracks, 2]
+        pred_list : List of length modes
+            Each element of the list is Tensor [pred_length, num_tracks, 2]
             Predicted positions of pedestrians i.e. absolute positions
         """
 
@@ -331,14 +339,13 @@ class LSTMGenerator(torch.nn.Module):
             # -1 because one prediction is done by the encoder already
             prediction_truth = [None for _ in range(n_predict)]
 
-        # initialize: Because of tracks with different lengths and the masked
-        # update, the hidden state for every LSTM needs to be a separate object
-        # in the backprop graph. Therefore: list of hidden states instead of
-        # a single higher rank Tensor.
+        # initialize: hidden-cell-states of all tracks as single [num_tracks, hidden_dim]
+        # Tensors. Tracks with different lengths are handled by the masked
+        # (out-of-place) update in self.step.
         num_tracks = observed.size(1)
         hidden_cell_state = (
-            [torch.zeros(self.hidden_dim, device=observed.device) for _ in range(num_tracks)],
-            [torch.zeros(self.hidden_dim, device=observed.device) for _ in range(num_tracks)],
+            torch.zeros(num_tracks, self.hidden_dim, device=observed.device),
+            torch.zeros(num_tracks, self.hidden_dim, device=observed.device),
         )
 
         ## Reset LSTMs of Interaction Encoders.
@@ -346,6 +353,10 @@ class LSTMGenerator(torch.nn.Module):
             max_num_neighbor = (batch_split[1:] - batch_split[:-1]).max() - 1
             batch_size = len(batch_split) - 1
             self.pool.reset(batch_size * (max_num_neighbor+1), max_num_neighbor, device=observed.device)
+            ## Padded pooling layout is shared by all timesteps
+            scatter_index = pooling_scatter_index(batch_split, device=observed.device)
+        else:
+            scatter_index = None
 
         # list of predictions
         normals = []  # predicted normal parameters for both phases
@@ -357,46 +368,62 @@ class LSTMGenerator(torch.nn.Module):
         # encoder
         for obs1, obs2 in zip(observed[:-1], observed[1:]):
             ##LSTM Step
-            hidden_cell_state, normal = self.step(self.encoder, hidden_cell_state, obs1, obs2, goals, batch_split)
+            hidden_cell_state, normal = self.step(self.encoder, hidden_cell_state, obs1, obs2, goals, batch_split, scatter_index)
 
             # concat predictions
             normals.append(normal)
             positions.append(obs2 + normal[:, :2])  # no sampling, just mean
 
+        # Add Noise: [num_tracks, hidden_dim] --> [modes * num_tracks, hidden_dim]
+        hidden_cell_state = self.adding_noise(hidden_cell_state, modes)
+
+        ## Tile the batch for the parallel decoding of all modes
+        if modes > 1:
+            observed = observed.repeat(1, modes, 1)
+            goals = goals.repeat(modes, 1)
+            if torch.is_tensor(prediction_truth):
+                prediction_truth = prediction_truth.repeat(1, modes, 1)
+            normals = [normal.repeat(modes, 1) for normal in normals]
+            positions = [position.repeat(modes, 1) for position in positions]
+            batch_split = repeat_batch_split(batch_split, num_tracks, modes)
+            if self.pool is not None:
+                repeat_pooling_state(self.pool, modes)
+                scatter_index = pooling_scatter_index(batch_split, device=observed.device)
+
         # initialize predictions with last position to form velocity. DEEP COPY !!!
         prediction_truth = copy.deepcopy(list(itertools.chain.from_iterable(
             (observed[-1:], prediction_truth[:-1])
         )))
 
-        # Add Noise
-        hidden_cell_state = self.adding_noise(hidden_cell_state)
-
         # decoder, predictions
+        primary_ids = batch_split[:-1]
         for obs1, obs2 in zip(prediction_truth[:-1], prediction_truth[1:]):
             if obs1 is None:
                 obs1 = positions[-2].detach()  # DETACH!!!
             else:
-                for primary_id in batch_split[:-1]:
-                    obs1[primary_id] = positions[-2][primary_id].detach()  # DETACH!!!
+                obs1[primary_ids] = positions[-2][primary_ids].detach()  # DETACH!!!
             if obs2 is None:
                 obs2 = positions[-1].detach()
             else:
-                for primary_id in batch_split[:-1]:
-                    obs2[primary_id] = positions[-1][primary_id].detach()  # DETACH!!!
-            hidden_cell_state, normal = self.step(self.decoder, hidden_cell_state, obs1, obs2, goals, batch_split)
+                obs2[primary_ids] = positions[-1][primary_ids].detach()  # DETACH!!!
+            hidden_cell_state, normal = self.step(self.decoder, hidden_cell_state, obs1, obs2, goals, batch_split, scatter_index)
 
             # concat predictions
             normals.append(normal)
             positions.append(obs2 + normal[:, :2])  # no sampling, just mean
 
-        # Pred_scene: Tensor [seq_length, num_tracks, 2]
+        # Pred_scene: Tensor [seq_length, modes * num_tracks, 2]
         #    Absolute positions of all pedestrians
-        # Rel_pred_scene: Tensor [seq_length, num_tracks, 5]
+        # Rel_pred_scene: Tensor [seq_length, modes * num_tracks, 5]
         #    Velocities of all pedestrians
         rel_pred_scene = torch.stack(normals, dim=0)
         pred_scene = torch.stack(positions, dim=0)
 
-        return rel_pred_scene, pred_scene
+        ## Split into the individual modes
+        rel_pred_list = list(torch.split(rel_pred_scene, num_tracks, dim=1))
+        pred_list = list(torch.split(pred_scene, num_tracks, dim=1))
+
+        return rel_pred_list, pred_list
 
 class LSTMDiscriminator(torch.nn.Module):
     def __init__(self, embedding_dim=64, hidden_dim=128, pool=None, pool_to_input=True, goal_dim=None, goal_flag=False):
@@ -445,7 +472,7 @@ class LSTMDiscriminator(torch.nn.Module):
             real_classifier_dims
         )
 
-    def step(self, lstm, hidden_cell_state, obs1, obs2, goals, batch_split):
+    def step(self, lstm, hidden_cell_state, obs1, obs2, goals, batch_split, scatter_index=None):
         """Do one step of prediction: two inputs to one normal prediction.
         
         Parameters
@@ -460,6 +487,10 @@ class LSTMDiscriminator(torch.nn.Module):
             Current x-y positions of the pedestrians
         goals : Tensor [num_tracks, 2]
             Goal coordinates of the pedestrians
+        batch_split : Tensor [batch_size + 1]
+            Tensor defining the split of the batch.
+        scatter_index : tuple, optional
+            Precomputed output of pooling_scatter_index(batch_split)
         
         Returns
         -------
@@ -476,8 +507,8 @@ class LSTMDiscriminator(torch.nn.Module):
 
         ## Masked Hidden Cell State
         hidden_cell_stacked = [
-            torch.stack([h for m, h in zip(track_mask, hidden_cell_state[0]) if m], dim=0),
-            torch.stack([c for m, c in zip(track_mask, hidden_cell_state[1]) if m], dim=0),
+            hidden_cell_state[0][track_mask],
+            hidden_cell_state[1][track_mask],
         ]
 
         ## Mask current velocity & embed
@@ -498,7 +529,7 @@ class LSTMDiscriminator(torch.nn.Module):
         ## Mask & Pool per scene
         if self.pool is not None:
             curr_positions, prev_positions, curr_hidden_state, track_mask_positions = \
-                generate_pooling_inputs(obs2, obs1, hidden_cell_state, track_mask, batch_split)
+                generate_pooling_inputs(obs2, obs1, hidden_cell_state, track_mask, batch_split, scatter_index)
             pool_sample = self.pool(curr_hidden_state, prev_positions, curr_positions)
             pooled = pool_sample[track_mask_positions.view(-1)]
 
@@ -511,12 +542,10 @@ class LSTMDiscriminator(torch.nn.Module):
         hidden_cell_stacked = lstm(input_emb, hidden_cell_stacked)
 
         # unmask [Update hidden-states of pedestrians]
-        mask_index = [i for i, m in enumerate(track_mask) if m]
-        for i, h, c in zip(mask_index,
-                           hidden_cell_stacked[0],
-                           hidden_cell_stacked[1]):
-            hidden_cell_state[0][i] = h
-            hidden_cell_state[1][i] = c
+        hidden_cell_state = (
+            hidden_cell_state[0].index_put((track_mask,), hidden_cell_stacked[0]),
+            hidden_cell_state[1].index_put((track_mask,), hidden_cell_stacked[1]),
+        )
 
         return hidden_cell_state, None
 
@@ -544,14 +573,13 @@ class LSTMDiscriminator(torch.nn.Module):
 
         observed = torch.cat([observed, prediction], dim=0)
 
-        # initialize: Because of tracks with different lengths and the masked
-        # update, the hidden state for every LSTM needs to be a separate object
-        # in the backprop graph. Therefore: list of hidden states instead of
-        # a single higher rank Tensor.
+        # initialize: hidden-cell-states of all tracks as single [num_tracks, hidden_dim]
+        # Tensors. Tracks with different lengths are handled by the masked
+        # (out-of-place) update in self.step.
         num_tracks = observed.size(1)
         hidden_cell_state = (
-            [torch.zeros(self.hidden_dim, device=observed.device) for _ in range(num_tracks)],
-            [torch.zeros(self.hidden_dim, device=observed.device) for _ in range(num_tracks)],
+            torch.zeros(num_tracks, self.hidden_dim, device=observed.device),
+            torch.zeros(num_tracks, self.hidden_dim, device=observed.device),
         )
 
         ## Reset LSTMs of Interaction Encoders.
@@ -559,16 +587,15 @@ class LSTMDiscriminator(torch.nn.Module):
             max_num_neighbor = (batch_split[1:] - batch_split[:-1]).max() - 1
             batch_size = len(batch_split) - 1
             self.pool.reset(batch_size * (max_num_neighbor+1), max_num_neighbor, device=observed.device)
+            ## Padded pooling layout is shared by all timesteps
+            scatter_index = pooling_scatter_index(batch_split, device=observed.device)
+        else:
+            scatter_index = None
 
         # encoder
         for obs1, obs2 in zip(observed[:-1], observed[1:]):
             ##LSTM Step
-            hidden_cell_state, _ = self.step(self.encoder, hidden_cell_state, obs1, obs2, goals, batch_split)
-
-        hidden_cell_state = (
-            torch.stack([h for h in hidden_cell_state[0]], dim=0),
-            torch.stack([c for c in hidden_cell_state[1]], dim=0),
-        )
+            hidden_cell_state, _ = self.step(self.encoder, hidden_cell_state, obs1, obs2, goals, batch_split, scatter_index)
 
         ## Score only the primary pedestrians
         primary_hidden_state = hidden_cell_state[0][batch_split[:-1]]
@@ -1,9 +1,8 @@
-import numpy as np
 import torch
 
-def sample_multivariate_distribution(mean, var_log):
+def sample_multivariate_distribution(mean, var_log, num_samples=None, generator=None):
     """
-    Draw random samples from a multivariate normal distribution 
+    Draw random samples from a multivariate normal distribution with diagonal covariance
 
     Parameters
     ----------
@@ -11,14 +10,17 @@ def sample_multivariate_distribution(mean, var_log):
         Mean of the multivariate distribution  
     var_log : Tensor [num_tracks, dim]
         Logarithm of the diagonal coefficients of the covariance matrix
+    num_samples : int, optional
+        Number of samples drawn per track. If None, a single sample is drawn
+        and the leading samples dimension is omitted
+    generator : torch.Generator, optional
+        Generator used for sampling (must live on the device of mean)
 
     Returns
     -------
-    samples : Tensor [num_tracks, dim]  
-        The drawn samples of size [num_tracks, dim]
+    samples : Tensor [num_tracks, dim] or [num_samples, num_tracks, dim]
+        The drawn samples
     """
-    samples = torch.zeros_like(mean)
-    for track in range(mean.size(0)):
-        cov_matrix = np.diag(torch.exp(var_log[track, :]).numpy())
-        samples[track, :] = torch.Tensor(np.random.multivariate_normal(mean[track, :].numpy(), cov_matrix))
-    return samples
\ No newline at end of file
+    size = mean.size() if num_samples is None else (num_samples,) + mean.size()
+    epsilon = torch.randn(size, generator=generator, dtype=mean.dtype, device=mean.device)
+    return mean + torch.exp(0.5 * var_log) * epsilon
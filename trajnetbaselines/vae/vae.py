@@ -1,28 +1,20 @@
 import itertools
 import copy
 
-import numpy as np
 import torch
 
 import trajnetplusplustools
 
 from .. import augmentation
+from ..preprocess import drop_distant
 from ..lstm.utils import center_scene
 from ..lstm.modules import Hidden2Normal, InputEmbedding
-from ..lstm.lstm import generate_pooling_inputs
+from ..lstm.lstm import generate_pooling_inputs, pooling_scatter_index, repeat_batch_split, repeat_pooling_state
 
 from .utils import sample_multivariate_distribution
 
 NAN = float('nan')
 
-def drop_distant(xy, r=6.0):
-    """
-    Drops pedestrians more than r meters away from primary ped
-    """
-    distance_2 = np.sum(np.square(xy - xy[:, 0:1]), axis=2)
-    mask = np.nanmin(distance_2, axis=0) < r**2
-    return xy[:, mask], mask
-
 class VAE(torch.nn.Module):
     def __init__(self, embedding_dim=64, hidden_dim=128, pool=None, pool_to_input=True, goal_dim=None, goal_flag=False,
                  num_modes=1, latent_dim=128):
@@ -81,32 +73,41 @@ class VAE(torch.nn.Module):
         self.vae_decoder = VAEDecoder(self.latent_dim, self.hidden_dim)
 
     def concat(self, hidden_cell_state, hidden_cell_state_pred):
-        return  (list(torch.cat([torch.stack(hidden_cell_state[0]), torch.stack(hidden_cell_state_pred[0])], dim=1)),
-                 list(torch.cat([torch.stack(hidden_cell_state[1]), torch.stack(hidden_cell_state_pred[1])], dim=1))
+        return  (torch.cat([hidden_cell_state[0], hidden_cell_state_pred[0]], dim=1),
+                 torch.cat([hidden_cell_state[1], hidden_cell_state_pred[1]], dim=1)
                 )
 
-    def add_noise(self, hidden_cell_state, z_mu, z_var_log, z_mu_obs, z_var_log_obs):
+    def add_noise(self, hidden_cell_state, z_mu, z_var_log, z_mu_obs, z_var_log_obs, modes=1, generator=None):
+        """ Sample `modes` latent vectors per track and condition the hidden-state on them.
+        The samples are drawn with `generator` (torch.Generator) if given, else with the global RNG
+
+        Returns
+        -------
+        hidden_cell_state : tuple (hidden_state, cell_state)
+            Each Tensor [modes * num_tracks, hidden_dim]. Sample m occupies
+            rows [m * num_tracks, (m + 1) * num_tracks)
+        """
 
         if self.training:
             ## Sampling using "reparametrization trick"
             # See Kingma & Wellig, Auto-Encoding Variational Bayes, 2014 (arXiv:1312.6114)
-            epsilon = torch.empty(size=z_mu.size()).normal_(mean=0, std=1)
+            epsilon = torch.empty(size=(modes,) + z_mu.size(), device=z_mu.device).normal_(mean=0, std=1, generator=generator)
             z_val = z_mu + torch.exp(0.5*z_var_log) * epsilon
 
         else:
-            # Draw a sample from the learned multivariate distribution (z_mu, z_var_log)
-            z_val = sample_multivariate_distribution(z_mu_obs, z_var_log_obs)
+            # Draw samples from the learned multivariate distribution (z_mu, z_var_log)
+            z_val = sample_multivariate_distribution(z_mu_obs, z_var_log_obs, num_samples=modes, generator=generator)
 
-        ## VAE decoder
+        ## VAE decoder: [modes, num_tracks, latent_dim] --> [modes * num_tracks, hidden_dim]
         decoder_output = self.vae_decoder(z_val)
 
         ## Update Hidden-Cell-State
-        hidden_state_new = [hidden_state * dec_output for dec_output, hidden_state in zip(decoder_output, hidden_cell_state[0])]
-        cell_state_new = [cell_state for cell_state in hidden_cell_state[1]]
+        hidden_state_new = hidden_cell_state[0].repeat(modes, 1) * decoder_output
+        cell_state_new = hidden_cell_state[1].repeat(modes, 1)
 
         return (hidden_state_new, cell_state_new)
 
-    def step(self, lstm, hidden_cell_state, obs1, obs2, goals, batch_split):
+    def step(self, lstm, hidden_cell_state, obs1, obs2, goals, batch_split, scatter_index=None):
         """Do one step of prediction: two inputs to one normal prediction.
         
         Parameters
@@ -121,6 +122,10 @@ class VAE(torch.nn.Module):
             Current x-y positions of the pedestrians
         goals : Tensor [num_tracks, 2]
             Goal coordinates of the pedestrians
+        batch_split : Tensor [batch_size + 1]
+            Tensor defining the split of the batch.
+        scatter_index : tuple, optional
+            Precomputed output of pooling_scatter_index(batch_split)
         
         Returns
         -------
@@ -137,8 +142,8 @@ class VAE(torch.nn.Module):
 
         ## Masked Hidden Cell State
         hidden_cell_stacked = [
-            torch.stack([h for m, h in zip(track_mask, hidden_cell_state[0]) if m], dim=0),
-            torch.stack([c for m, c in zip(track_mask, hidden_cell_state[1]) if m], dim=0),
+            hidden_cell_state[0][track_mask],
+            hidden_cell_state[1][track_mask],
         ]
 
         ## Mask current velocity & embed
@@ -159,7 +164,7 @@ class VAE(torch.nn.Module):
         ## Mask & Pool per scene
         if self.pool is not None:
             curr_positions, prev_positions, curr_hidden_state, track_mask_positions = \
-                generate_pooling_inputs(obs2, obs1, hidden_cell_state, track_mask, batch_split)
+                generate_pooling_inputs(obs2, obs1, hidden_cell_state, track_mask, batch_split, scatter_index)
             pool_sample = self.pool(curr_hidden_state, prev_positions, curr_positions)
             pooled = pool_sample[track_mask_positions.view(-1)]
 
@@ -173,19 +178,18 @@ class VAE(torch.nn.Module):
         normal_masked = self.hidden2normal(hidden_cell_stacked[0])
 
         # unmask [Update hidden-states and next velocities of pedestrians]
+        # Out-of-place index_put: the hidden-cell-states of absent pedestrians
+        # are carried over unchanged and remain part of the backprop graph.
+        hidden_cell_state = (
+            hidden_cell_state[0].index_put((track_mask,), hidden_cell_stacked[0]),
+            hidden_cell_state[1].index_put((track_mask,), hidden_cell_stacked[1]),
+        )
         normal = torch.full((track_mask.size(0), 5), NAN, device=obs1.device)
-        mask_index = [i for i, m in enumerate(track_mask) if m]
-        for i, h, c, n in zip(mask_index,
-                              hidden_cell_stacked[0],
-                              hidden_cell_stacked[1],
-                              normal_masked):
-            hidden_cell_state[0][i] = h
-            hidden_cell_state[1][i] = c
-            normal[i] = n
+        normal = normal.index_put((track_mask,), normal_masked)
 
         return hidden_cell_state, normal
 
-    def forward(self, observed, goals, batch_split, prediction_truth=None, n_predict=None):
+    def forward(self, observed, goals, batch_split, prediction_truth=None, n_predict=None, generator=None):
         """Forecast the entire sequence 
         
         Parameters
@@ -202,12 +206,16 @@ class VAE(torch.nn.Module):
             Helps in teacher forcing wrt neighbours positions during training
         n_predict: Int
             Length of sequence to be predicted during test time
+        generator: torch.Generator, optional
+            Generator used to sample the latent vectors of the modes (global RNG if None)
         Returns
         -------
-        rel_pred_scene : Tensor [pred_length, num_tracks, 5]
+        rel_pred_scene : List of length num_modes
+            Each element of the list is Tensor [pred_length, num_tracks, 5]
             Predicted velocities of pedestrians as multivariate normal
             i.e. positions relative to previous positions
-        pred_scene : Tensor [pred_length, num_tracks, 2]
+        pred_scene : List of length num_modes
+            Each element of the list is Tensor [pred_length, num_tracks, 2]
             Predicted positions of pedestrians i.e. absolute positions
         """
 
@@ -216,14 +224,13 @@ class VAE(torch.nn.Module):
             # -1 because one prediction is done by the encoder already
             prediction_truth = [None for _ in range(n_predict - 1)]
 
-        # initialize: Because of tracks with different lengths and the masked
-        # update, the hidden state for every LSTM needs to be a separate object
-        # in the backprop graph. Therefore: list of hidden states instead of
-        # a single higher rank Tensor.
+        # initialize: hidden-cell-states of all tracks as single [num_tracks, hidden_dim]
+        # Tensors. Tracks with different lengths are handled by the masked
+        # (out-of-place) update in self.step.
         num_tracks = observed.size(1)
         hidden_cell_state = (
-            [torch.zeros(self.hidden_dim, device=observed.device) for _ in range(num_tracks)],
-            [torch.zeros(self.hidden_dim, device=observed.device) for _ in range(num_tracks)],
+            torch.zeros(num_tracks, self.hidden_dim, device=observed.device),
+            torch.zeros(num_tracks, self.hidden_dim, device=observed.device),
         )
 
         ## Reset LSTMs of Interaction Encoders.
@@ -231,20 +238,23 @@ class VAE(torch.nn.Module):
             max_num_neighbor = (batch_split[1:] - batch_split[:-1]).max() - 1
             batch_size = len(batch_split) - 1
             self.pool.reset(batch_size * (max_num_neighbor+1), max_num_neighbor, device=observed.device)
+            ## Padded pooling layout is shared by all timesteps
+            scatter_index = pooling_scatter_index(batch_split, device=observed.device)
+        else:
+            scatter_index = None
 
-        # list of predictions store a dictionary. Each key corresponds to one mode
-        normals = {mode: [] for mode in range(self.num_modes)} # predicted normal parameters for both phases
-        positions = {mode: [] for mode in range(self.num_modes)} # true (during obs phase) and predicted positions
+        # list of predictions
+        normals = []  # predicted normal parameters for both phases
+        positions = []  # true (during obs phase) and predicted positions
 
         # encoder
         for obs1, obs2 in zip(observed[:-1], observed[1:]):
             ##LSTM Step
-            hidden_cell_state, normal = self.step(self.obs_encoder, hidden_cell_state, obs1, obs2, goals, batch_split)
+            hidden_cell_state, normal = self.step(self.obs_encoder, hidden_cell_state, obs1, obs2, goals, batch_split, scatter_index)
 
             # concat predictions
-            for mode_n, mode_p in zip(normals.keys(), positions.keys()):
-                normals[mode_n].append(normal)
-                positions[mode_p].append(obs2 + normal[:, :2]) # no sampling, just mean
+            normals.append(normal)
+            positions.append(obs2 + normal[:, :2]) # no sampling, just mean
     
         # initialize predictions with last position to form velocity. DEEP COPY !!!
         prediction_truth = copy.deepcopy(list(itertools.chain.from_iterable(
@@ -256,14 +266,14 @@ class VAE(torch.nn.Module):
             assert prediction_truth is not None
             # Initialize hidden cell state for prediction encoder
             hidden_cell_state_pred = (
-                [torch.zeros(self.hidden_dim, device=observed.device) for _ in range(num_tracks)],
-                [torch.zeros(self.hidden_dim, device=observed.device) for _ in range(num_tracks)],
+                torch.zeros(num_tracks, self.hidden_dim, device=observed.device),
+                torch.zeros(num_tracks, self.hidden_dim, device=observed.device),
             )
 
             ## Encode
             for obs1, obs2 in zip(prediction_truth[:-1], prediction_truth[1:]):
                 # LSTM Step
-                hidden_cell_state_pred, _ = self.step(self.pred_encoder, hidden_cell_state_pred, obs1, obs2, goals, batch_split)
+                hidden_cell_state_pred, _ = self.step(self.pred_encoder, hidden_cell_state_pred, obs1, obs2, goals, batch_split, scatter_index)
 
         ## Get z_xy and z_x ###################################
         ## VAE encoder, latent distribution
@@ -277,40 +287,54 @@ class VAE(torch.nn.Module):
 
         # Compute target latent distribution (depending only on observation)
         z_distr_x = None
-        z_mu_obs = torch.zeros(num_tracks, self.latent_dim)
-        z_var_log_obs = torch.ones(num_tracks, self.latent_dim)
+        z_mu_obs = torch.zeros(num_tracks, self.latent_dim, device=observed.device)
+        z_var_log_obs = torch.ones(num_tracks, self.latent_dim, device=observed.device)
         if not self.desire:
             z_mu_obs, z_var_log_obs = self.vae_encoder_x(hidden_cell_state[0])
             z_distr_x = torch.cat((z_mu_obs, z_var_log_obs), dim=1)
         ########################################################
 
-        # Make num_modes predictions
-        for k in range(self.num_modes):
-            hidden_cell_state_dec = self.add_noise(hidden_cell_state, z_mu, z_var_log, z_mu_obs, z_var_log_obs)
+        # Make num_modes predictions: all modes are decoded in parallel.
+        # [num_tracks, hidden_dim] --> [num_modes * num_tracks, hidden_dim]
+        modes = self.num_modes
+        hidden_cell_state_dec = self.add_noise(hidden_cell_state, z_mu, z_var_log, z_mu_obs, z_var_log_obs, modes,
+                                               generator=generator)
+
+        ## Tile the batch for the parallel decoding of all modes
+        if modes > 1:
+            goals = goals.repeat(modes, 1)
+            prediction_truth = [obs.repeat(modes, 1) if obs is not None else None for obs in prediction_truth]
+            normals = [normal.repeat(modes, 1) for normal in normals]
+            positions = [position.repeat(modes, 1) for position in positions]
+            batch_split = repeat_batch_split(batch_split, num_tracks, modes)
+            if self.pool is not None:
+                repeat_pooling_state(self.pool, modes)
+                scatter_index = pooling_scatter_index(batch_split, device=observed.device)
+
+        # decoder, predictions
+        primary_ids = batch_split[:-1]
+        for obs1, obs2 in zip(prediction_truth[:-1], prediction_truth[1:]):
+            if obs1 is None:
+                obs1 = positions[-2].detach()  # DETACH!!!
+            else:
+                obs1[primary_ids] = positions[-2][primary_ids].detach()  # DETACH!!!
+            if obs2 is None:
+                obs2 = positions[-1].detach()
+            else:
+                obs2[primary_ids] = positions[-1][primary_ids].detach()  # DETACH!!!
+            hidden_cell_state_dec, normal = self.step(self.decoder, hidden_cell_state_dec, obs1, obs2, goals, batch_split, scatter_index)
+            # concat predictions
+            normals.append(normal)
+            positions.append(obs2 + normal[:, :2])  # no sampling, just mean
 
-            # decoder, predictions
-            for obs1, obs2 in zip(prediction_truth[:-1], prediction_truth[1:]):
-                if obs1 is None:
-                    obs1 = positions[k][-2].detach()  # DETACH!!!
-                else:
-                    for primary_id in batch_split[:-1]:
-                        obs1[primary_id] = positions[k][-2][primary_id].detach()  # DETACH!!!
-                if obs2 is None:
-                    obs2 = positions[k][-1].detach()
-                else:
-                    for primary_id in batch_split[:-1]:
-                        obs2[primary_id] = positions[k][-1][primary_id].detach()  # DETACH!!!
-                hidden_cell_state_dec, normal = self.step(self.decoder, hidden_cell_state_dec, obs1, obs2, goals, batch_split)
-                # concat predictions
-                normals[k].append(normal)
-                positions[k].append(obs2 + normal[:, :2])  # no sampling, just mean
-
-        # Pred_scene: Tensor [seq_length, num_tracks, 2]
+        # Pred_scene: List of length num_modes
+        #    Each element is Tensor [seq_length, num_tracks, 2]
         #    Absolute positions of all pedestrians
-        # Rel_pred_scene: Tensor [seq_length, num_tracks, 5]
+        # Rel_pred_scene: List of length num_modes
+        #    Each element is Tensor [seq_length, num_tracks, 5]
         #    Velocities of all pedestrians
-        rel_pred_scene = [torch.stack(normals[mode_n], dim=0) for mode_n in normals.keys()]
-        pred_scene = [torch.stack(positions[mode_p], dim=0) for mode_p in positions.keys()]
+        rel_pred_scene = list(torch.split(torch.stack(normals, dim=0), num_tracks, dim=1))
+        pred_scene = list(torch.split(torch.stack(positions, dim=0), num_tracks, dim=1))
 
         return rel_pred_scene, pred_scene, z_distr_xy, z_distr_x
 
@@ -325,7 +349,8 @@ class VAEEncoder(torch.nn.Module):
         self.relu = torch.nn.ReLU()
 
     def forward(self, inputs):
-        inputs = torch.stack(inputs)
+        if not torch.is_tensor(inputs):
+            inputs = torch.stack(inputs)
         inputs = torch.reshape(inputs, shape=(-1, self.input_dim))
         z_mu = self.relu(self.fc_mu(inputs))
         z_log_var = 0.01 + self.relu(self.fc_var(inputs))
@@ -363,7 +388,8 @@ class VAEPredictor(object):
             return torch.load(f)
 
 
-    def __call__(self, paths, scene_goal, n_predict=12, modes=1, predict_all=True, obs_length=9, start_length=0, args=None):
+    def __call__(self, paths, scene_goal, n_predict=12, modes=1, predict_all=True, obs_length=9, start_length=0, args=None,
+                 generator=None):
         self.model.eval()
         # self.model.train()
         self.model.num_modes = modes
@@ -380,7 +406,8 @@ class VAEPredictor(object):
             batch_split = torch.Tensor(batch_split).long()
 
             multimodal_outputs = {}
-            _, output_scenes_list, _, _ = self.model(xy[start_length:obs_length], scene_goal, batch_split, n_predict=n_predict)
+            _, output_scenes_list, _, _ = self.model(xy[start_length:obs_length], scene_goal, batch_split, n_predict=n_predict,
+                                                     generator=generator)
             for num_p, _ in enumerate(output_scenes_list):
                 output_scenes = output_scenes_list[num_p]
                 output_scenes = output_scenes.numpy()